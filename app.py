@@ -1,62 +1,66 @@
 import os
-from flask import Flask, render_template, request, flash, redirect, url_for
-import json
+from flask import Flask, Response, render_template, request, flash, redirect, url_for, abort, jsonify
+from markupsafe import Markup, escape
 import client
-import namenode
-import datanode
+from cache import LRUCache
 
 ui_client = client.Client("localhost",9000,9001)
 # ui_client.run()
-ui_namenode = namenode.NameNode("localhost",9001,[9002,9003,9004])
-# ui_namenode.start()
-ui_datanodes = []
-for port in [9002,9003,9004]:
-    ui_datanodes.append(datanode.DataNode("localhost",port))
-# for dn in ui_datanodes:
-#     dn.start()
 
 app = Flask(__name__)
 app.secret_key = '21jsxo3n'
 
-def is_folder(item, metadata):
-    return item in metadata["dir"].keys()
-
-def get_separate_files_and_folders(metadata,parent,current_directory):
-    folders, files = [], []
-    if parent=='':  # root
-        children = metadata["dir"][current_directory]["children"]  
-        for child in children:
-            if is_folder(parent+current_directory+child,metadata):
-                folders.append(child)
-            else:
-                files.append(child)
-        return folders,files  
-    if parent=='/':    # dirs under root
-        children = metadata["dir"][parent+current_directory]["children"]  
-        for child in children:
-            if is_folder(parent+current_directory+"/"+child,metadata):
-                folders.append(child)
-            else:
-                files.append(child)
-        return folders,files 
-    else:   # all other dirs
-        children = metadata["dir"][parent+current_directory]["children"]    
-        for child in children:
-            if is_folder(parent+current_directory+"/"+child,metadata):
-                folders.append(child)
-            else:
-                files.append(child)
-        return folders,files
+# entries shown per page of a directory
+PAGE_SIZE = 200
+
+# (directory path, page) -> (generation, entries, total entries) of pages listed before
+listings = LRUCache(1024)
+
+# bytes of a file shown on its page, the rest is available through download
+FILE_PREVIEW_BYTES = 64 * 1024
+
+# replicas shown per page of the block viewer
+BLOCKS_PAGE_SIZE = 50
+
+# bytes of a block the viewer loads at a time
+BLOCK_PREVIEW_BYTES = 4096
+
+# (datanode, block id) -> contents of blocks viewed recently, bounded by total bytes
+# block ids are never reused, so a cached block can't go stale
+block_cache = LRUCache(16 * 1024 * 1024, sizeof=len)
+
+# folders and files on one page of a directory and the number of pages, from the namenode
+# a cached page is revalidated with its generation, the namenode only sends the entries again if the directory changed
+def get_separate_files_and_folders(path, page):
+    cached = listings.get((path, page))
+    response = ui_client.listing(path, page*PAGE_SIZE, PAGE_SIZE, cached[0] if cached else None)
+    if response["status"]=="error":
+        flash(response["message"])
+        return [], [], 1
+    if response.get("not_modified"):
+        _, entries, total = cached
+    else:
+        entries, total = response["entries"], response["total"]
+        listings.put((path, page), (response["generation"], entries, total))
+    folders = [entry["name"] for entry in entries if entry["type"]=="dir"]
+    files = [entry["name"] for entry in entries if entry["type"]=="file"]
+    return folders, files, max((total + PAGE_SIZE - 1) // PAGE_SIZE, 1)
+
+# edfs directory of a UI path like root-dir-sub, with a trailing slash
+def edfs_directory(parent):
+    parent = parent.replace('-','/')
+    if parent=="root":
+        return "/"
+    return "/"+parent.replace("root/","")+"/"
 
 # Route for home page
 @app.route('/', methods=['GET','POST'])
 def home():
     directory = '/'  
-    with open("metadata.json","r") as f:
-        metadata = json.load(f)
-    folders, files = get_separate_files_and_folders(metadata,'',directory)
+    page = request.args.get('page', 0, type=int)
+    folders, files, pages = get_separate_files_and_folders(directory, page)
 
-    return render_template('index.html', directory=directory, folders=folders, files=files)
+    return render_template('index.html', directory=directory, folders=folders, files=files, page=page, pages=pages)
 
 # Display contents of a directory (command: ls)
 @app.route('/folder/<parent>/<folder_name>', methods=['POST','GET'])
@@ -68,80 +72,126 @@ def folder(parent, folder_name):
         parent = "/"+parent.replace("root/","")+"/"
     
     current_directory = folder_name
-    with open("metadata.json","r") as f:
-        metadata = json.load(f)
-    folders, files = get_separate_files_and_folders(metadata,parent,current_directory)
-    return render_template('directory.html', directory=parent+current_directory, folders=folders, files=files)
+    page = request.args.get('page', 0, type=int)
+    folders, files, pages = get_separate_files_and_folders(parent+current_directory, page)
+    return render_template('directory.html', directory=parent+current_directory, folders=folders, files=files, page=page, pages=pages)
 
-# Display file contents (command: cat)
+# Display file contents (command: cat), only the first FILE_PREVIEW_BYTES of a large file are fetched, as a range read
 @app.route('/file/<parent>/<file_name>', methods=['POST','GET'])
 def file(parent,file_name):
-    local_path = str(os.getcwd())+"/"+file_name
-    parent = parent.replace('-','/')
-    if parent=="root":
-        parent = "/"
-    else:
-        parent = "/"+parent.replace("root/","")+"/"
-    content = str(ui_client.execute_command("cat "+parent+file_name))
-    content = content.replace('\n', '<br>')
-    return render_template('display_file.html',path=parent+file_name,file_name=file_name, content=content,dic=local_path)
-
-# Upload a file (command: put)
+    parent = edfs_directory(parent)
+    preview = b""
+    file_size = 0
+    try:
+        with ui_client.open(parent+file_name, readahead=0) as f:
+            file_size = f.size
+            preview = f.read(FILE_PREVIEW_BYTES)
+    except IOError as e:
+        flash(str(e))
+    content = escape(preview.decode(errors="replace")).replace('\n', Markup('<br>'))
+    return render_template('display_file.html',path=parent+file_name,file_name=file_name, content=content,
+                           file_size=file_size, truncated=file_size > FILE_PREVIEW_BYTES, preview_bytes=FILE_PREVIEW_BYTES)
+
+# Upload files from a form (command: put)
+# each file is passed on block by block from the stream the form parser gives it,
+# held in memory when small and in an anonymous temporary file otherwise
 @app.route('/upload', methods=['POST'])
 def upload():
-    parent = request.form.get('path')
-    parent = parent.replace('-','/')
-    if parent=="root":
-        parent = "/"
-    else:
-        parent = "/"+parent.replace("root/","")+"/"
+    parent = edfs_directory(request.form.get('path'))
 
     files = request.files.getlist('file[]')
     for file in files:
-        edfs_path = parent+file.filename
-        file_content = file.read()
-
-        file_name = file.filename[:file.filename.rfind(".")]
-        file_ext = file.filename[file.filename.rfind(".")+1:]
-        temp_file = file_name+"_temp."+file_ext
-
-        with open(temp_file, 'wb') as f:
-            f.write(file_content)
-        ui_client.execute_command("put "+temp_file+" "+edfs_path)
-        os.remove(temp_file)
+        file_size = file.stream.seek(0, os.SEEK_END)
+        file.stream.seek(0)
+        if not ui_client.put_stream(file.stream, parent+file.filename, file_size):
+            flash(f"Couldn't upload {file.filename}")
 
     if parent=="/":
         return redirect(url_for("home"))
     parent = ("root/"+parent[1:-1]).replace("/","-")
     return redirect(url_for("folder", parent=parent[:parent.rfind("-")], folder_name=parent[parent.rfind("-")+1:]))
 
-    
+
+# Upload one file sent as the raw request body (command: put), streamed into the datanodes as it arrives
+@app.route('/upload/<parent>/<file_name>', methods=['PUT'])
+def upload_stream(parent, file_name):
+    if request.content_length is None:
+        abort(411)
+    if not ui_client.put_stream(request.stream, edfs_directory(parent)+file_name, request.content_length):
+        return jsonify({"status":"error", "message":f"Couldn't upload {file_name}"}), 500
+    return jsonify({"status":"success"})
+
 # Download a file (command: get)
+# the response is streamed as the blocks arrive from the datanodes, parallelism blocks at a time
 @app.route('/download',methods=['POST'])
 def download():
     edfs_path = request.form.get('parent').replace('-','/')
     file_name = request.form.get('file_name')
-    local_path = str(os.getcwd())+"/"+file_name
-    ui_client.execute_command("get "+edfs_path+" "+local_path)
-    parent = "root" if edfs_path[:edfs_path.rfind("/")]=="" else ("root"+edfs_path[:edfs_path.rfind("/")]).replace("/","-")
-    
-    return redirect(url_for("file", parent=parent, file_name=file_name,dic=local_path))    
-
-# View file blocks
-@app.route('/blocks',methods=['POST'])
+    try:
+        file_size, chunks = ui_client.open_stream(edfs_path)
+    except IOError as e:
+        flash(str(e))
+        parent = "root" if edfs_path[:edfs_path.rfind("/")]=="" else ("root"+edfs_path[:edfs_path.rfind("/")]).replace("/","-")
+        return redirect(url_for("file", parent=parent, file_name=file_name))
+
+    # the length is sent up front so a download cut short by a failed block shows up as incomplete
+    response = Response((bytes(chunk) for chunk in chunks), mimetype='application/octet-stream')
+    response.headers['Content-Length'] = file_size
+    response.headers.set('Content-Disposition', 'attachment', filename=file_name)
+    return response
+
+# View file blocks, one page of replicas at a time, their contents are fetched from /block as they are opened
+@app.route('/blocks',methods=['POST','GET'])
 def blocks():
-    edfs_path = request.form.get('parent').replace('-','/')
-    file_name = request.form.get('file_name')
-    blocks_metadata = ui_client.get_blocks_metadata(edfs_path)
-    
-    content = "<hr>\n\n"
-    for b in blocks_metadata:
-        content = content + "Partition: " + str(b["partition"]) + "\nSize: " + str(b["num_bytes"]) + "\nDatanode: " + str(b["datanode"]) + "\nBlock ID: " + b["id"] + "\n\nBlock Content:\n\n"
-        content = content +ui_client.get_block_content(b["id"],b["datanode"])
-        content = content + "\n\n<hr>\n\n"
-    content = content.replace('\n', '<br>')
-    
-    return render_template('display_blocks.html',path=edfs_path,file_name=file_name, content=content)
+    parent = request.values.get('parent')
+    edfs_path = parent.replace('-','/')
+    file_name = request.values.get('file_name')
+    page = request.values.get('page', 0, type=int)
+    response = ui_client.get_blocks_metadata(edfs_path, page*BLOCKS_PAGE_SIZE, BLOCKS_PAGE_SIZE)
+    if response["status"]=="error":
+        flash(response["message"])
+        blocks_metadata, total = [], 0
+    else:
+        blocks_metadata, total = response["blocks"], response["total"]
+    pages = max((total + BLOCKS_PAGE_SIZE - 1) // BLOCKS_PAGE_SIZE, 1)
+
+    return render_template('display_blocks.html', path=edfs_path, parent=parent, file_name=file_name, blocks=blocks_metadata,
+                           total=total, page=page, pages=pages, preview_bytes=BLOCK_PREVIEW_BYTES)
+
+# Raw contents of one replica, honours Range requests so the viewer can load a large block piece by piece
+@app.route('/block/<int:datanode>/<uuid:block_id>', methods=['GET'])
+def block(datanode, block_id):
+    key = (datanode, str(block_id))
+    data = block_cache.get(key)
+    if data is None:
+        try:
+            data = bytes(ui_client.get_block(key[1], datanode))
+        except IOError as e:
+            abort(404, str(e))
+        block_cache.put(key, data)
+    response = Response(data, mimetype='application/octet-stream')
+    response.cache_control.private = True
+    response.cache_control.max_age = 3600
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(data))
+
+
+# Latency, throughput and in-flight requests of the NameNode and every DataNode it knows, ?format=json for the raw metrics
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    nodes = []
+    try:
+        namenode = ui_client.metrics(ui_client.namenode)
+    except Exception as e:
+        abort(502, f"NameNode unreachable: {e}")
+    nodes.append(namenode)
+    for datanode in namenode.get("datanodes", []):
+        try:
+            nodes.append(ui_client.metrics(datanode["port"]))
+        except Exception as e:
+            nodes.append({"node":"DataNode", "port":datanode["port"], "status":"error", "message":str(e)})
+    if request.args.get('format') == 'json':
+        return jsonify(nodes=nodes, client=ui_client.cache_stats())
+    return render_template('metrics.html', nodes=nodes, client=ui_client.cache_stats())
 
 
 if __name__ == '__main__':
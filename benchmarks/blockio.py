@@ -0,0 +1,78 @@
+import argparse
+import os
+import random
+import time
+import uuid
+
+from cluster import LocalCluster
+from connpool import ConnectionPool
+
+DEFAULT_BLOCK_SIZES = [64 * 1024, 1024**2, 4 * 1024**2, 16 * 1024**2, 64 * 1024**2]
+RANGE_READ_BYTES = 64 * 1024
+RANGE_READS = 200
+TIMEOUT = 60
+
+def format_size(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:g}{unit}"
+        n /= 1024
+
+# write count blocks of block_size to one datanode, returns (block ids, seconds)
+def write_blocks(pool, address, block_size, count):
+    data = memoryview(os.urandom(block_size))
+    ids = [str(uuid.uuid4()) for _ in range(count)]
+    start = time.perf_counter()
+    for block_id in ids:
+        writer = pool.submit_stream(address, {"command":"write_block", "block_id":block_id, "pipeline":[]}, block_size)
+        for offset in range(0, block_size, 1024**2):
+            writer.write(data[offset:offset + 1024**2])
+        response = writer.finish().result(TIMEOUT)
+        assert response["status"] == "success", response["message"]
+    return ids, time.perf_counter() - start
+
+def read_blocks(pool, address, ids, block_size):
+    start = time.perf_counter()
+    for block_id in ids:
+        response = pool.request(address, {"command":"get", "block_id":block_id}, TIMEOUT)
+        assert response["status"] == "success" and len(response["block"]) == block_size, response.get("message")
+    return time.perf_counter() - start
+
+# RANGE_READS reads of RANGE_READ_BYTES at random offsets, returns seconds per read
+def range_reads(pool, address, ids, block_size):
+    length = min(RANGE_READ_BYTES, block_size)
+    start = time.perf_counter()
+    for _ in range(RANGE_READS):
+        offset = random.randrange(block_size - length + 1)
+        response = pool.request(address, {"command":"get", "block_id":random.choice(ids), "offset":offset, "length":length}, TIMEOUT)
+        assert response["status"] == "success" and len(response["block"]) == length, response.get("message")
+    return (time.perf_counter() - start) / RANGE_READS
+
+# on a fresh datanode: write the blocks, read them once so they are verified, then time a second full read and range reads
+def measure(datanode_args, block_size, total):
+    count = max(total // block_size, 1)
+    with LocalCluster(datanode_ports=(9202,), namenode_args=["--replication", "1"], datanode_args=datanode_args) as cluster:
+        pool = ConnectionPool()
+        address = ("localhost", cluster.datanode_ports[0])
+        ids, write_secs = write_blocks(pool, address, block_size, count)
+        read_blocks(pool, address, ids, block_size)
+        read_secs = read_blocks(pool, address, ids, block_size)
+        range_secs = range_reads(pool, address, ids, block_size)
+        pool.close()
+    return count * block_size / write_secs, count * block_size / read_secs, range_secs
+
+def main():
+    parser = argparse.ArgumentParser(description="DataNode block write and read throughput, reads through user space against sendfile")
+    parser.add_argument("--total-mb", type=int, default=256, help="bytes of blocks written at each block size")
+    parser.add_argument("--block-sizes", type=int, nargs="+", default=DEFAULT_BLOCK_SIZES)
+    args = parser.parse_args()
+
+    print(f"{'block':>6} {'write MB/s':>11} {'copy get MB/s':>14} {'sendfile get MB/s':>18} {'copy 64K range us':>18} {'sendfile 64K range us':>22}")
+    for block_size in args.block_sizes:
+        write, copy_read, copy_range = measure(["--no-sendfile"], block_size, args.total_mb * 1024**2)
+        _, sendfile_read, sendfile_range = measure([], block_size, args.total_mb * 1024**2)
+        print(f"{format_size(block_size):>6} {write / 1e6:>11.0f} {copy_read / 1e6:>14.0f} {sendfile_read / 1e6:>18.0f} "
+              f"{copy_range * 1e6:>18.0f} {sendfile_range * 1e6:>22.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+
+from cluster import LocalCluster
+import client
+
+DEFAULT_BLOCK_SIZES = [4 * 1024, 64 * 1024, 1024**2, 4 * 1024**2, 16 * 1024**2, 64 * 1024**2, 128 * 1024**2]
+
+# resident bytes of a process, from /proc so only on Linux
+def rss(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def format_size(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:g}{unit}"
+        n /= 1024
+
+# put and get one file on a fresh cluster whose namenode defaults to block_size
+# returns (put seconds, get seconds, namenode bytes grown by the put, replicas)
+def measure(block_size, src, dst):
+    with LocalCluster(namenode_args=["--block-size", str(block_size)]) as cluster:
+        namenode_pid = cluster.processes[0].pid
+        edfs = client.Client("localhost", 0, cluster.namenode_port)
+        before = rss(namenode_pid)
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            start = time.perf_counter()
+            assert edfs.put(src, "/sweep.bin"), f"put failed, see logs in {cluster.work_dir}"
+            put_secs = time.perf_counter() - start
+            start = time.perf_counter()
+            assert edfs.get("/sweep.bin", dst), f"get failed, see logs in {cluster.work_dir}"
+            get_secs = time.perf_counter() - start
+        grown = rss(namenode_pid) - before
+        replicas = edfs.get_blocks_metadata("/sweep.bin", 0, 1)["total"]
+        edfs.pool.close()
+    with open(src, "rb") as a, open(dst, "rb") as b:
+        assert a.read() == b.read(), "file read back differs from the one written"
+    return put_secs, get_secs, grown, replicas
+
+def main():
+    parser = argparse.ArgumentParser(description="put/get throughput and NameNode memory for one file at each block size")
+    parser.add_argument("--size-mb", type=float, default=64, help="size of the file written and read back")
+    parser.add_argument("--block-sizes", type=int, nargs="+", default=DEFAULT_BLOCK_SIZES, help="bytes per block, one fresh cluster each")
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    print(f"{'block size':>10} {'replicas':>9} {'put MB/s':>9} {'get MB/s':>9} {'NN MB':>7}")
+    with tempfile.TemporaryDirectory() as local_dir:
+        src = os.path.join(local_dir, "src.bin")
+        dst = os.path.join(local_dir, "dst.bin")
+        with open(src, "wb") as f:
+            f.write(os.urandom(size))
+        for block_size in args.block_sizes:
+            put_secs, get_secs, grown, replicas = measure(block_size, src, dst)
+            print(f"{format_size(block_size):>10} {replicas:>9} {size / put_secs / 1e6:>9.2f} {size / get_secs / 1e6:>9.2f} {grown / 1e6:>7.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+EMPTY_METADATA = {"file": {}, "dir": {"/": {"parent": 0, "children": []}}}
+
+# a namenode and datanodes running as subprocesses in a scratch directory
+class LocalCluster:
+    def __init__(self, namenode_port=9201, datanode_ports=(9202, 9203, 9204), namenode_args=(), datanode_args=()):
+        self.namenode_port = namenode_port
+        self.datanode_ports = list(datanode_ports)
+        self.namenode_args = list(namenode_args)
+        self.datanode_args = list(datanode_args)
+        self.work_dir = None
+        self.processes = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # start all nodes and wait until they accept connections
+    def start(self):
+        self.work_dir = tempfile.mkdtemp(prefix="edfs-bench-")
+        with open(os.path.join(self.work_dir, "metadata.json"), "w") as f:
+            json.dump(EMPTY_METADATA, f)
+        for port in self.datanode_ports:
+            os.mkdir(os.path.join(self.work_dir, str(port)))
+
+        namenode_cmd = ["namenode.py", "localhost", str(self.namenode_port)] + [str(p) for p in self.datanode_ports] + self.namenode_args
+        self.spawn(namenode_cmd, "namenode.log")
+        for port in self.datanode_ports:
+            self.spawn(["datanode.py", "localhost", str(port), str(self.namenode_port)] + self.datanode_args, f"datanode_{port}.log")
+
+        for port in [self.namenode_port] + self.datanode_ports:
+            self.wait_for_port(port)
+
+    def spawn(self, args, log_name):
+        log = open(os.path.join(self.work_dir, log_name), "w")
+        env = dict(os.environ, PYTHONPATH=REPO_DIR)
+        process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, args[0])] + args[1:], cwd=self.work_dir, stdout=log, stderr=subprocess.STDOUT, env=env)
+        self.processes.append(process)
+
+    def wait_for_port(self, port, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                with socket.create_connection(("localhost", port), timeout=0.5):
+                    return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError(f"Node on port {port} did not start, see logs in {self.work_dir}")
+
+    # stop all nodes and remove the scratch directory
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.processes = []
+        if self.work_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            self.work_dir = None
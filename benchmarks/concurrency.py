@@ -0,0 +1,82 @@
+import argparse
+import contextlib
+import os
+import random
+import tempfile
+import threading
+import time
+
+from cluster import LocalCluster
+import client
+
+# mixed workload: mostly directory listings, the rest split between uploads and downloads
+OP_WEIGHTS = {"ls": 0.5, "put": 0.25, "get": 0.25}
+FILE_SIZE = 1024
+
+def worker(worker_id, namenode_port, deadline, local_dir, seed_files, put_dir, counts, errors):
+    edfs = client.Client("localhost", 0, namenode_port)
+    rng = random.Random(worker_id)
+    src = os.path.join(local_dir, "src.txt")
+    dst = os.path.join(local_dir, f"out_{worker_id}.txt")
+    ops = list(OP_WEIGHTS)
+    weights = list(OP_WEIGHTS.values())
+    n = 0
+    while time.time() < deadline:
+        op = rng.choices(ops, weights)[0]
+        try:
+            if op == "ls":
+                ok = edfs.ls("/")
+            elif op == "put":
+                n += 1
+                ok = edfs.put(src, f"{put_dir}/w{worker_id}_{n}.txt")
+            else:
+                ok = edfs.get(rng.choice(seed_files), dst) != 0
+            counts[op] += 1
+            if not ok:
+                errors[op] += 1
+        except Exception:
+            errors[op] += 1
+
+def run(clients, duration, namenode_port, seed_files, local_dir):
+    counts = {op: 0 for op in OP_WEIGHTS}
+    errors = {op: 0 for op in OP_WEIGHTS}
+    # each level uploads into its own directory so file names never collide between levels
+    put_dir = f"/clients{clients}"
+    client.Client("localhost", 0, namenode_port).mkdir(put_dir)
+    deadline = time.time() + duration
+    threads = [threading.Thread(target=worker, args=(i, namenode_port, deadline, local_dir, seed_files, put_dir, counts, errors)) for i in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    return counts, errors, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Mixed ls/put/get throughput at increasing client concurrency")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per concurrency level")
+    parser.add_argument("--workers", type=int, default=16, help="server worker threads")
+    args = parser.parse_args()
+
+    server_args = ["--workers", str(args.workers)]
+    results = []
+    with LocalCluster(namenode_args=server_args, datanode_args=server_args) as cluster, tempfile.TemporaryDirectory() as local_dir:
+        with open(os.path.join(local_dir, "src.txt"), "wb") as f:
+            f.write(os.urandom(FILE_SIZE // 2).hex().encode())
+        seed_files = [f"/seed_{i}.txt" for i in range(8)]
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            seeder = client.Client("localhost", 0, cluster.namenode_port)
+            for path in seed_files:
+                seeder.put(os.path.join(local_dir, "src.txt"), path)
+            for clients in args.clients:
+                results.append((clients,) + run(clients, args.duration, cluster.namenode_port, seed_files, local_dir))
+
+    print(f"{'clients':>8} {'ops/sec':>10} {'ls':>8} {'put':>8} {'get':>8} {'errors':>8}")
+    for clients, counts, errors, elapsed in results:
+        total = sum(counts.values())
+        print(f"{clients:>8} {total / elapsed:>10.1f} {counts['ls']:>8} {counts['put']:>8} {counts['get']:>8} {sum(errors.values()):>8}")
+
+if __name__ == "__main__":
+    main()
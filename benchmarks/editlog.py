@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from cluster import EMPTY_METADATA
+import namenode
+
+FILES_PER_DIR = 1000
+
+# fill the namespace directly, as if the files had been created earlier
+def populate(nn, n_files):
+    for d in range((n_files + FILES_PER_DIR - 1) // FILES_PER_DIR):
+        nn.apply_edit({"op":"mkdir", "path":f"/d{d}"})
+    for i in range(n_files):
+        blocks = [{"id":str(uuid.uuid4()), "partition":1, "datanode":port, "num_bytes":1024} for port in (9002, 9003)]
+        nn.apply_edit({"op":"add_file", "path":f"/d{i // FILES_PER_DIR}/f{i}.txt", "file":{"rf":2, "size":1024, "blocks":blocks}})
+
+# commit new files from several threads at once, the way concurrent clients would
+# the files are allocated beforehand, only their put_update commits are timed
+def run_mutations(nn, n_mutations, threads):
+    def worker(t):
+        for i in range(t, n_mutations, threads):
+            nn.process_command({"command":"put_update", "file_path":paths[i], "file_size":1024, "locations":locations[i], "block_sizes":{"0":1024}})
+    nn.process_command({"command":"mkdir", "path":"/new"})
+    paths = [f"/new/f{i}.txt" for i in range(n_mutations)]
+    locations = [nn.process_command({"command":"put", "file_path":path, "file_size":1024})["locations"] for path in paths]
+    syncs = nn.edit_log.syncs
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return n_mutations / (time.perf_counter() - start), n_mutations / max(nn.edit_log.syncs - syncs, 1)
+
+# the old save_metadata rewrote the whole namespace on every mutation
+def full_rewrite_rate(nn, samples):
+    start = time.perf_counter()
+    for _ in range(samples):
+        with open("metadata_rewrite.json", "w") as f:
+            f.write(nn.namespace.to_json(0))
+    return samples / (time.perf_counter() - start)
+
+def bench(n_files, n_mutations, threads, rewrite_samples):
+    work_dir = tempfile.mkdtemp(prefix="edfs-editlog-")
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        with open("metadata.json", "w") as f:
+            json.dump(EMPTY_METADATA, f)
+        nn = namenode.NameNode("localhost", 0, [9002, 9003, 9004], checkpoint_txns=float("inf"), checkpoint_period=float("inf"))
+        populate(nn, n_files)
+        rate, edits_per_sync = run_mutations(nn, n_mutations, threads)
+        start = time.perf_counter()
+        nn.checkpoint()
+        checkpoint_secs = time.perf_counter() - start
+        rewrite = full_rewrite_rate(nn, rewrite_samples)
+        return rate, edits_per_sync, checkpoint_secs, rewrite
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="NameNode mutations/sec with the edit log versus rewriting metadata.json")
+    parser.add_argument("--files", type=int, nargs="+", default=[10000, 100000, 1000000], help="namespace sizes")
+    parser.add_argument("--mutations", type=int, default=5000, help="mutations timed at each size")
+    parser.add_argument("--threads", type=int, default=8, help="threads committing mutations concurrently")
+    parser.add_argument("--rewrite-samples", type=int, default=3, help="full metadata rewrites timed at each size")
+    args = parser.parse_args()
+
+    print(f"{'files':>10} {'edit log mut/s':>15} {'edits/fsync':>12} {'checkpoint s':>13} {'full rewrite mut/s':>19}")
+    for n_files in args.files:
+        rate, edits_per_sync, checkpoint_secs, rewrite = bench(n_files, args.mutations, args.threads, args.rewrite_samples)
+        print(f"{n_files:>10} {rate:>15.0f} {edits_per_sync:>12.1f} {checkpoint_secs:>13.2f} {rewrite:>19.2f}")
+
+if __name__ == "__main__":
+    main()
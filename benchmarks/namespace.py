@@ -0,0 +1,78 @@
+import argparse
+import gc
+import multiprocessing
+import resource
+import sys
+import time
+import uuid
+
+import cluster  # noqa: F401, puts the repo on sys.path
+from namespace import Namespace
+
+FILES_PER_DIR = 1000
+DATANODES = (9002, 9003, 9004)
+
+def file_dict(n_blocks, rf):
+    blocks = [{"id":str(uuid.uuid4()), "partition":p + 1, "datanode":DATANODES[(p + r) % len(DATANODES)], "num_bytes":2048}
+              for p in range(n_blocks) for r in range(rf)]
+    return {"rf":rf, "size":2048 * n_blocks, "blocks":blocks}
+
+# the namenode's layout before the inode tree: a dict of file dicts and a dict of directory dicts keyed by full path
+def build_dicts(n_files, n_blocks, rf):
+    file_metadata = {}
+    directory_metadata = {"/": {"parent": 0, "children": []}}
+    for i in range(n_files):
+        d = f"/d{i // FILES_PER_DIR}"
+        if i % FILES_PER_DIR == 0:
+            directory_metadata["/"]["children"].append(d[1:])
+            directory_metadata[d] = {"parent": "/", "children": []}
+        file_metadata[f"{d}/f{i}.txt"] = file_dict(n_blocks, rf)
+        directory_metadata[d]["children"].append(f"f{i}.txt")
+    return file_metadata, directory_metadata
+
+def build_tree(n_files, n_blocks, rf):
+    namespace = Namespace()
+    for i in range(n_files):
+        d = f"/d{i // FILES_PER_DIR}"
+        if i % FILES_PER_DIR == 0:
+            namespace.mkdir(d)
+        namespace.add_file(f"{d}/f{i}.txt", file_dict(n_blocks, rf))
+    return namespace
+
+LAYOUTS = {"dicts": build_dicts, "inode tree": build_tree}
+
+# peak resident bytes of the process
+def max_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+# bytes taken by one namespace, measured in a fresh process so layouts don't share memory
+def measure(layout, n_files, n_blocks, rf):
+    gc.collect()
+    before = max_rss()
+    start = time.perf_counter()
+    namespace = LAYOUTS[layout](n_files, n_blocks, rf)
+    elapsed = time.perf_counter() - start
+    size = max_rss() - before
+    del namespace
+    return size, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="NameNode namespace memory, dict layout against the inode tree")
+    parser.add_argument("--files", type=int, default=1000000)
+    parser.add_argument("--blocks-per-file", type=int, default=2, help="blocks of the larger files, the per block cost is the difference to one block files")
+    parser.add_argument("--rf", type=int, default=2)
+    args = parser.parse_args()
+    assert args.blocks_per_file > 1, "--blocks-per-file must be at least 2"
+
+    print(f"{'layout':>11} {'bytes/file':>11} {'bytes/block':>12} {'MB at 1 block':>14} {'MB at ' + str(args.blocks_per_file) + ' blocks':>15} {'build s':>8}")
+    with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        for layout in LAYOUTS:
+            one, secs = pool.apply(measure, (layout, args.files, 1, args.rf))
+            many, _ = pool.apply(measure, (layout, args.files, args.blocks_per_file, args.rf))
+            per_block = (many - one) / (args.files * (args.blocks_per_file - 1))
+            per_file = one / args.files - per_block
+            print(f"{layout:>11} {per_file:>11.0f} {per_block:>12.0f} {one / 1e6:>14.0f} {many / 1e6:>15.0f} {secs:>8.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import collections
+import random
+import statistics
+import time
+
+import cluster  # noqa: F401, puts the repo on sys.path
+from placement import NodeStats, POLICIES
+
+BLOCK_SIZE = 2048
+
+# block sizes of a mix of files, most blocks are full and every file ends in a partial block
+def block_sizes(rng, n_blocks, max_file_blocks):
+    while n_blocks > 0:
+        n = min(rng.randint(1, max_file_blocks), n_blocks)
+        n_blocks -= n
+        for _ in range(n - 1):
+            yield BLOCK_SIZE
+        yield rng.randint(1, BLOCK_SIZE)
+
+# allocate n_blocks through a policy with up to window writes in flight, the way the namenode sees concurrent puts
+def simulate(policy_name, args):
+    rng = random.Random(args.seed)
+    nodes = []
+    for i in range(args.nodes):
+        capacity = args.capacities[i % len(args.capacities)] if args.capacities else args.capacity
+        nodes.append(NodeStats(9002 + i, f"rack{i % args.racks}", capacity))
+    policy = POLICIES[policy_name](nodes, random.Random(args.seed))
+
+    in_flight = collections.deque()
+    single_rack = 0
+    failed = 0
+    start = time.perf_counter()
+    for size in block_sizes(rng, args.blocks, args.max_file_blocks):
+        try:
+            ports = policy.place(args.rf, size)
+        except ValueError:
+            failed += 1
+            continue
+        policy.reserve(ports, size)
+        in_flight.append((ports, size))
+        if args.racks > 1 and args.rf > 1 and len({policy.nodes[p].rack for p in ports}) == 1:
+            single_rack += 1
+        if len(in_flight) > args.window:
+            ports, size = in_flight.popleft()
+            policy.release(ports, size)
+            for port in ports:
+                policy.add_used(port, size)
+    elapsed = time.perf_counter() - start
+
+    utilization = [node.utilization() for node in nodes]
+    mean = statistics.fmean(utilization)
+    return {
+        "policy": policy_name,
+        "max": max(utilization),
+        "mean": mean,
+        "cv": statistics.pstdev(utilization) / mean if mean else 0.0,
+        "single_rack": single_rack,
+        "failed": failed,
+        "allocs_per_sec": args.blocks / elapsed,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="simulated datanode usage skew of each block placement policy, no cluster is started")
+    parser.add_argument("--blocks", type=int, default=1000000, help="blocks allocated per policy")
+    parser.add_argument("--nodes", type=int, default=10)
+    parser.add_argument("--racks", type=int, default=2, help="nodes are spread over this many racks round robin")
+    parser.add_argument("--rf", type=int, default=2)
+    parser.add_argument("--capacity", type=int, default=4 * 1024**3, help="bytes per node")
+    parser.add_argument("--capacities", type=int, nargs="+", help="per node capacities, repeated across nodes, for a heterogeneous cluster")
+    parser.add_argument("--window", type=int, default=64, help="blocks allocated but not committed at any time")
+    parser.add_argument("--max-file-blocks", type=int, default=16)
+    parser.add_argument("--policies", nargs="+", choices=sorted(POLICIES), default=sorted(POLICIES))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'policy':>13} {'max util':>9} {'mean util':>10} {'cv':>7} {'1-rack':>8} {'failed':>7} {'allocs/s':>10}")
+    for name in args.policies:
+        r = simulate(name, args)
+        print(f"{r['policy']:>13} {r['max']:>9.4%} {r['mean']:>10.4%} {r['cv']:>7.4f} {r['single_rack']:>8} {r['failed']:>7} {r['allocs_per_sec']:>10.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+
+from cluster import LocalCluster
+import client
+
+def main():
+    parser = argparse.ArgumentParser(description="get throughput by read parallelism, 1 is the single-stream baseline")
+    parser.add_argument("--size-mb", type=float, default=4, help="size of the file read back")
+    parser.add_argument("--parallelism", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--repeat", type=int, default=3, help="reads per parallelism setting, the best is reported")
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    results = []
+    with LocalCluster() as cluster, tempfile.TemporaryDirectory() as local_dir:
+        src = os.path.join(local_dir, "src.bin")
+        dst = os.path.join(local_dir, "dst.bin")
+        with open(src, "wb") as f:
+            f.write(os.urandom(size))
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            client.Client("localhost", 0, cluster.namenode_port).put(src, "/read.bin")
+            for parallelism in args.parallelism:
+                edfs = client.Client("localhost", 0, cluster.namenode_port, parallelism=parallelism)
+                best = float("inf")
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    edfs.get("/read.bin", dst)
+                    best = min(best, time.perf_counter() - start)
+                results.append((parallelism, best))
+                edfs.pool.close()
+        with open(src, "rb") as a, open(dst, "rb") as b:
+            assert a.read() == b.read(), "file read back differs from the one written"
+
+    baseline = results[0][1]
+    print(f"{'parallelism':>12} {'seconds':>9} {'MB/s':>8} {'speedup':>8}")
+    for parallelism, secs in results:
+        print(f"{parallelism:>12} {secs:>9.3f} {size / secs / 1e6:>8.2f} {baseline / secs:>8.2f}")
+
+if __name__ == "__main__":
+    main()
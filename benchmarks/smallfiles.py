@@ -0,0 +1,71 @@
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+
+from cluster import LocalCluster
+import client
+
+# one put, listing and rm round trip per file, the way a client without batched ops has to go about it
+def one_by_one(edfs, local_dir, names, dst):
+    edfs.mkdir(dst)
+    start = time.perf_counter()
+    for name in names:
+        assert edfs.put(os.path.join(local_dir, name), f"{dst}/{name}"), f"put of {name} failed"
+    put_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    listed = edfs.send_to_namenode({"command":"ls", "path":dst})["list"]
+    for name in listed:
+        edfs.send_to_namenode({"command":"stat", "paths":[f"{dst}/{name}"]})
+    ls_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for name in names:
+        assert edfs.rm(f"{dst}/{name}"), f"rm of {name} failed"
+    edfs.rmdir(dst)
+    rm_secs = time.perf_counter() - start
+    return put_secs, ls_secs, rm_secs
+
+# put -r, ls -R and rm -r
+def batched(edfs, local_dir, names, dst):
+    start = time.perf_counter()
+    assert edfs.put_recursive(local_dir, dst), "put -r failed"
+    put_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    assert edfs.ls_recursive(dst), "ls -R failed"
+    ls_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    assert edfs.rm_recursive(dst), "rm -r failed"
+    rm_secs = time.perf_counter() - start
+    return put_secs, ls_secs, rm_secs
+
+MODES = {"one by one": one_by_one, "batched": batched}
+
+def main():
+    parser = argparse.ArgumentParser(description="many-small-file put/list/rm throughput, one request per file against the batched ops")
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--file-size", type=int, default=1024, help="bytes per file")
+    args = parser.parse_args()
+
+    results = []
+    with LocalCluster() as cluster, tempfile.TemporaryDirectory() as local_dir:
+        names = [f"f{i}.txt" for i in range(args.files)]
+        for name in names:
+            with open(os.path.join(local_dir, name), "wb") as f:
+                f.write(os.urandom(args.file_size))
+        edfs = client.Client("localhost", 0, cluster.namenode_port)
+        for i, (mode, run) in enumerate(MODES.items()):
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                results.append((mode, run(edfs, local_dir, names, f"/small{i}")))
+        edfs.pool.close()
+
+    print(f"{'mode':>11} {'put files/s':>12} {'list files/s':>13} {'rm files/s':>11}")
+    for mode, (put_secs, ls_secs, rm_secs) in results:
+        print(f"{mode:>11} {args.files / put_secs:>12.0f} {args.files / ls_secs:>13.0f} {args.files / rm_secs:>11.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+from storage import ENGINES, PACK_LIMIT
+
+DEFAULT_BLOCK_SIZES = [2 * 1024, 16 * 1024, 64 * 1024]
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+def format_us(seconds):
+    return f"{seconds * 1e6:.0f}"
+
+# write blocks through a fresh engine, then read them back in another order
+# returns (write latencies, read latencies, seconds to reopen the engine, files and directories it left on disk)
+def measure(engine, blocks, block_size, root):
+    store = ENGINES[engine](root)
+    data = os.urandom(block_size)
+    ids = [str(uuid.uuid4()) for _ in range(blocks)]
+    writes = []
+    for block_id in ids:
+        start = time.perf_counter()
+        writer = store.create(block_id, block_size)
+        writer.write(data)
+        writer.commit()
+        writes.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    store = ENGINES[engine](root)
+    reopen_secs = time.perf_counter() - start
+
+    reads = []
+    view = memoryview(bytearray(block_size))
+    for block_id in sorted(ids):
+        start = time.perf_counter()
+        with store.open(block_id) as f:
+            reader = f.checksum_reader()
+            n = f.readinto(view)
+            reader.verify(view[:n], 0, f.length)
+        reads.append(time.perf_counter() - start)
+    inodes = sum(len(dirs) + len(files) for _, dirs, files in os.walk(root))
+    return writes, reads, reopen_secs, inodes
+
+def main():
+    parser = argparse.ArgumentParser(description="per-block write and read latency of each DataNode storage engine")
+    parser.add_argument("--blocks", type=int, default=20000)
+    parser.add_argument("--block-sizes", type=int, nargs="+", default=DEFAULT_BLOCK_SIZES, help=f"bytes per block, packing covers up to {PACK_LIMIT}")
+    parser.add_argument("--dir", help="directory to put the block stores in, a temporary one by default")
+    args = parser.parse_args()
+
+    print(f"{'engine':>8} {'block':>6} {'write p50 us':>13} {'write p99 us':>13} {'read p50 us':>12} {'read p99 us':>12} {'reopen s':>9} {'inodes':>7}")
+    for block_size in args.block_sizes:
+        for engine in ENGINES:
+            root = tempfile.mkdtemp(prefix="edfs-storage-", dir=args.dir)
+            try:
+                writes, reads, reopen_secs, inodes = measure(engine, args.blocks, block_size, root)
+            finally:
+                shutil.rmtree(root, ignore_errors=True)
+            print(f"{engine:>8} {block_size // 1024:>5}K {format_us(percentile(writes, 0.5)):>13} {format_us(percentile(writes, 0.99)):>13} "
+                  f"{format_us(percentile(reads, 0.5)):>12} {format_us(percentile(reads, 0.99)):>12} {reopen_secs:>9.2f} {inodes:>7}")
+
+if __name__ == "__main__":
+    main()
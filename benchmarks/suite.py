@@ -0,0 +1,255 @@
+import argparse
+import bisect
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from cluster import LocalCluster, REPO_DIR
+from connpool import ConnectionPool
+import client
+
+# runs workloads against a local cluster and prints throughput and latency percentiles per operation as json, e.g.
+#   python3 benchmarks/suite.py --workloads metadata random --clients 8 --duration 10 --out before.json
+# so a change can be compared against the numbers from before it
+
+WORKLOADS = ("metadata", "sequential", "random", "mixed")
+PERCENTILES = {"p50_ms": 0.50, "p99_ms": 0.99, "p999_ms": 0.999}
+
+# latencies and failures of one kind of operation, filled by a single worker thread
+class OpStats:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+
+    # time one call of fn, which returns a false value on failure, counting nbytes moved if it succeeds
+    def measure(self, fn, nbytes=0):
+        start = time.perf_counter()
+        try:
+            ok = fn()
+        except Exception:
+            ok = False
+        self.latencies.append(time.perf_counter() - start)
+        if ok:
+            self.bytes += nbytes
+        else:
+            self.errors += 1
+        return ok
+
+    def merge(self, other):
+        self.latencies += other.latencies
+        self.errors += other.errors
+        self.bytes += other.bytes
+
+    def summary(self, elapsed):
+        latencies = sorted(self.latencies)
+        result = {"count":len(latencies), "errors":self.errors, "ops_per_sec":round(len(latencies) / elapsed, 1)}
+        if self.bytes:
+            result["mb_per_sec"] = round(self.bytes / elapsed / 1e6, 2)
+        for name, p in PERCENTILES.items():
+            result[name] = round(latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000, 3) if latencies else None
+        result["max_ms"] = round(latencies[-1] * 1000, 3) if latencies else None
+        return result
+
+# op name -> OpStats, created on first use
+class StatsByOp(dict):
+    def __missing__(self, op):
+        self[op] = OpStats()
+        return self[op]
+
+# draws indexes 0..n-1, index i with probability proportional to 1 / (i + 1) ** s
+class Zipf:
+    def __init__(self, n, s, rng):
+        self.rng = rng
+        self.cumulative = []
+        total = 0
+        for i in range(n):
+            total += 1 / (i + 1) ** s
+            self.cumulative.append(total)
+
+    def sample(self):
+        return bisect.bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1])
+
+# state shared by the workers of one workload
+class Workload:
+    def __init__(self, args, namenode_port):
+        self.args = args
+        self.namenode_port = namenode_port
+
+    def client(self):
+        return client.Client("localhost", 0, self.namenode_port, cache_bytes=self.args.client_cache_bytes, metadata_ttl=self.args.metadata_ttl)
+
+    # put size bytes of random data at path
+    def put_bytes(self, edfs, path, size, block_size=None):
+        return edfs.put_stream(io.BytesIO(os.urandom(size)), path, size, block_size=block_size)
+
+    def setup(self):
+        pass
+
+    # run one worker until deadline, recording into stats, a StatsByOp
+    def run(self, worker_id, deadline, stats):
+        raise NotImplementedError
+
+# small-file metadata storm: every worker puts, stats, lists and removes tiny files in its own directory
+class MetadataWorkload(Workload):
+    KEEP = 100      # files a worker's directory holds before the oldest are removed
+
+    def setup(self):
+        self.client().mkdir("/meta")
+
+    def run(self, worker_id, deadline, stats):
+        edfs = self.client()
+        directory = f"/meta/w{worker_id}"
+        stats["mkdir"].measure(lambda: edfs.mkdir(directory))
+        n = 0
+        while time.time() < deadline:
+            path = f"{directory}/f{n}.txt"
+            stats["put"].measure(lambda: self.put_bytes(edfs, path, self.args.small_size), self.args.small_size)
+            stats["stat"].measure(lambda: edfs.stat([path]))
+            stats["ls"].measure(lambda: edfs.listing(directory, 0, self.KEEP)["status"] == "success")
+            if n >= self.KEEP:
+                stats["rm"].measure(lambda: edfs.rm(f"{directory}/f{n - self.KEEP}.txt"))
+            n += 1
+
+# large sequential transfers: every worker puts a big file and reads it back, over and over
+class SequentialWorkload(Workload):
+    def run(self, worker_id, deadline, stats):
+        edfs = self.client()
+        size = self.args.large_mb * 1024 * 1024
+        n = 0
+        while n == 0 or time.time() < deadline:
+            path = f"/large_w{worker_id}_{n}.bin"
+            if stats["put"].measure(lambda: self.put_bytes(edfs, path, size), size):
+                stats["get"].measure(lambda: sum(len(data) for data in edfs.open_stream(path)[1]) == size, size)
+                edfs.rm(path)
+            n += 1
+
+# random reads straight from the datanodes, of whole blocks and of small ranges, with no client caching
+class RandomReadWorkload(Workload):
+    def setup(self):
+        edfs = self.client()
+        edfs.mkdir("/random")
+        size = self.args.random_file_mb * 1024 * 1024
+        self.blocks = []
+        for i in range(self.args.random_files):
+            path = f"/random/f{i}.bin"
+            assert self.put_bytes(edfs, path, size, self.args.random_block_size), f"put of {path} failed"
+            self.blocks += [(b["id"], b["datanode"], b["num_bytes"]) for b in edfs.get_blocks_metadata(path)["blocks"]]
+
+    def run(self, worker_id, deadline, stats):
+        pool = ConnectionPool()
+        rng = random.Random(worker_id)
+        read_size = self.args.read_size
+        def read(block_id, datanode, offset=0, length=None):
+            command = {"command":"get", "block_id":block_id}
+            if length is not None:
+                command.update(offset=offset, length=length)
+            response = pool.request(("localhost", datanode), command)
+            return response["status"] == "success"
+        while time.time() < deadline:
+            block_id, datanode, num_bytes = rng.choice(self.blocks)
+            stats["read_block"].measure(lambda: read(block_id, datanode), num_bytes)
+            block_id, datanode, num_bytes = rng.choice(self.blocks)
+            offset = rng.randrange(max(num_bytes - read_size, 0) + 1)
+            stats["read_range"].measure(lambda: read(block_id, datanode, offset, read_size), min(read_size, num_bytes))
+        pool.close()
+
+# reads of files picked with a zipf distribution, so a few are hot, mixed with writes of new files
+class MixedWorkload(Workload):
+    def setup(self):
+        edfs = self.client()
+        edfs.mkdir("/mixed")
+        for i in range(self.args.mixed_files):
+            assert self.put_bytes(edfs, f"/mixed/f{i}.bin", self.args.mixed_size), f"put of /mixed/f{i}.bin failed"
+
+    def run(self, worker_id, deadline, stats):
+        edfs = self.client()
+        rng = random.Random(worker_id)
+        zipf = Zipf(self.args.mixed_files, self.args.zipf_s, rng)
+        size = self.args.mixed_size
+        n = 0
+        while time.time() < deadline:
+            if rng.random() < self.args.read_fraction:
+                path = f"/mixed/f{zipf.sample()}.bin"
+                stats["read"].measure(lambda: sum(len(data) for data in edfs.open_stream(path)[1]) == size, size)
+            else:
+                path = f"/mixed/new_w{worker_id}_{n}.bin"
+                stats["write"].measure(lambda: self.put_bytes(edfs, path, size), size)
+                n += 1
+
+WORKLOAD_CLASSES = {"metadata": MetadataWorkload, "sequential": SequentialWorkload, "random": RandomReadWorkload, "mixed": MixedWorkload}
+
+# set up a workload, run it on clients threads for duration seconds, returns its per-op summaries
+def run_workload(name, args, namenode_port):
+    workload = WORKLOAD_CLASSES[name](args, namenode_port)
+    workload.setup()
+    per_worker = [StatsByOp() for _ in range(args.clients)]
+    deadline = time.time() + args.duration
+    threads = [threading.Thread(target=workload.run, args=(i, deadline, per_worker[i])) for i in range(args.clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    merged = StatsByOp()
+    for stats in per_worker:
+        for op, op_stats in stats.items():
+            merged[op].merge(op_stats)
+    return {"seconds":round(elapsed, 2), "ops":{op: op_stats.summary(elapsed) for op, op_stats in merged.items()}}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="load generator and benchmark suite, prints per-op throughput and latency percentiles as json")
+    parser.add_argument("--workloads", nargs="+", choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument("--datanodes", type=int, default=3)
+    parser.add_argument("--clients", type=int, default=4, help="concurrent client threads per workload")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per workload")
+    parser.add_argument("--namenode-args", default="", help="extra namenode arguments, as one string")
+    parser.add_argument("--datanode-args", default="", help="extra datanode arguments, as one string")
+    parser.add_argument("--client-cache-bytes", type=int, default=0, help="client block cache, off by default so reads reach the datanodes")
+    parser.add_argument("--metadata-ttl", type=float, default=0, help="client metadata cache ttl, off by default")
+    parser.add_argument("--small-size", type=int, default=1024, help="bytes per file of the metadata workload")
+    parser.add_argument("--large-mb", type=int, default=64, help="file size of the sequential workload")
+    parser.add_argument("--random-files", type=int, default=8)
+    parser.add_argument("--random-file-mb", type=int, default=16)
+    parser.add_argument("--random-block-size", type=int, default=1024 * 1024)
+    parser.add_argument("--read-size", type=int, default=4096, help="bytes per range read of the random workload")
+    parser.add_argument("--mixed-files", type=int, default=200)
+    parser.add_argument("--mixed-size", type=int, default=64 * 1024)
+    parser.add_argument("--zipf-s", type=float, default=1.1, help="zipf exponent of the mixed workload's reads, higher is more skewed")
+    parser.add_argument("--read-fraction", type=float, default=0.9, help="share of the mixed workload's ops that are reads")
+    parser.add_argument("--out", help="also write the results to this file")
+    args = parser.parse_args()
+
+    datanode_ports = range(9202, 9202 + args.datanodes)
+    namenode_args = args.namenode_args.split()
+    if args.datanodes < 2 and "--replication" not in namenode_args:
+        namenode_args += ["--replication", "1"]
+    result = {"commit":git_commit(), "config":vars(args), "workloads":{}}
+    # each workload gets a fresh cluster so one doesn't slow the next with its leftovers
+    for name in args.workloads:
+        with LocalCluster(datanode_ports=datanode_ports, namenode_args=namenode_args, datanode_args=args.datanode_args.split()) as cluster:
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                result["workloads"][name] = run_workload(name, args, cluster.namenode_port)
+        print(f"{name} done", file=sys.stderr)
+
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import os
+import threading
+from collections import OrderedDict
+
+# thread safe least recently used cache bounded by the total size of its values
+# sizeof gives the size of a value, by default every value counts as 1 so max_size is an entry count
+# on_evict(key, value) is called for every entry pushed out to make room, outside the lock
+class LRUCache:
+    def __init__(self, max_size, sizeof=None, on_evict=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.entries.get(key, self)
+            if value is self:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        evicted = []
+        with self.lock:
+            old = self.entries.pop(key, self)
+            if old is not self:
+                self.size -= self.sizeof(old)
+            # a value bigger than the whole cache isn't kept
+            if size > self.max_size:
+                evicted.append((key, value))
+            else:
+                self.entries[key] = value
+                self.size += size
+                while self.size > self.max_size:
+                    evicted.append(self.entries.popitem(last=False))
+                    self.size -= self.sizeof(evicted[-1][1])
+        if self.on_evict is not None:
+            for item in evicted:
+                self.on_evict(*item)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            value = self.entries.pop(key, self)
+            if value is self:
+                return default
+            self.size -= self.sizeof(value)
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# blocks by id, up to max_bytes of them in memory, blocks evicted from memory spill to files in spill_dir up to spill_bytes
+# block ids are never reused, so a cached block can't go stale, it only gets evicted
+# spilled blocks left by an earlier process are picked up again
+class BlockCache:
+    def __init__(self, max_bytes, spill_dir=None, spill_bytes=0):
+        self.spill_dir = spill_dir if spill_dir and spill_bytes else None
+        self.memory = LRUCache(max_bytes, sizeof=len, on_evict=self.spill if self.spill_dir else None)
+        self.disk = LRUCache(spill_bytes, sizeof=lambda size: size, on_evict=self.unlink)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            for entry in os.scandir(self.spill_dir):
+                if entry.is_file():
+                    self.disk.put(entry.name, entry.stat().st_size)
+
+    # the cached copy of any of block_ids, which are replicas of the same data, None if there is none
+    def get(self, *block_ids):
+        for block_id in block_ids:
+            data, spilled = self.lookup(block_id)
+            if data is not None:
+                with self.lock:
+                    if spilled:
+                        self.spill_hits += 1
+                    else:
+                        self.hits += 1
+                return data
+        with self.lock:
+            self.misses += 1
+        return None
+
+    # (data, whether it came from a spill file), (None, False) if block_id isn't cached
+    def lookup(self, block_id):
+        data = self.memory.entries.get(block_id)
+        if data is not None:
+            return self.memory.get(block_id), False
+        if self.spill_dir is None or self.disk.pop(block_id) is None:
+            return None, False
+        # back into memory, the file is removed so the block is only held once
+        try:
+            with open(os.path.join(self.spill_dir, block_id), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None, False
+        self.unlink(block_id)
+        self.memory.put(block_id, data)
+        return data, True
+
+    def put(self, block_id, data):
+        self.memory.put(block_id, data)
+
+    def spill(self, block_id, data):
+        if len(data) > self.disk.max_size:
+            return
+        try:
+            with open(os.path.join(self.spill_dir, block_id), "wb") as f:
+                f.write(data)
+        except OSError:
+            return
+        self.disk.put(block_id, len(data))
+
+    def unlink(self, block_id, size=None):
+        try:
+            os.remove(os.path.join(self.spill_dir, block_id))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        self.memory.clear()
+        for block_id in list(self.disk.entries):
+            self.disk.pop(block_id)
+            self.unlink(block_id)
+
+    # hit and miss counts and bytes held, for reporting
+    def stats(self):
+        with self.lock:
+            return {"hits":self.hits, "spill_hits":self.spill_hits, "misses":self.misses,
+                    "memory_bytes":self.memory.size, "memory_blocks":len(self.memory), "spill_bytes":self.disk.size, "spill_blocks":len(self.disk)}
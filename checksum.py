@@ -0,0 +1,96 @@
+import struct
+import zlib
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+# every block file has a sidecar <block id>.meta holding a checksum for each BYTES_PER_CHECKSUM bytes of the block
+# the sidecar starts with a header: magic, version, algorithm, bytes per checksum, then one big-endian uint32 per chunk
+META_SUFFIX = ".meta"
+META_MAGIC = b"EDCK"
+META_VERSION = 1
+META_HEADER = struct.Struct("!4sBBI")
+BYTES_PER_CHECKSUM = 512
+
+# algorithm id -> running checksum function f(data, value), crc32c is used when the crc32c package is installed
+ALGORITHMS = {1: zlib.crc32}
+if crc32c is not None:
+    ALGORITHMS[2] = crc32c.crc32c
+DEFAULT_ALGORITHM = max(ALGORITHMS)
+
+
+class ChecksumError(IOError):
+    pass
+
+
+def meta_path(block_path):
+    return block_path + META_SUFFIX
+
+
+# checksums of data arriving in pieces of any size
+class ChecksumWriter:
+    def __init__(self, algorithm=DEFAULT_ALGORITHM, bytes_per_checksum=BYTES_PER_CHECKSUM):
+        self.algorithm = algorithm
+        self.func = ALGORITHMS[algorithm]
+        self.bytes_per_checksum = bytes_per_checksum
+        self.sums = []
+        self.value = 0
+        self.filled = 0     # bytes of the current chunk seen so far
+
+    def update(self, data):
+        data = memoryview(data)
+        while len(data):
+            take = min(self.bytes_per_checksum - self.filled, len(data))
+            self.value = self.func(data[:take], self.value)
+            self.filled += take
+            data = data[take:]
+            if self.filled == self.bytes_per_checksum:
+                self.sums.append(self.value)
+                self.value = 0
+                self.filled = 0
+
+    # the sidecar contents, covering a final partial chunk
+    def finish(self):
+        if self.filled:
+            self.sums.append(self.value)
+            self.value = 0
+            self.filled = 0
+        return META_HEADER.pack(META_MAGIC, META_VERSION, self.algorithm, self.bytes_per_checksum) + struct.pack(f"!{len(self.sums)}I", *self.sums)
+
+    def write(self, block_path):
+        with open(meta_path(block_path), "wb") as f:
+            f.write(self.finish())
+
+
+# checksums of a stored block, checked against its data chunk by chunk as it is read
+class ChecksumReader:
+    def __init__(self, meta):
+        magic, version, algorithm, self.bytes_per_checksum = META_HEADER.unpack_from(meta)
+        if magic != META_MAGIC or version != META_VERSION or algorithm not in ALGORITHMS:
+            raise ChecksumError("Unreadable block checksum file")
+        self.func = ALGORITHMS[algorithm]
+        n = (len(meta) - META_HEADER.size) // 4
+        self.sums = struct.unpack_from(f"!{n}I", meta, META_HEADER.size)
+
+    # the reader for a block file, None if it was stored without checksums
+    @classmethod
+    def open(cls, block_path):
+        try:
+            with open(meta_path(block_path), "rb") as f:
+                return cls(f.read())
+        except FileNotFoundError:
+            return None
+
+    # check data read from offset in the block, offset is a multiple of bytes_per_checksum
+    # and data runs to a chunk boundary or the end of the block
+    def verify(self, data, offset, block_length):
+        data = memoryview(data)
+        chunk = offset // self.bytes_per_checksum
+        if (block_length + self.bytes_per_checksum - 1) // self.bytes_per_checksum != len(self.sums):
+            raise ChecksumError(f"Block is {block_length} bytes but has checksums for {len(self.sums)} chunks")
+        for start in range(0, len(data), self.bytes_per_checksum):
+            if self.func(data[start:start + self.bytes_per_checksum], 0) != self.sums[chunk]:
+                raise ChecksumError(f"Checksum mismatch at byte {offset + start}")
+            chunk += 1
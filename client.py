@@ -1,15 +1,79 @@
-import base64
+import argparse
+import bisect
+import codecs
+import collections
+import io
 import json
 import os
-import shutil
-import socket
 import sys
+import time
+import uuid
+from concurrent.futures import wait, FIRST_COMPLETED
+from cache import BlockCache, LRUCache
+from connpool import ConnectionPool
+from protocol import CODEC_VERSIONS, set_codec
+
+DEFAULT_PARALLELISM = 8     # blocks fetched at once by get and cat
+DEFAULT_READ_TIMEOUT = 10   # seconds to wait on a replica before trying the next one
+PUT_OPTIONS = ("--rf", "--block-size")
+PUT_BATCH_FILES = 1000                      # files allocated and committed per namenode request by put -r
+PUT_BATCH_BYTES = 64 * 1024 * 1024          # block bytes put -r keeps in flight to the datanodes
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024      # block bytes kept in memory for repeated reads
+DEFAULT_METADATA_TTL = 10                   # seconds a file's block locations are reused without asking the namenode
+METADATA_CACHE_SIZE = 10000                 # files whose block locations are kept
+DEFAULT_READAHEAD = 1024 * 1024             # bytes an EDFSFile fetches past a read, at first
+MAX_READAHEAD = 32 * 1024 * 1024            # bytes its readahead grows to while it is read sequentially
+
+# returned by a shell command whose arguments don't fit it
+INVALID_USE = object()
+
+# "--name value" pairs of a command with integer values, None if there is an unknown name or a value isn't a number
+def parse_options(args, names):
+    if len(args) % 2:
+        return None
+    options = dict(zip(args[::2], args[1::2]))
+    if not all(name in names and value.isdigit() for name, value in options.items()):
+        return None
+    return {name: int(value) for name, value in options.items()}
+
+# fill view from a binary stream, returns the bytes read, fewer than len(view) only at the end of the stream
+def read_into(stream, view):
+    readinto = getattr(stream, "readinto", None)
+    n = 0
+    while n < len(view):
+        if readinto is not None:
+            k = readinto(view[n:])
+        else:
+            chunk = stream.read(len(view) - n)
+            k = len(chunk)
+            view[n:n + k] = chunk
+        if not k:
+            break
+        n += k
+    return n
 
 class Client:
-    def __init__(self, ip, port, namenode_port): 
+    def __init__(self, ip, port, namenode_port, parallelism=DEFAULT_PARALLELISM, read_timeout=DEFAULT_READ_TIMEOUT,
+                 cache_bytes=DEFAULT_CACHE_BYTES, cache_dir=None, cache_spill_bytes=0, metadata_ttl=DEFAULT_METADATA_TTL, local_datanodes=()):
         self.ip = ip
         self.port = port
         self.namenode = namenode_port
+        self.parallelism = parallelism
+        self.read_timeout = read_timeout
+        # persistent connections to the namenode and datanodes, reused across commands
+        self.pool = ConnectionPool()
+        # blocks read before, by replica id, in memory and optionally spilled to cache_dir
+        self.block_cache = BlockCache(cache_bytes, cache_dir, cache_spill_bytes)
+        # file path -> (time fetched, partitions, file size) from the namenode, reused for metadata_ttl seconds
+        # an entry that leads to replicas that can't be read is refetched, and this client's own writes drop theirs
+        self.metadata_cache = LRUCache(METADATA_CACHE_SIZE)
+        self.metadata_ttl = metadata_ttl
+        self.metadata_hits = 0
+        self.metadata_misses = 0
+        # datanodes on this machine, their replicas are read first
+        self.local_datanodes = set(local_datanodes)
+        # names this client to the namenode as the holder of its append leases
+        self.holder = f"{ip}:{port}/{uuid.uuid4().hex[:8]}"
 
     # get user input commands
     def run(self):
@@ -23,39 +87,90 @@ class Client:
             except Exception as e:
                 print(f"Error: {e}")
             
-    # execute user input commands
+    # execute user input commands, each command's arguments are checked and run by its entry in SHELL_COMMANDS
     def execute_command(self, command):
         cmd_parts = command.split()
+        if not cmd_parts:
+            return None
         cmd = cmd_parts[0]
-        if cmd == "ls":     
-            return self.ls(cmd_parts[1] if len(cmd_parts) > 1 else "/")
-        elif cmd == "rm" and len(cmd_parts)==2:   
-            return self.rm(cmd_parts[1])
-        elif cmd == "put" and len(cmd_parts)==3:  
-            return self.put(cmd_parts[1], cmd_parts[2])
-        elif cmd == "get" and len(cmd_parts)==3:
-            return self.get(cmd_parts[1], cmd_parts[2])
-        elif cmd == "mkdir" and len(cmd_parts)==2:    
-            return self.mkdir(cmd_parts[1])
-        elif cmd == "rmdir" and len(cmd_parts)==2:    
-            return self.rmdir(cmd_parts[1])
-        elif cmd == "cat" and len(cmd_parts)==2:
-            return self.cat(cmd_parts[1])
-        elif cmd == "blocks_metadata" and len(cmd_parts)==2:
-            return self.get_blocks_metadata(cmd_parts[1])
-        elif cmd == "block_content" and len(cmd_parts)==3:
-            return self.get_block_content(cmd_parts[1],int(cmd_parts[2]))
-        else:
+        handler = SHELL_COMMANDS.get(cmd)
+        result = handler(self, cmd_parts[1:]) if handler is not None else INVALID_USE
+        if result is INVALID_USE:
             print("Invalid command/Invalid use of command:", cmd)
+            return None
+        return result
+
+    # shell commands: each takes the arguments after the command's name and returns INVALID_USE if they don't fit it
+    def shell_ls(self, args):
+        if args[:1] == ["-R"]:
+            return self.ls_recursive(args[1] if len(args) > 1 else "/")
+        if args[:1] == ["-l"]:
+            return self.ls_long(args[1] if len(args) > 1 else "/")
+        return self.ls(args[0] if args else "/")
+
+    def shell_rm(self, args):
+        if len(args) == 1:
+            return self.rm(args[0])
+        if len(args) == 2 and args[0] == "-r":
+            return self.rm_recursive(args[1])
+        return INVALID_USE
+
+    def shell_stat(self, args):
+        return self.stat(args) if args else INVALID_USE
+
+    # put [-r] [--rf N] [--block-size N] <src> <dst>
+    def shell_put(self, args):
+        recursive = args[:1] == ["-r"]
+        if recursive:
+            args = args[1:]
+        options = parse_options(args[:-2], PUT_OPTIONS) if len(args) >= 2 else None
+        if options is None:
+            return INVALID_USE
+        put = self.put_recursive if recursive else self.put
+        return put(args[-2], args[-1], options.get("--rf"), options.get("--block-size"))
+
+    def shell_append(self, args):
+        return self.append(*args) if len(args) == 2 else INVALID_USE
+
+    def shell_get(self, args):
+        return self.get(*args) if len(args) == 2 else INVALID_USE
+
+    # read <path> <offset> <length>
+    def shell_read(self, args):
+        if len(args) != 3 or not args[1].isdigit() or not args[2].isdigit():
+            return INVALID_USE
+        try:
+            data = self.read(args[0], int(args[1]), int(args[2]))
+        except IOError as e:
+            print(e)
+            return 0
+        print(bytes(data).decode(errors="replace"))
+        return data
+
+    def shell_block_content(self, args):
+        if len(args) != 2:
+            return INVALID_USE
+        content = self.get_block_content(args[0], int(args[1]))
+        print(content)
+        return content
+
+    def shell_metrics(self, args):
+        if len(args) > 1 or not all(arg.isdigit() for arg in args):
+            return INVALID_USE
+        return self.print_metrics(int(args[0]) if args else self.namenode)
+
+    def shell_profile(self, args):
+        if len(args) != 2 or not args[0].isdigit() or args[1] not in ("start", "stop", "report"):
+            return INVALID_USE
+        return self.profile(int(args[0]), args[1])
+
+    def shell_cache(self, args):
+        return self.print_cache_stats() if not args else INVALID_USE
 
     # send commands to namenode over socket
     def send_to_namenode(self, command):
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect(("localhost",self.namenode))
-                s.sendall(json.dumps(command).encode())
-                response = s.recv(4096)
-                return json.loads(response)
+            return self.pool.request(("localhost",self.namenode), command)
         except Exception as e:
             print(f"Error sending command to NameNode: {e}")
             return {"status": "error", "message": str(e)}
@@ -63,38 +178,28 @@ class Client:
     # send commands to datanode over socket
     def send_to_datanode(self, command, dn_port):
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect(("localhost",dn_port))
-                s.sendall(json.dumps(command).encode())              
-                response = s.recv(4096)
-                return json.loads(response)
+            return self.pool.request(("localhost",dn_port), command)
         except Exception as e:
             print(f"Error sending command to DataNode: {e}")
             return {"status": "error", "message": str(e)}
         
-    # split a file into partitions by size
-    def split_file(self, src_file_path, src_file_name, partition_size, splits_dir):
-        with open(src_file_path, 'r') as f:
-            file_contents = f.read()
-        num_partitions = (len(file_contents) + partition_size - 1) // partition_size
-
-        for i in range(num_partitions):
-            # slice the file contents based on the indices
-            start_index = i * partition_size
-            end_index = (i + 1) * partition_size
-            partition_contents = file_contents[start_index:end_index]
-            # write 
-            partition_path = splits_dir+"/"+src_file_name[:src_file_name.index(".")]+"_"+str(i+1)+"."+src_file_name[src_file_name.index(".")+1:]
-            with open(partition_path, 'w') as partition_file:
-                partition_file.write(partition_contents)
-
-
     # command put - upload file from local machine to edfs 
-    def put(self, src, dst):
-        # get size of file in bytes
-        file_size = os.stat(src).st_size  
+    # rf and block_size override the namenode's default number of replicas and bytes per block for this file
+    def put(self, src, dst, rf=None, block_size=None):
+        with open(src, "rb") as f:
+            # get size of file in bytes
+            return self.put_stream(f, dst, os.fstat(f.fileno()).st_size, rf, block_size)
+
+    # upload file_size bytes read from a binary stream, holding one block of it in memory at a time
+    def put_stream(self, stream, dst, file_size, rf=None, block_size=None):
+        self.metadata_cache.pop(dst)
         # send a write request to namenode
-        namenode_response = self.send_to_namenode({"command":"put", "file_path":dst, "file_size":file_size})
+        request = {"command":"put", "file_path":dst, "file_size":file_size}
+        if rf:
+            request["rf"] = rf
+        if block_size:
+            request["block_size"] = block_size
+        namenode_response = self.send_to_namenode(request)
         if namenode_response["status"]=="error":
             print(namenode_response["message"])
             return 0
@@ -102,70 +207,241 @@ class Client:
         # namenode returns locations to store the file 
         locations = namenode_response["locations"]      
 
-        # namenode also returns the default EDFS block size to help splitting
+        # namenode also returns the file's block size to help splitting
         bytes_per_split = namenode_response["block_size"]
         print("\nFile size:",file_size)
         print("Allowed block size:",namenode_response["block_size"])
+        if len(locations)>1:
+            print("Splitting file into",len(locations),"partitions")
 
-        block_sizes = {}    # to record the actual sie of each block
-
-        if len(locations)==1:   # no file splitting required
-            block_sizes[0] = file_size
-            with open(src, "rb") as f:
-                file = f.read()
-            # base64 encoding required to send file over socket
-            file_b64 = base64.b64encode(file).decode()  
-                
-            # sending file to datanode
-            r = 1
-            for replica in locations[0]:
-                print("\nSending replica",str(r),"to DataNode port",replica[0])
-                response_dn = self.send_to_datanode({"command":"put", "block_id":replica[1], "data":file_b64},replica[0])    
-                print(response_dn["message"])
-                if response_dn["status"]=="error":
-                    print(response_dn["message"])
-                    return 0
-                r+=1
+        block_sizes = {}    # to record the actual size of each block, keyed by partition number as a string
 
-        elif len(locations)>1:
-            print("Splitting file into",len(namenode_response["locations"]),"partitions")
-
-            splits_dir = os.getcwd()+"/splits"
-            if os.path.exists(splits_dir):
-                shutil.rmtree(splits_dir)
-            os.mkdir(splits_dir)
+        # stream the file one block at a time through a single reused buffer
+        # submit() returns once a block is written to the socket, so the buffer can be refilled
+        # while the datanodes are still acknowledging earlier blocks
+        # each block goes only to the first replica, which forwards it along the rest of the pipeline
+        buffer = bytearray(min(bytes_per_split, file_size))
+        view = memoryview(buffer)
+        pending = []
+        for p, partition in enumerate(locations):
+            expected = min(bytes_per_split, file_size - p * bytes_per_split)
+            n = read_into(stream, view[:expected])
+            if n < expected:
+                return self.abandon_put([(dst, locations)], f"Source ended after {p * bytes_per_split + n} of {file_size} bytes")
+            block_sizes[str(p)] = n
+            print("\nSending partition",str(p+1),"to DataNode pipeline"," -> ".join(str(replica[0]) for replica in partition))
+            try:
+                pending.append(self.pool.submit(("localhost",partition[0][0]), {"command":"write_block", "block_id":partition[0][1], "pipeline":partition[1:], "data":view[:n]}))
+            except Exception as e:
+                return self.abandon_put([(dst, locations)], f"Error sending command to DataNode: {e}")
 
-            # split the file by block size
-            src_file_name = src[src.rfind("/")+1:]
-            self.split_file(src, src_file_name, bytes_per_split, splits_dir)
-            
-            for filename in os.listdir(splits_dir):
-                split_num = int(filename[:filename.index(".")].split('_')[-1])-1
-                if split_num not in block_sizes.keys():
-                    block_sizes[split_num] = os.stat(splits_dir+"/"+filename).st_size
-
-                # file encoding
-                with open(splits_dir+"/"+filename, "rb") as f:
-                    file = f.read()
-                file_b64 = base64.b64encode(file).decode()
-                
-                # sending file split to datanode
-                r = 1
-                for replica in locations[split_num]:
-                    print("\nSending partition",str(split_num+1),"replica",str(r),"to DataNode port",replica[0])
-                    response_dn = self.send_to_datanode({"command":"put", "block_id":replica[1], "data":file_b64},replica[0])    
-                    if response_dn["status"]=="error":
-                        print(response_dn["message"])
-                        return 0
-                    r+=1
-
-            shutil.rmtree(splits_dir)
+        for future in pending:
+            try:
+                response_dn = future.result()
+            except Exception as e:
+                response_dn = {"status": "error", "message": str(e)}
+            if response_dn["status"]=="error":
+                return self.abandon_put([(dst, locations)], response_dn["message"])
 
         # telling the namenode to update metadata for the newly saved file
-        response_new_file = self.send_to_namenode({"command":"put_update", "file_path":dst, "file_size":file_size, "locations":locations, "block_sizes":block_sizes})
+        response_new_file = self.send_to_namenode({"command":"put_update", "file_path":dst, "file_size":file_size, "locations":locations, "block_sizes":block_sizes, "block_size":bytes_per_split})
         print(response_new_file["message"])
-        return 1
+        return 1 if response_new_file["status"]=="success" else 0
+
+    # give up puts whose blocks weren't all written, items are (edfs path, locations) as allocated,
+    # the namenode releases their space and deletes the blocks that were written rather than waiting for them to time out
+    def abandon_put(self, items, message):
+        print(message)
+        self.send_to_namenode({"command":"abandon_put", "files":[{"file_path":dst, "locations":locations} for dst, locations in items]})
+        return 0
     
+    # command append - add a local file to the end of an edfs file
+    def append(self, src, dst):
+        with open(src, "rb") as f:
+            return self.append_stream(f, dst, os.fstat(f.fileno()).st_size)
+
+    # append size bytes read from a binary stream to an existing file, holding one block of it in memory at a time
+    # the namenode grants a lease that keeps other writers out until the append is committed, renewed here while blocks
+    # are sent, if the file's last block isn't full it is read and rewritten with the new bytes under a new block id
+    def append_stream(self, stream, dst, size):
+        self.metadata_cache.pop(dst)
+        namenode_response = self.send_to_namenode({"command":"append", "file_path":dst, "append_size":size, "holder":self.holder})
+        if namenode_response["status"]=="error":
+            print(namenode_response["message"])
+            return 0
+        lease = {"file_path":dst, "lease":namenode_response["lease"]}
+        renew_every = namenode_response["lease_period"] / 2
+        renewed = time.monotonic()
+        locations = namenode_response["locations"]
+        bytes_per_split = namenode_response["block_size"]
+        tail = namenode_response["tail"]
+
+        # give the lease back so the blocks written so far are deleted and other writers needn't wait for it to expire
+        def abandon(message):
+            print(message)
+            self.send_to_namenode(dict(lease, command="release_lease"))
+            return 0
+
+        tail_data = b""
+        if tail["num_bytes"]:
+            try:
+                _, tail_data = next(self.read_partitions([(0, [(block_id, port) for block_id, port in tail["replicas"]])]))
+            except (IOError, StopIteration) as e:
+                return abandon(f"Couldn't read the file's last block: {e}")
+        total = len(tail_data) + size
+
+        block_sizes = {}    # bytes of each new block, keyed by partition number as a string
+        buffer = bytearray(min(bytes_per_split, total))
+        view = memoryview(buffer)
+        pending = []
+        for p, partition in enumerate(locations):
+            expected = min(bytes_per_split, total - p * bytes_per_split)
+            filled = 0
+            if p == 0 and tail_data:
+                view[:len(tail_data)] = tail_data
+                filled = len(tail_data)
+            n = filled + read_into(stream, view[filled:expected])
+            if n < expected:
+                return abandon(f"Source ended after {p * bytes_per_split + n - len(tail_data)} of {size} bytes")
+            block_sizes[str(p)] = n
+            if time.monotonic() - renewed >= renew_every:
+                renew_response = self.send_to_namenode(dict(lease, command="renew_lease"))
+                if renew_response["status"]=="error":
+                    print(renew_response["message"])
+                    return 0
+                renewed = time.monotonic()
+            print("\nSending partition",str(p+1),"to DataNode pipeline"," -> ".join(str(replica[0]) for replica in partition))
+            try:
+                pending.append(self.pool.submit(("localhost",partition[0][0]), {"command":"write_block", "block_id":partition[0][1], "pipeline":partition[1:], "data":view[:n]}))
+            except Exception as e:
+                return abandon(f"Error sending command to DataNode: {e}")
+
+        for future in pending:
+            try:
+                response_dn = future.result()
+            except Exception as e:
+                response_dn = {"status": "error", "message": str(e)}
+            if response_dn["status"]=="error":
+                return abandon(response_dn["message"])
+
+        response = self.send_to_namenode(dict(lease, command="append_update", file_size=namenode_response["file_size"] + size, block_sizes=block_sizes))
+        self.metadata_cache.pop(dst)
+        print(response["message"])
+        return 1 if response["status"]=="success" else 0
+
+    # upload many files with a few namenode requests: each batch of PUT_BATCH_FILES is allocated with one put_batch
+    # and committed with one put_update_batch, items are (local path, edfs path), returns the number of files uploaded
+    # blocks of all files in a batch are sent at once, up to PUT_BATCH_BYTES of them in flight
+    def put_batch(self, items, rf=None, block_size=None):
+        for _, dst in items:
+            self.metadata_cache.pop(dst)
+        uploaded = 0
+        for start in range(0, len(items), PUT_BATCH_FILES):
+            batch = items[start:start + PUT_BATCH_FILES]
+            files = []
+            for _, dst in batch:
+                files.append({"file_path":dst, "file_size":0})
+                if rf:
+                    files[-1]["rf"] = rf
+                if block_size:
+                    files[-1]["block_size"] = block_size
+            try:
+                for (src, _), f in zip(batch, files):
+                    f["file_size"] = os.stat(src).st_size
+            except OSError as e:
+                print(e)
+                continue
+            namenode_response = self.send_to_namenode({"command":"put_batch", "files":files})
+            if namenode_response["status"]=="error":
+                print(namenode_response["message"])
+                continue
+
+            # commit only the files whose every block was written
+            failed = set()
+            block_sizes = [{} for _ in batch]
+            pending = collections.deque()
+            in_flight = 0
+            for i, ((src, dst), allocated) in enumerate(zip(batch, namenode_response["files"])):
+                try:
+                    with open(src, "rb") as f:
+                        for p, partition in enumerate(allocated["locations"]):
+                            data = f.read(allocated["block_size"])
+                            block_sizes[i][str(p)] = len(data)
+                            pending.append((i, len(data), self.pool.submit(("localhost",partition[0][0]), {"command":"write_block", "block_id":partition[0][1], "pipeline":partition[1:], "data":data})))
+                            in_flight += len(data)
+                            while in_flight > PUT_BATCH_BYTES:
+                                in_flight -= self.wait_write(pending.popleft(), failed)
+                except OSError as e:
+                    print(f"Error uploading {src}: {e}")
+                    failed.add(i)
+            while pending:
+                self.wait_write(pending.popleft(), failed)
+
+            commit = []
+            for i, ((src, dst), f, allocated) in enumerate(zip(batch, files, namenode_response["files"])):
+                if i not in failed:
+                    commit.append({"file_path":dst, "file_size":f["file_size"], "locations":allocated["locations"], "block_sizes":block_sizes[i], "block_size":allocated["block_size"]})
+            if failed:
+                self.abandon_put([(batch[i][1], namenode_response["files"][i]["locations"]) for i in sorted(failed)], f"{len(failed)} files failed to upload")
+            if not commit:
+                continue
+            namenode_response = self.send_to_namenode({"command":"put_update_batch", "files":commit})
+            print(namenode_response["message"])
+            if namenode_response["status"]=="success":
+                uploaded += len(commit)
+        return uploaded
+
+    # wait for a block write of put_batch, (file index, size, future), a failed write marks its file failed, returns the size
+    @staticmethod
+    def wait_write(write, failed):
+        i, size, future = write
+        try:
+            response = future.result()
+        except Exception as e:
+            response = {"status": "error", "message": str(e)}
+        if response["status"]=="error":
+            print(response["message"])
+            failed.add(i)
+        return size
+
+    # command put -r - upload a local directory tree into dst, which is created if it doesn't exist
+    # directories are created one by one, the files in batches, a directory the namenode refuses is skipped with everything under it
+    def put_recursive(self, local_dir, dst, rf=None, block_size=None):
+        if not os.path.isdir(local_dir):
+            print(f"{local_dir} is not a directory")
+            return 0
+        dst = dst.rstrip("/") or "/"
+        if not self.ensure_directory(dst):
+            print(f"Couldn't create {dst}")
+            return 0
+        items = []
+        skipped = []
+        for root, dirs, files in os.walk(local_dir):
+            relative = os.path.relpath(root, local_dir)
+            edfs_dir = dst if relative == "." else (dst if dst != "/" else "") + "/" + relative.replace(os.sep, "/")
+            for name in list(dirs):
+                if not self.ensure_directory(f"{edfs_dir.rstrip('/')}/{name}"):
+                    skipped.append(os.path.join(root, name))
+                    dirs.remove(name)
+            for name in files:
+                # the namenode only takes file names with an extension
+                if "." not in name:
+                    skipped.append(os.path.join(root, name))
+                    continue
+                items.append((os.path.join(root, name), f"{edfs_dir.rstrip('/')}/{name}"))
+        for path in skipped:
+            print(f"Skipped {path}")
+        uploaded = self.put_batch(items, rf, block_size)
+        print(f"Uploaded {uploaded} of {len(items)} files")
+        return 1 if uploaded == len(items) else 0
+
+    # create a directory unless it already exists, returns whether it exists now
+    def ensure_directory(self, path):
+        if self.send_to_namenode({"command":"mkdir", "path":path})["status"]=="success":
+            return True
+        namenode_response = self.send_to_namenode({"command":"stat", "paths":[path]})
+        return namenode_response["status"]=="success" and namenode_response["stats"][0].get("type")=="dir"
+
     # command ls - list contents of a directory
     def ls(self, path):
         namenode_response = self.send_to_namenode({"command":"ls", "path":path})
@@ -179,12 +455,75 @@ class Client:
             print()
             return 1
         
+    # one page of a directory with the type and size of each entry, see NameNode.listing
+    # passing the generation of a page fetched earlier returns "not_modified" if the directory hasn't changed since
+    def listing(self, path, offset=0, limit=None, generation=None):
+        command = {"command":"listing", "path":path, "offset":offset}
+        if limit is not None:
+            command["limit"] = limit
+        if generation is not None:
+            command["generation"] = generation
+        return self.send_to_namenode(command)
+
+    # command ls -l - list a directory with entry types and sizes, a page at a time
+    def ls_long(self, path):
+        offset = 0
+        print()
+        while True:
+            namenode_response = self.listing(path, offset)
+            if namenode_response["status"]=="error":
+                print(namenode_response["message"])
+                return 0
+            for entry in namenode_response["entries"]:
+                print(f"{entry['type']:<4} {entry['size']:>12} {entry['name']}")
+            offset += len(namenode_response["entries"])
+            if not namenode_response["entries"] or offset >= namenode_response["total"]:
+                break
+        print()
+        return 1
+
     # command rm - delete a file
     def rm(self, path):
+        self.metadata_cache.pop(path)
         namenode_response = self.send_to_namenode({"command":"rm", "path":path})
         print(namenode_response["message"])
         return 0 if namenode_response["status"]=="error" else 1
     
+    # command rm -r - delete a directory and everything under it, the namenode deletes the blocks
+    def rm_recursive(self, path):
+        self.metadata_cache.clear()
+        namenode_response = self.send_to_namenode({"command":"rm_recursive", "path":path})
+        print(namenode_response["message"])
+        return 0 if namenode_response["status"]=="error" else 1
+
+    # command stat - type and size of each path, see NameNode.stat
+    def stat(self, paths):
+        namenode_response = self.send_to_namenode({"command":"stat", "paths":paths})
+        if namenode_response["status"]=="error":
+            print(namenode_response["message"])
+            return 0
+        for stat in namenode_response["stats"]:
+            if stat["status"]=="error":
+                print(f"{stat['path']}: {stat['message']}")
+            elif stat["type"]=="dir":
+                print(f"{stat['path']}: directory, {stat['entries']} entries")
+            else:
+                print(f"{stat['path']}: file, {stat['size']} bytes, {stat['block_size']} byte blocks, rf {stat['rf']}, {stat['replicas']} replicas")
+        return namenode_response["stats"]
+
+    # command ls -R - everything under a directory, fetched in one request
+    def ls_recursive(self, path):
+        namenode_response = self.send_to_namenode({"command":"ls_recursive", "path":path})
+        if namenode_response["status"]=="error":
+            print(namenode_response["message"])
+            return 0
+        print()
+        for line in bytes(namenode_response["data"]).decode().splitlines():
+            kind, size, entry_path = line.split("\t", 2)
+            print(f"{kind:<4} {int(size):>12} {entry_path}")
+        print()
+        return 1
+
     # command mkdir - create a directory
     def mkdir(self, path):
         namenode_response = self.send_to_namenode({"command":"mkdir", "path":path})
@@ -197,100 +536,456 @@ class Client:
         print(namenode_response["message"])
         return 0 if namenode_response["status"]=="error" else 1
 
-    # command get - download file from edfs to local machine
-    def get(self, file_path, local_path):
+    # group the namenode's replica list by partition in file order, returns ([(offset, replicas)], file size)
+    def partitions_from(self, blocks):
+        by_partition = {}
+        for block in blocks:
+            by_partition.setdefault(block["partition"], []).append(block)
+        partitions = []
+        offset = 0
+        for p in sorted(by_partition):
+            replicas = by_partition[p]
+            partitions.append((offset, [(b["id"], b["datanode"]) for b in replicas]))
+            offset += replicas[0]["num_bytes"]
+        return partitions, offset
+
+    # (partitions, file size, refresh) of a file, from the metadata cache while its entry is younger than metadata_ttl
+    # refresh() fetches the partitions from the namenode again, None if the file is gone, and stays None for fresh metadata
+    # raises IOError if the namenode can't give the file's blocks
+    def locate(self, file_path):
+        cached = self.metadata_cache.get(file_path)
+        if cached is not None and time.monotonic() - cached[0] < self.metadata_ttl:
+            self.metadata_hits += 1
+            def refresh():
+                self.metadata_cache.pop(file_path)
+                try:
+                    return self.locate(file_path)[0]
+                except IOError:
+                    return None
+            return cached[1], cached[2], refresh
+        self.metadata_misses += 1
         namenode_response = self.send_to_namenode({"command":"get", "file_path":file_path})
         if namenode_response["status"]=="error":
-            print(namenode_response["message"])
-            return 0
+            self.metadata_cache.pop(file_path)
+            raise IOError(namenode_response["message"])
+        partitions, file_size = self.partitions_from(namenode_response["blocks"])
+        if self.metadata_ttl > 0:
+            self.metadata_cache.put(file_path, (time.monotonic(), partitions, file_size))
+        return partitions, file_size, None
 
-        partitions = {}
-        for block in namenode_response["blocks"]:
-            p = block["partition"]
-            if p not in partitions.keys():
-                partitions[p] = []
-            partitions[p].append([block["id"], block["datanode"]])
+    # request a partition, or length bytes of it from start, from a replica it hasn't been tried on,
+    # preferring local datanodes and datanodes not in failed, returns (future, datanode port, deadline)
+    def submit_read(self, partitions, index, tried, failed, start=0, length=None):
+        replicas = [replica for replica in partitions[index][1] if replica[1] not in tried]
+        replicas.sort(key=lambda replica: (replica[1] in failed, replica[1] not in self.local_datanodes))
+        command = {"command":"get"}
+        if length is not None:
+            command.update(offset=start, length=length)
+        for block_id, datanode_port in replicas:
+            tried.add(datanode_port)
+            try:
+                future = self.pool.submit(("localhost",datanode_port), dict(command, block_id=block_id))
+                return future, datanode_port, time.monotonic() + self.read_timeout
+            except OSError as e:
+                print(f"Error sending command to DataNode: {e}")
+                failed.add(datanode_port)
+        raise IOError(f"No replica of partition {index+1} could be read")
 
-        splits_dir = os.getcwd()+"/splits"
-        if os.path.exists(splits_dir):
-            shutil.rmtree(splits_dir)
-        os.mkdir(splits_dir)
+    # fetch partitions with up to self.parallelism requests in flight, yields (offset, data)
+    # ranges lists (partition index, start, length) pieces to read instead of every whole partition, length None for
+    # the rest of the partition, the offset yielded with a piece is that of its first byte in the file
+    # cached blocks are used without a request and fetched whole blocks are added to the cache, data must not be modified
+    # a replica that fails or doesn't answer within read_timeout is replaced by the next one,
+    # and a datanode that timed out or dropped the connection is tried last for the rest of the read
+    # once every replica of a partition has failed the partitions are fetched again with refresh, if given,
+    # in case they came from the metadata cache and the replicas moved or an append replaced the last block
+    # pieces are cut off at file_size, if given, the size the partitions were located with, so a last block an append
+    # grew in the meantime reads as it was
+    # with ordered set pieces are yielded in the order of ranges, otherwise as soon as they arrive
+    def read_partitions(self, partitions, ordered=True, refresh=None, ranges=None, file_size=None):
+        if ranges is None:
+            ranges = [(index, 0, None) for index in range(len(partitions))]
+        in_flight = {}
+        tried = {}
+        failed = set()
+        ready = {}
+        next_submit = 0
+        next_yield = 0
 
-        file_content = ""
+        def submit(piece):
+            nonlocal partitions, refresh
+            index, start, length = ranges[piece]
+            try:
+                return self.submit_read(partitions, index, tried[piece], failed, start, length)
+            except IOError:
+                fresh, refresh = (refresh() if refresh is not None else None), None
+                # the file was replaced if its blocks no longer line up, appends only add blocks after the ones read here
+                if fresh is None or [offset for offset, _ in fresh[:len(partitions)]] != [offset for offset, _ in partitions]:
+                    raise
+                partitions = fresh
+                tried[piece] = set()
+                return self.submit_read(partitions, index, tried[piece], failed, start, length)
+
+        def file_offset(piece):
+            index, start, _ = ranges[piece]
+            return partitions[index][0] + start
+
+        # take a ready piece, returns its offset and data without any bytes past file_size
+        def take(number):
+            offset, data = file_offset(number), ready.pop(number)
+            if file_size is not None and offset + len(data) > file_size:
+                data = data[:max(file_size - offset, 0)]
+            return offset, data
+
+        while next_yield < len(ranges):
+            # ready blocks count against the window so memory stays at parallelism blocks
+            now = time.monotonic()
+            while next_submit < len(ranges) and len(in_flight) + len(ready) < self.parallelism:
+                index, start, length = ranges[next_submit]
+                data = self.block_cache.get(*(block_id for block_id, _ in partitions[index][1]))
+                if data is not None:
+                    ready[next_submit] = data if length is None else memoryview(data)[start:start + length]
+                else:
+                    tried[next_submit] = set()
+                    in_flight[next_submit] = submit(next_submit)
+                next_submit += 1
+
+            timeout = max(min((deadline for _, _, deadline in in_flight.values()), default=now) - now, 0)
+            wait([future for future, _, _ in in_flight.values()], timeout=timeout, return_when=FIRST_COMPLETED)
 
-        for p in partitions.keys():
-            for replica in partitions[p]:
+            now = time.monotonic()
+            for piece, (future, datanode_port, deadline) in list(in_flight.items()):
+                index, _, length = ranges[piece]
+                if not future.done():
+                    if now >= deadline:
+                        print(f"Timed out reading partition {index+1} from DataNode {datanode_port}")
+                        failed.add(datanode_port)
+                        in_flight[piece] = submit(piece)
+                    continue
                 try:
-                    block_id = replica[0]
-                    datanode_port = replica[1]
-                    datanode_response = self.send_to_datanode({"command":"get", "block_id":block_id},datanode_port)
-                    data = base64.b64decode(datanode_response["block"]).decode()
-                    file_content+=data
-                    break
-                except:
+                    response = future.result()
+                except Exception as e:
+                    failed.add(datanode_port)
+                    response = {"status": "error", "message": str(e)}
+                if response["status"]=="error":
+                    print(response["message"])
+                    in_flight[piece] = submit(piece)
                     continue
+                del in_flight[piece]
+                del tried[piece]
+                ready[piece] = response["block"]
+                block_id = next((block_id for block_id, port in partitions[index][1] if port == datanode_port), None)
+                if block_id is not None and length is None:
+                    self.block_cache.put(block_id, ready[piece])
+
+            if ordered:
+                while next_yield in ready:
+                    yield take(next_yield)
+                    next_yield += 1
+            else:
+                for number in list(ready):
+                    yield take(number)
+                    next_yield += 1
+
+    # the (partition index, start, length) pieces of partitions covering length bytes of a file_size byte file from offset,
+    # a piece that covers its whole partition has length None so it is read and cached whole
+    def partition_ranges(self, partitions, file_size, offset, length):
+        end = min(offset + length, file_size)
+        ranges = []
+        first = max(bisect.bisect_right([start for start, _ in partitions], offset) - 1, 0)
+        for index in range(first, len(partitions)):
+            start = partitions[index][0]
+            if start >= end:
+                break
+            stop = partitions[index + 1][0] if index + 1 < len(partitions) else file_size
+            piece_start, piece_end = max(offset, start), min(end, stop)
+            whole = piece_start == start and piece_end == stop
+            ranges.append((index, piece_start - start, None if whole else piece_end - piece_start))
+        return ranges
+
+    # length bytes of a file from offset, fewer if the file ends first, fetching only the blocks that cover them
+    # and only the part of each that is needed, raises IOError if the file or a partition can't be read
+    def read(self, file_path, offset, length):
+        partitions, file_size, refresh = self.locate(file_path)
+        return self.read_located(partitions, file_size, refresh, offset, length)
 
-        with open(local_path, 'w') as merged_file:
-            merged_file.write(file_content)
+    # read() of a file whose partitions are already located
+    def read_located(self, partitions, file_size, refresh, offset, length):
+        offset = max(offset, 0)
+        result = bytearray(max(min(length, file_size - offset), 0))
+        if result:
+            for piece_offset, data in self.read_partitions(partitions, ordered=False, refresh=refresh, file_size=offset + len(result),
+                                                           ranges=self.partition_ranges(partitions, file_size, offset, len(result))):
+                result[piece_offset - offset:piece_offset - offset + len(data)] = data
+        return result
+
+    # a seekable, read-only file object over an edfs file, see EDFSFile
+    def open(self, file_path, readahead=DEFAULT_READAHEAD):
+        return EDFSFile(self, file_path, readahead)
+
+    # command get - download file from edfs to local machine
+    def get(self, file_path, local_path):
+        try:
+            partitions, file_size, refresh = self.locate(file_path)
+        except IOError as e:
+            print(e)
+            return 0
+
+        try:
+            # blocks are written at their own offset as they arrive, in whatever order that is
+            with open(local_path, "wb") as f:
+                f.truncate(file_size)
+                for offset, data in self.read_partitions(partitions, ordered=False, refresh=refresh, file_size=file_size):
+                    f.seek(offset)
+                    f.write(data)
+        except IOError as e:
+            print(e)
+            return 0
 
         print("File saved to",local_path)
-        shutil.rmtree(splits_dir)
+        return 1
+
+    # (file size, iterator over the file's contents in order) for streaming a file elsewhere
+    # the iterator holds at most parallelism blocks and raises IOError if a partition can't be read
+    def open_stream(self, file_path):
+        partitions, file_size, refresh = self.locate(file_path)
+        return file_size, (data for _, data in self.read_partitions(partitions, refresh=refresh, file_size=file_size))
 
     # command cat - display file contents on the terminal
+    # blocks are written out as they arrive and not kept, so at most parallelism of them are held however big the file is
     def cat(self, file_path):
-        namenode_response = self.send_to_namenode({"command":"cat", "file_path":file_path})
-        if namenode_response["status"] == "error":
-            print(namenode_response["message"])
+        try:
+            _, content = self.open_stream(file_path)
+        except IOError as e:
+            print(e)
             return 0
 
-        partitions = {}
-        for block in namenode_response["blocks"]:
-            p = block["partition"]
-            if p not in partitions.keys():
-                partitions[p] = []
-            partitions[p].append([block["id"], block["datanode"]])
-
-        splits_dir = os.getcwd()+"/splits"
-        if os.path.exists(splits_dir):
-            shutil.rmtree(splits_dir)
-        os.mkdir(splits_dir)
-
-        file_content = ""
-        for p in partitions.keys():
-            for replica in partitions[p]:
-                try:
-                    block_id = replica[0]
-                    datanode_port = replica[1]
-                    datanode_response = self.send_to_datanode({"command":"cat", "block_id":block_id},datanode_port)
-                    data = base64.b64decode(datanode_response["block"]).decode()
-                    file_content+=data
-                    break
-                except:
-                    continue
-
-        print(file_content)
-        shutil.rmtree(splits_dir)
-        return file_content
+        out = getattr(sys.stdout, "buffer", None)
+        # a character split across two blocks is decoded once both halves are in
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        try:
+            # blocks are printed in order as soon as the ones before them have arrived
+            sys.stdout.flush()
+            for data in content:
+                if out is not None:
+                    out.write(data)
+                else:
+                    sys.stdout.write(decoder.decode(data))
+            if out is not None:
+                out.write(b"\n")
+                out.flush()
+            else:
+                print(decoder.decode(b"", final=True))
+        except IOError as e:
+            print(e)
+            return 0
+        return 1
 
     # for client UI
-    def get_blocks_metadata(self, file_path):
-        namenode_response = self.send_to_namenode({"command":"blocks_metadata", "file_path":file_path})
-        print(namenode_response)
-        return eval(namenode_response['data'])
+    # returns the namenode response, whose "blocks" lists up to limit replicas from offset on and "total" counts them all
+    def get_blocks_metadata(self, file_path, offset=0, limit=None):
+        command = {"command":"blocks_metadata", "file_path":file_path, "offset":offset}
+        if limit is not None:
+            command["limit"] = limit
+        namenode_response = self.send_to_namenode(command)
+        if namenode_response["status"]=="error":
+            print(namenode_response["message"])
+        return namenode_response
+
+    # command blocks_metadata - list the replicas of a file's blocks
+    def print_blocks_metadata(self, file_path):
+        namenode_response = self.get_blocks_metadata(file_path)
+        if namenode_response["status"]=="error":
+            return 0
+        for block in namenode_response["blocks"]:
+            print(f"partition {block['partition']} on DataNode {block['datanode']}: {block['id']} ({block['num_bytes']} bytes)")
+        if namenode_response["total"] > len(namenode_response["blocks"]):
+            print(f"... {namenode_response['total'] - len(namenode_response['blocks'])} more")
+        return 1
+
+    # raw bytes of one replica, raises IOError if the datanode doesn't have it
+    # a block's bytes, or length bytes of it from offset
+    def get_block(self, block_id, datanode_port, offset=0, length=None):
+        command = {"command":"block_content", "block_id":block_id}
+        if offset or length is not None:
+            command.update(offset=offset, length=length)
+        datanode_response = self.send_to_datanode(command, datanode_port)
+        if datanode_response["status"]=="error":
+            raise IOError(datanode_response["message"])
+        return datanode_response["block"]
     
+    # latency histograms, counters and in-flight requests of a namenode or datanode, the namenode's also lists its datanodes
+    def metrics(self, port):
+        return self.pool.request(("localhost",port), {"command":"metrics"}, self.read_timeout)
+
+    # command metrics - print a node's metrics, the namenode's by default
+    def print_metrics(self, port):
+        try:
+            response = self.metrics(port)
+        except Exception as e:
+            print(f"Error getting metrics from port {port}: {e}")
+            return 0
+        print(json.dumps(response, indent=2))
+        return response
+
+    # command profile - start or stop the sampling profiler of a node, or print what it has sampled
+    def profile(self, port, action):
+        try:
+            response = self.pool.request(("localhost",port), {"command":"profile", "action":action}, self.read_timeout)
+        except Exception as e:
+            print(f"Error sending profile request to port {port}: {e}")
+            return 0
+        print(response["message"])
+        if response["status"]=="success" and action != "start":
+            print(f"{response['samples']} samples every {response['interval_s']}s")
+            for function, count in response["functions"]:
+                print(f"{count:>8} {function}")
+        return response
+
+    # hit and miss counts of the block and metadata caches
+    def cache_stats(self):
+        return dict(self.block_cache.stats(), metadata_hits=self.metadata_hits, metadata_misses=self.metadata_misses)
+
+    # command cache - print cache_stats
+    def print_cache_stats(self):
+        stats = self.cache_stats()
+        for name, value in stats.items():
+            print(f"{name}: {value}")
+        return stats
+
     # for client UI
     def get_block_content(self, block_id, datanode_port):
-        datanode_response = self.send_to_datanode({"command":"block_content","block_id":block_id},datanode_port)
-        print(type(base64.b64decode(datanode_response["block"]).decode()))
-        return str(base64.b64decode(datanode_response["block"]).decode())
+        try:
+            return bytes(self.get_block(block_id, datanode_port)).decode(errors="replace")
+        except IOError as e:
+            print(e)
+            return ""
+
+# a read-only, seekable binary file over an edfs file, usable wherever a file object is, e.g. pandas.read_csv(client.open(path))
+# reads are served from a buffer filled with Client.read, each fill fetches readahead bytes past what was asked for,
+# the window doubles up to MAX_READAHEAD while reads continue where the buffer ended and shrinks back after a seek
+# the file's block locations are looked up once, when it is opened
+class EDFSFile(io.BufferedIOBase):
+    def __init__(self, client, file_path, readahead=DEFAULT_READAHEAD):
+        super().__init__()
+        self.client = client
+        self.name = file_path
+        self.partitions, self.size, self.refresh = client.locate(file_path)
+        self.position = 0
+        self.buffer = b""
+        self.buffer_offset = 0
+        self.initial_readahead = readahead
+        self.readahead = readahead
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        self._checkClosed()
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError(f"Invalid whence {whence}")
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.position = offset
+        return self.position
+
+    # bytes of the buffer from the current position on
+    def buffered(self):
+        start = self.position - self.buffer_offset
+        if 0 <= start < len(self.buffer):
+            return memoryview(self.buffer)[start:]
+        return memoryview(b"")
+
+    # refill the buffer from the current position with at least n bytes, if the file has them, plus the readahead
+    def fill(self, n):
+        if self.buffer and self.position == self.buffer_offset + len(self.buffer):
+            self.readahead = min(self.readahead * 2, max(MAX_READAHEAD, self.initial_readahead))
+        else:
+            self.readahead = self.initial_readahead
+        self.buffer = self.client.read_located(self.partitions, self.size, self.refresh, self.position, n + self.readahead)
+        self.buffer_offset = self.position
+
+    def read(self, size=-1):
+        self._checkClosed()
+        remaining = max(self.size - self.position, 0)
+        size = remaining if size is None or size < 0 else min(size, remaining)
+        data = bytes(self.buffered()[:size])
+        self.position += len(data)
+        if len(data) < size:
+            # the rest after a refill
+            self.fill(size - len(data))
+            rest = bytes(self.buffered()[:size - len(data)])
+            self.position += len(rest)
+            data += rest
+        return data
+
+    def read1(self, size=-1):
+        return self.read(size)
+
+    # buffered bytes from the current position, refilling the buffer first if it has none
+    def peek(self, size=0):
+        self._checkClosed()
+        if not len(self.buffered()) and self.position < self.size:
+            self.fill(max(size, 1))
+        return bytes(self.buffered())
+
+    def close(self):
+        self.buffer = b""
+        super().close()
+
+
+# a function of a client and one path argument as a shell command
+def one_path(method):
+    return lambda client, args: method(client, args[0]) if len(args) == 1 else INVALID_USE
+
+SHELL_COMMANDS = {
+    "ls": Client.shell_ls,
+    "rm": Client.shell_rm,
+    "stat": Client.shell_stat,
+    "put": Client.shell_put,
+    "get": Client.shell_get,
+    "append": Client.shell_append,
+    "mkdir": one_path(Client.mkdir),
+    "rmdir": one_path(Client.rmdir),
+    "cat": one_path(Client.cat),
+    "read": Client.shell_read,
+    "blocks_metadata": one_path(Client.print_blocks_metadata),
+    "metrics": Client.shell_metrics,
+    "profile": Client.shell_profile,
+    "cache": Client.shell_cache,
+    "block_content": Client.shell_block_content,
+}
 
 if __name__ == "__main__":
-    if len(sys.argv)!=4:
-        print("Correct usage: python3 client.py <client_ip> <client_port> <namenode_port>\n") 
-        sys.exit(1)
-    client_ip = sys.argv[1]
-    client_port = int(sys.argv[2])
-    namenode_port = int(sys.argv[3])
-
-    client = Client(client_ip, client_port, namenode_port)
-    client.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(usage="python3 client.py <client_ip> <client_port> <namenode_port> [--parallelism N] [--cache-bytes N] [--cache-dir DIR] [--codec json|msgpack]")
+    parser.add_argument("client_ip")
+    parser.add_argument("client_port", type=int)
+    parser.add_argument("namenode_port", type=int)
+    parser.add_argument("--parallelism", type=int, default=DEFAULT_PARALLELISM, help="blocks fetched at once by get and cat")
+    parser.add_argument("--read-timeout", type=float, default=DEFAULT_READ_TIMEOUT, help="seconds to wait on a replica before trying the next one")
+    parser.add_argument("--cache-bytes", type=int, default=DEFAULT_CACHE_BYTES, help="bytes of blocks kept in memory for repeated reads, 0 for none")
+    parser.add_argument("--cache-dir", help="directory blocks evicted from memory spill to")
+    parser.add_argument("--cache-spill-bytes", type=int, default=0, help="bytes of blocks kept in --cache-dir")
+    parser.add_argument("--metadata-ttl", type=float, default=DEFAULT_METADATA_TTL, help="seconds a file's block locations are reused, 0 to always ask the namenode")
+    parser.add_argument("--local-datanode", type=int, action="append", default=[], help="port of a datanode on this machine, read from first, repeatable")
+    parser.add_argument("--codec", choices=sorted(CODEC_VERSIONS), default="json", help="encoding of the request headers this process sends, msgpack needs the msgpack package")
+    args = parser.parse_args()
+    try:
+        set_codec(args.codec)
+    except ValueError as e:
+        parser.error(str(e))
+
+    client = Client(args.client_ip, args.client_port, args.namenode_port, args.parallelism, args.read_timeout,
+                    args.cache_bytes, args.cache_dir, args.cache_spill_bytes, args.metadata_ttl, args.local_datanode)
+    client.run()
@@ -0,0 +1,133 @@
+# command tables: each command a node answers is registered with its handler and the schemas of its request and response
+#
+# a schema maps field names to the type, or tuple of types, their value must have, fields wrapped in optional() may be
+# left out, and are then not passed to the handler so its own default applies, fields wrapped in checked() must also
+# pass a check of their value
+# a request is checked against its schema before the handler runs and the handler gets the request's fields as keyword
+# arguments, so adding a command is registering one method rather than extending an if-chain in every node
+# responses are only checked against theirs when a table's check_responses is set, as a test of the handlers
+
+# fields every response carries
+RESPONSE_FIELDS = {"command": str, "status": str}
+
+# commands that change nothing, or nothing more when run twice, so a request whose connection dropped after it was
+# sent can be sent again, the other commands may already have been applied and are never resent
+IDEMPOTENT_COMMANDS = frozenset({"get", "block_content", "cat", "ls", "listing", "stat", "ls_recursive", "blocks_metadata",
+                                 "metrics", "renew_lease"})
+
+
+# a field whose value must also pass check, which raises ValueError for a value it refuses
+class checked:
+    def __init__(self, types, check):
+        self.types = types
+        self.check = check
+
+
+# a field that may be missing from a message, or be None
+class optional:
+    def __init__(self, types):
+        self.check = types.check if isinstance(types, checked) else None
+        types = types.types if isinstance(types, checked) else types
+        self.types = types if isinstance(types, tuple) else (types,)
+        self.types += (type(None),)
+
+
+# the fields of one kind of message, in checking order
+class Schema:
+    def __init__(self, fields=None):
+        self.required = []
+        self.optional = []
+        for name, types in (fields or {}).items():
+            if isinstance(types, optional):
+                self.optional.append((name, types.types, types.check))
+            elif isinstance(types, checked):
+                self.required.append((name, types.types, types.check))
+            else:
+                self.required.append((name, types, None))
+        self.names = [name for name, _, _ in self.required + self.optional]
+
+    # why message doesn't fit the schema, None if it does
+    def check(self, message):
+        for name, types, check in self.required:
+            if name not in message:
+                return f"missing field {name!r}"
+            error = self.check_field(name, message[name], types, check)
+            if error is not None:
+                return error
+        for name, types, check in self.optional:
+            if name in message and message[name] is not None:
+                error = self.check_field(name, message[name], types, check)
+                if error is not None:
+                    return error
+        return None
+
+    def check_field(self, name, value, types, check):
+        if not isinstance(value, types):
+            return f"field {name!r} is {type(value).__name__}"
+        if check is not None:
+            try:
+                check(value)
+            except ValueError as e:
+                return f"field {name!r}: {e}"
+        return None
+
+    # the schema's fields present in message, as handler arguments
+    def arguments(self, message):
+        return {name: message[name] for name in self.names if name in message and message[name] is not None}
+
+
+# a stream command's handler reads the request's payload off the connection itself and is run by the server's
+# stream handlers, the table only checks its requests
+class Command:
+    def __init__(self, name, handler, request, response, stream=False):
+        self.name = name
+        self.handler = handler
+        self.stream = stream
+        self.request = Schema(request)
+        self.response = Schema(dict(RESPONSE_FIELDS, **(response or {})))
+
+
+# commands answered by one kind of node, handlers are registered on the node's class with the command decorator
+# and called with the node as their first argument
+class CommandTable:
+    def __init__(self, name):
+        self.name = name
+        self.commands = {}
+        self.check_responses = False
+
+    # register the decorated method as the handler of name, which can be stacked to register it for several names
+    def command(self, name, request=None, response=None, stream=False):
+        def register(handler):
+            self.commands[name] = Command(name, handler, request, response, stream)
+            return handler
+        return register
+
+    def __contains__(self, name):
+        return name in self.commands
+
+    # the error response for a request that names no command of the table or doesn't fit its schema, None if it's valid
+    def check(self, message):
+        name = message.get("command")
+        command = self.commands.get(name)
+        if command is None:
+            return {"command":name, "status":"error", "message":f"{self.name} Error: Unknown command {name!r}"}
+        error = command.request.check(message)
+        if error is not None:
+            return {"command":name, "status":"error", "message":f"{self.name} Error: Invalid {name} request, {error}"}
+        return None
+
+    # check a request against its command's schema and run the command's handler on node
+    def dispatch(self, node, message):
+        error = self.check(message)
+        if error is not None:
+            return error
+        name = message["command"]
+        command = self.commands[name]
+        if command.stream:
+            return {"command":name, "status":"error", "message":f"{self.name} Error: {name} needs a framed request"}
+        response = command.handler(node, **command.request.arguments(message))
+        if self.check_responses and response.get("status") == "success":
+            error = command.response.check(response)
+            if error is not None:
+                return {"command":name, "status":"error", "message":f"{self.name} Error: Invalid {name} response, {error}"}
+        return response
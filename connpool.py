@@ -0,0 +1,242 @@
+import itertools
+import socket
+import threading
+import time
+from concurrent.futures import Future
+import protocol
+from commands import IDEMPOTENT_COMMANDS
+
+DEFAULT_MAX_CONNECTIONS = 4     # per (host, port)
+DEFAULT_MAX_PIPELINE = 16       # in-flight requests per connection before opening another one
+DEFAULT_IDLE_TIMEOUT = 30       # seconds an unused connection is kept open
+DEFAULT_CONNECT_TIMEOUT = 5
+
+# a long lived connection with several requests in flight
+# a reader thread matches responses to waiting requests by request id
+class PooledConnection:
+    def __init__(self, address, connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self.address = address
+        self.sock = socket.create_connection(address, timeout=connect_timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.closed = False
+        self.last_used = time.monotonic()
+        self.reader = threading.Thread(target=self.read_responses, daemon=True)
+        self.reader.start()
+
+    # number of requests waiting for a response
+    def in_flight(self):
+        return len(self.pending)
+
+    # send a request, returns a future for its response
+    def submit(self, message):
+        future, request_id = self.register()
+        try:
+            with self.send_lock:
+                protocol.send_message(self.sock, message, request_id)
+        except OSError as e:
+            self.close(e)
+            raise
+        return future
+
+    # start a request whose payload_len bytes of payload are written afterwards through the returned StreamWriter
+    # the connection sends nothing else until the writer is finished
+    def submit_stream(self, message, payload_len, field="data"):
+        future, request_id = self.register()
+        self.send_lock.acquire()
+        try:
+            self.sock.sendall(protocol.encode_stream_header(message, request_id, payload_len, field))
+        except OSError as e:
+            self.send_lock.release()
+            self.close(e)
+            raise
+        return StreamWriter(self, future)
+
+    # allocate a request id and the future its response will be delivered to
+    def register(self):
+        future = Future()
+        with self.pending_lock:
+            if self.closed:
+                raise ConnectionError(f"Connection to {self.address} is closed")
+            # request id 0 is never used, it marks replies to old style json requests
+            request_id = next(self.request_ids) % 0xFFFFFFFF + 1
+            self.pending[request_id] = future
+        self.last_used = time.monotonic()
+        return future, request_id
+
+    def read_responses(self):
+        error = ConnectionError(f"Connection to {self.address} closed by peer")
+        try:
+            while True:
+                request_id, response, _ = protocol.recv_message(self.sock)
+                if response is None:
+                    break
+                with self.pending_lock:
+                    future = self.pending.pop(request_id, None)
+                self.last_used = time.monotonic()
+                if future is not None:
+                    future.set_result(response)
+        except (OSError, ValueError) as e:
+            error = ConnectionError(f"Connection to {self.address} failed: {e}")
+        self.close(error)
+
+    # close the socket and fail every request still waiting on it
+    def close(self, error=None):
+        with self.pending_lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending.clear()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        for future in pending:
+            if not future.done():
+                future.set_exception(error or ConnectionError(f"Connection to {self.address} closed"))
+
+
+# payload of a streamed request, written in pieces as they become available
+class StreamWriter:
+    def __init__(self, conn, future):
+        self.conn = conn
+        self.future = future
+        self.done = False
+
+    def write(self, data):
+        try:
+            self.conn.sock.sendall(data)
+        except OSError as e:
+            self.abort(e)
+            raise
+
+    # the whole payload was written, returns the future for the response
+    def finish(self):
+        if not self.done:
+            self.done = True
+            self.conn.send_lock.release()
+        return self.future
+
+    # give up part way through, the connection can't be reused after a partial frame
+    def abort(self, error=None):
+        if not self.done:
+            self.done = True
+            self.conn.send_lock.release()
+            self.conn.close(error)
+
+
+# connections keyed by (host, port), shared by every caller in the process
+class ConnectionPool:
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, max_pipeline=DEFAULT_MAX_PIPELINE, idle_timeout=DEFAULT_IDLE_TIMEOUT, connect_timeout=DEFAULT_CONNECT_TIMEOUT, retries=1,
+                 metrics=None):
+        self.max_connections = max_connections
+        # round trips are timed into metrics as rpc.<command>, with the payload bytes sent, if given
+        self.metrics = metrics
+        self.max_pipeline = max_pipeline
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.reaper = threading.Thread(target=self.evict_idle_forever, daemon=True)
+        self.reaper.start()
+
+    # pick the least busy open connection, opening a new one when all are busy
+    def get_connection(self, address):
+        with self.lock:
+            conns = [c for c in self.connections.get(address, []) if not c.closed]
+            best = min(conns, key=PooledConnection.in_flight, default=None)
+            if best is not None and (best.in_flight() < self.max_pipeline or len(conns) >= self.max_connections):
+                self.connections[address] = conns
+                return best
+        conn = PooledConnection(address, self.connect_timeout)
+        with self.lock:
+            self.connections.setdefault(address, []).append(conn)
+        return conn
+
+    # send a request without waiting, several submits to one address share a connection
+    # a request is only sent again if sending it failed, so the node never got it whole
+    def submit(self, address, message):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.timed(self.get_connection(address).submit(message), message, protocol.payload_size(message))
+            except OSError:
+                if attempt == self.retries:
+                    raise
+
+    # start a streamed request, see PooledConnection.submit_stream
+    def submit_stream(self, address, message, payload_len, field="data"):
+        for attempt in range(self.retries + 1):
+            try:
+                writer = self.get_connection(address).submit_stream(message, payload_len, field)
+                self.timed(writer.future, message, payload_len)
+                return writer
+            except OSError:
+                if attempt == self.retries:
+                    raise
+
+    # record the round trip of a request once its response arrives
+    def timed(self, future, message, payload_len):
+        if self.metrics is not None:
+            name = f"rpc.{message.get('command')}"
+            start = time.perf_counter()
+            self.metrics.gauge(name, 1)
+            self.metrics.add("rpc_bytes_out", payload_len)
+            def done(future):
+                self.metrics.record(name, time.perf_counter() - start)
+                self.metrics.gauge(name, -1)
+                if future.exception() is not None:
+                    self.metrics.add(f"rpc_errors.{message.get('command')}")
+            future.add_done_callback(done)
+        return future
+
+    # send a request and wait for its response
+    # a connection that drops after the request was sent may have had it applied, so only commands that are safe to
+    # run twice are sent again, anything else fails with the ConnectionError and the caller finds out what happened
+    def request(self, address, message, timeout=None):
+        retries = self.retries if message.get("command") in IDEMPOTENT_COMMANDS else 0
+        for attempt in range(retries + 1):
+            try:
+                return self.submit(address, message).result(timeout)
+            except ConnectionError:
+                if attempt == retries:
+                    raise
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            idle = []
+            for address, conns in list(self.connections.items()):
+                keep = []
+                for conn in conns:
+                    if conn.closed:
+                        continue
+                    if conn.in_flight() == 0 and now - conn.last_used > self.idle_timeout:
+                        idle.append(conn)
+                    else:
+                        keep.append(conn)
+                if keep:
+                    self.connections[address] = keep
+                else:
+                    del self.connections[address]
+        for conn in idle:
+            conn.close()
+
+    def evict_idle_forever(self):
+        while True:
+            time.sleep(max(self.idle_timeout / 2, 0.1))
+            self.evict_idle()
+
+    # close every pooled connection
+    def close(self):
+        with self.lock:
+            conns = [c for conns in self.connections.values() for c in conns]
+            self.connections.clear()
+        for conn in conns:
+            conn.close()
@@ -1,89 +1,459 @@
+import argparse
+import collections
+import contextlib
 import os
-import sys
-import socket
-import json
-import base64
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from checksum import ChecksumError
+from commands import CommandTable, checked, optional
+from connpool import ConnectionPool
+from metrics import Metrics
+from namespace import parse_block_id
+from protocol import CODEC_VERSIONS, FilePayload, PAYLOAD_TYPES, set_codec
+from server import ThreadedServer, DEFAULT_WORKERS
+from storage import ENGINES
+
+# bytes received and forwarded at a time by the write pipeline
+PIPELINE_CHUNK_SIZE = 64 * 1024
+
+# seconds between heartbeats, and between full block reports unless the namenode asks for one sooner
+HEARTBEAT_INTERVAL = 3
+BLOCK_REPORT_INTERVAL = 60
+# bytes per second all re-replication copies sent by a datanode share, 0 for no limit
+DEFAULT_REPLICATION_BANDWIDTH = 10 * 1024 * 1024
+REPLICATION_THREADS = 4
+
+# a block verified this recently is read without checking its checksums again, as long as its file is unchanged
+VERIFIED_TTL = 600
+VERIFIED_CACHE_SIZE = 100000
+# the block scanner rereads every block once per SCAN_PERIOD seconds at no more than the scan bandwidth,
+# waiting up to SCAN_BACKOFF seconds before each block for foreground writes and copies to finish
+DEFAULT_SCAN_BANDWIDTH = 1024 * 1024
+SCAN_PERIOD = 6 * 3600
+SCAN_BACKOFF = 1
+
+# spaces out sends so they average at most rate bytes per second across every thread using it
+class Throttler:
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_send = time.monotonic()
+
+    # wait until n more bytes may be sent
+    def throttle(self, n):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_send, now)
+            self.next_send = start + n / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+# (start, end) of length bytes from offset within a block of size bytes, cut short at the end of the block
+def block_range(size, offset=0, length=None):
+    start = min(offset, size)
+    return start, size if length is None else min(start + length, size)
 
 class DataNode:
-    def __init__(self, ip, port):
+    commands = CommandTable("DataNode")
+
+    def __init__(self, ip, port, workers=DEFAULT_WORKERS, namenode_port=None, replication_bandwidth=DEFAULT_REPLICATION_BANDWIDTH,
+                 scan_bandwidth=DEFAULT_SCAN_BANDWIDTH, storage="sharded", sendfile=True):
         self.ip = ip
         self.port = port
-        self.blocks_available = 128
+        self.workers = workers
+        self.namenode_port = namenode_port
         self.storage_path = os.getcwd()+"/"+str(port)
+        # where the block files live, sharded directories or packed segments
+        self.storage = ENGINES[storage](self.storage_path)
+        # serve recently verified blocks straight from disk to the socket
+        self.sendfile = sendfile and hasattr(os, "sendfile")
+        # per thread chunk buffers for receiving and copying blocks
+        self.buffers = threading.local()
+
+        # request latencies and bytes moved, served by the metrics op
+        self.metrics = Metrics()
+        # connections to the next datanode in write pipelines, and to the namenode for heartbeats
+        self.pool = ConnectionPool(metrics=self.metrics)
+
+        # what the next heartbeat tells the namenode, guarded by stats_lock
+        self.stats_lock = threading.Lock()
+        self.used = self.storage.used()
+        self.load = 0           # block writes and copies running
+        self.received = []      # block ids written since the last heartbeat
+        self.deleted = []       # block ids deleted since the last heartbeat
+        self.corrupt = []       # block ids that failed checksum verification since the last heartbeat
+        # every block found corrupt and not deleted since, repeated in each full block report so a namenode that
+        # restarted learns of them again
+        self.known_corrupt = set()
 
-    # start listening on datanode port
+        # block id -> (storage version, time verified) of blocks whose checksums were checked recently, oldest first
+        self.verified = collections.OrderedDict()
+        self.verified_lock = threading.Lock()
+        self.scan_throttler = Throttler(scan_bandwidth)
+
+        # copies of blocks to other datanodes the namenode asked for, throttled to replication_bandwidth
+        self.throttler = Throttler(replication_bandwidth)
+        self.transfers = ThreadPoolExecutor(max_workers=REPLICATION_THREADS, thread_name_prefix="Replication")
+
+    # start listening on datanode port, and heartbeating if the namenode port is known
     def start(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((self.ip, self.port))
-            s.listen()
-            print(f"DataNode started at {self.ip}:{self.port}")
-            try:
-                while True:
-                    conn, addr = s.accept()
-                    print(f"Connection from {addr}")
-                    self.handle_command(conn)
-            except KeyboardInterrupt:
-                s.close()
-                print("\nProgram terminated by user.")
+        if self.namenode_port is not None:
+            threading.Thread(target=self.heartbeat_forever, daemon=True).start()
+        threading.Thread(target=self.scan_forever, daemon=True).start()
+        self.storage.start()
+        ThreadedServer(self.ip, self.port, self.process_command, self.workers, "DataNode", {"write_block": self.handle_write_block},
+                       self.metrics, self.metrics_info, self.commands.check).serve_forever()
+
+    # datanode fields of the metrics response
+    def metrics_info(self):
+        with self.stats_lock:
+            return {"used":self.used, "load":self.load, "storage":type(self.storage).__name__, "sendfile":self.sendfile}
     
-    # receive command
-    def handle_command(self, conn):
-        with conn:
-            data = conn.recv(4096)
-            command = json.loads(data.decode())
-            response = self.process_command(command)
-            conn.sendall(json.dumps(response).encode())
-
-    # process command
+    # answer a request with the handler its command is registered to
     def process_command(self, command):
-        if command["command"]=="put":
-            return self.write_new_file(command["block_id"], command["data"]) 
-        if command["command"]=="rm":
-            return self.remove_file(command["block_id"]) 
-        if command["command"]=="get":
-            return self.get_file_content(command["block_id"])
-        if command["command"]=="cat":
-            return self.get_file_content(command["block_id"])
-        if command["command"]=="block_content":
-            return self.get_file_content(command["block_id"])
-
+        return self.commands.dispatch(self, command)
 
+    @commands.command("put", {"block_id":(str, int), "data":(bytes, bytearray, memoryview)}, {"message":str})
     def write_new_file(self, block_id, data):
-        data = base64.b64decode(data)
-        local_file_path = self.storage_path+"/"+str(block_id)
-        with open(local_file_path, "wb") as f:
-            f.write(data)
+        writer = self.storage.create(str(block_id), len(data))
+        try:
+            writer.write(data)
+            writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+        self.block_received(block_id, len(data))
         return {"command":"put", "status":"success","message":"Successfully written on DataNode "+str(self.port)}
     
-    def get_file_content(self, block_id):
-        local_file_path = self.storage_path+"/"+str(block_id)
+    # stream handler for write_block, counted in the load reported to the namenode
+    # the block id names the file the block is written to, so only a well formed one is let through
+    @commands.command("write_block", {"block_id":checked(str, parse_block_id), "pipeline":optional(list)}, {"acks":list}, stream=True)
+    def handle_write_block(self, command, conn, length):
+        with self.busy():
+            return self.write_block(command, conn, length)
+
+    # write a block while forwarding it down the replication pipeline
+    # pipeline lists the downstream replicas as [datanode port, block id], each chunk is written locally and
+    # passed to the first of them as soon as it arrives, which does the same with the rest of the list,
+    # acks flow back up the chain so the response covers every replica
+    def write_block(self, command, conn, length):
+        pipeline = command.get("pipeline", [])
+        downstream = None
+        acks = []
+        if pipeline:
+            next_command = {"command":"write_block", "block_id":pipeline[0][1], "pipeline":pipeline[1:]}
+            try:
+                downstream = self.pool.submit_stream(("localhost",pipeline[0][0]), next_command, length)
+            except OSError as e:
+                acks += [{"datanode":port, "status":"error", "message":f"Pipeline to DataNode {port} could not be set up: {e}"} for port, _ in pipeline]
+
+        error = None
+        try:
+            writer = self.storage.create(str(command["block_id"]), length)
+        except OSError as e:
+            writer, error = None, e
+
+        # the whole payload is always read off the socket, even after a local error, so the connection stays usable
+        view = self.chunk_buffer()
+        remaining = length
+        try:
+            while remaining:
+                n = conn.recv_into(view[:min(len(view), remaining)])
+                if n == 0:
+                    raise ConnectionError("Connection closed in the middle of a block")
+                remaining -= n
+                if writer is not None and error is None:
+                    try:
+                        writer.write(view[:n])
+                    except OSError as e:
+                        error = e
+                if downstream is not None:
+                    try:
+                        downstream.write(view[:n])
+                    except OSError as e:
+                        downstream = None
+                        acks += [{"datanode":port, "status":"error", "message":f"Pipeline to DataNode {port} broke: {e}"} for port, _ in pipeline]
+        except OSError:
+            # the upstream went away, nothing of this block is kept here or further down
+            if downstream is not None:
+                downstream.abort()
+            if writer is not None:
+                writer.abort()
+            raise
+        if writer is not None:
+            try:
+                if error is None:
+                    writer.commit()
+                else:
+                    writer.abort()
+            except OSError as e:
+                error = e
+
+        if error is None:
+            self.block_received(command["block_id"], length)
+            acks.insert(0, {"datanode":self.port, "status":"success", "message":"Successfully written on DataNode "+str(self.port)})
+        else:
+            acks.insert(0, {"datanode":self.port, "status":"error", "message":f"Failed to write block on DataNode {self.port}: {error}"})
+        if downstream is not None:
+            try:
+                acks += downstream.finish().result()["acks"]
+            except Exception as e:
+                acks += [{"datanode":port, "status":"error", "message":f"No ack from DataNode {port}: {e}"} for port, _ in pipeline]
+
+        status = "success" if all(ack["status"]=="success" for ack in acks) else "error"
+        return {"command":"write_block", "status":status, "acks":acks, "message":"; ".join(ack["message"] for ack in acks)}
+
+    # the chunk buffer of the calling thread, reused for every block it receives or copies
+    def chunk_buffer(self):
+        view = getattr(self.buffers, "view", None)
+        if view is None:
+            view = self.buffers.view = memoryview(bytearray(PIPELINE_CHUNK_SIZE))
+        return view
+
+    # a block, or length bytes of it from offset, a recently verified block is sent with sendfile
+    # and anything else is read and checked against its checksums first
+    @commands.command("get", {"block_id":(str, int), "offset":optional(int), "length":optional(int)}, {"block":PAYLOAD_TYPES})
+    @commands.command("block_content", {"block_id":(str, int), "offset":optional(int), "length":optional(int)}, {"block":PAYLOAD_TYPES})
+    @commands.command("cat", {"block_id":(str, int)}, {"block":PAYLOAD_TYPES})
+    def get_file_content(self, block_id, offset=0, length=None):
+        if offset < 0 or (length is not None and length < 0):
+            return {"command":"get", "status":"error", "message":f"Invalid range {offset}+{length}"}
         try:
-            with open(local_file_path, "rb") as f:
-                block = f.read()
-            # base64 encoding required to send file over socket
-            block_b64 = base64.b64encode(block).decode() 
-            return {"command":"get", "status":"success","block":block_b64}
+            if self.sendfile:
+                f = self.storage.open(str(block_id))
+                if self.recently_verified(block_id, f.version):
+                    start, end = block_range(f.length, offset, length)
+                    self.metrics.add("reads.sendfile")
+                    return {"command":"get", "status":"success", "block":FilePayload(f, f.offset + start, end - start)}
+                f.close()
+            self.metrics.add("reads.verified")
+            block = self.read_block(block_id, offset=offset, length=length)
+            # block bytes travel as the raw frame payload
+            return {"command":"get", "status":"success","block":block}
+        except ChecksumError as e:
+            self.report_corrupt(block_id, e)
+            return {"command":"get", "status":"error","message":f"Corrupt block on datanode{self.port}: {e}"}
         except:
             return {"command":"get", "status":"error","message":"Block not found on datanode"+str(self.port)}
+
+    # read a block, or length bytes of it from offset, checking each piece against its checksums as it comes off disk
+    # unless the block was verified within VERIFIED_TTL, throttler paces the reads of the block scanner
+    def read_block(self, block_id, throttler=None, offset=0, length=None):
+        with self.storage.open(str(block_id)) as f:
+            start, end = block_range(f.length, offset, length)
+            read_start, read_end = start, end
+            reader = None if self.recently_verified(block_id, f.version) else f.checksum_reader()
+            if reader is not None:
+                # checksums cover whole chunks, so a range is widened to the chunks around it
+                chunk = reader.bytes_per_checksum
+                read_start, read_end = start - start % chunk, min(end + -end % chunk, f.length)
+            block = bytearray(read_end - read_start)
+            view = memoryview(block)
+            f.seek(read_start)
+            offset = 0
+            while offset < len(block):
+                n = f.readinto(view[offset:offset + PIPELINE_CHUNK_SIZE])
+                if not n:
+                    raise ChecksumError(f"Block is {read_start + offset} bytes, expected {f.length}")
+                if throttler is not None:
+                    throttler.throttle(n)
+                if reader is not None:
+                    reader.verify(view[offset:offset + n], read_start + offset, f.length)
+                offset += n
+        if reader is not None and (read_start, read_end) == (0, f.length):
+            self.mark_verified(block_id, f.version)
+        if (read_start, read_end) != (start, end):
+            return view[start - read_start:end - read_start]
+        return block
+
+    def mark_verified(self, block_id, version):
+        with self.verified_lock:
+            self.verified[block_id] = (version, time.monotonic())
+            self.verified.move_to_end(block_id)
+            while len(self.verified) > VERIFIED_CACHE_SIZE:
+                self.verified.popitem(last=False)
+
+    def recently_verified(self, block_id, version):
+        with self.verified_lock:
+            entry = self.verified.get(block_id)
+        return entry is not None and entry[0] == version and time.monotonic() - entry[1] < VERIFIED_TTL
+
+    def report_corrupt(self, block_id, error):
+        print(f"Block {block_id} is corrupt: {error}")
+        with self.verified_lock:
+            self.verified.pop(block_id, None)
+        with self.stats_lock:
+            self.corrupt.append(block_id)
+            self.known_corrupt.add(block_id)
+
+    # reread every block in the background to find corruption before a reader does
+    def scan_forever(self):
+        while True:
+            start = time.monotonic()
+            for block_id in self.storage.block_ids():
+                try:
+                    if self.recently_verified(block_id, self.storage.version(block_id)):
+                        continue
+                except OSError:
+                    continue
+                # foreground writes and copies go first
+                deadline = time.monotonic() + SCAN_BACKOFF
+                while self.load and time.monotonic() < deadline:
+                    time.sleep(0.05)
+                try:
+                    self.read_block(block_id, self.scan_throttler)
+                except ChecksumError as e:
+                    self.report_corrupt(block_id, e)
+                except OSError:
+                    # deleted while the scan was running
+                    pass
+            time.sleep(max(start + SCAN_PERIOD - time.monotonic(), 0))
     
+    @commands.command("rm", {"block_id":(str, int)}, {"message":str})
     def remove_file(self, block_id):
-        local_file_path = self.storage_path+"/"+str(block_id)
         try:
-            os.remove(local_file_path) 
-            print(f"File '{local_file_path}' deleted successfully.")
+            size = self.storage.delete(str(block_id))
+            with self.verified_lock:
+                self.verified.pop(block_id, None)
+            self.block_deleted(block_id, size)
+            print(f"Block '{block_id}' deleted successfully.")
             return {"command":"rm", "status":"success","message":"Deleted on DataNode "+str(self.port)}
-        except OSError as e:
-            {"command":"rm", "status":"error", "message":f"Failed to delete file '{local_file_path}': {e}"}
+        except (OSError, ValueError) as e:
+            return {"command":"rm", "status":"error", "message":f"Failed to delete block '{block_id}': {e}"}
 
+    # delete several blocks in one request, blocks that are already gone are skipped
+    @commands.command("rm_blocks", {"block_ids":list}, {"deleted":int, "message":str})
+    def remove_files(self, block_ids):
+        deleted = sum(self.remove_file(block_id)["status"]=="success" for block_id in block_ids)
+        return {"command":"rm_blocks", "status":"success", "deleted":deleted, "message":f"Deleted {deleted} blocks on DataNode {self.port}"}
 
-if __name__ == "__main__":
 
-    if len(sys.argv)!=3:
-        print("Correct usage: python3 datanode.py <datanode_ip> <datanode_port>\n")
-        sys.exit(1)
-    datanode_ip = sys.argv[1]
-    datanode_port = int(sys.argv[2])
+    @contextlib.contextmanager
+    def busy(self):
+        with self.stats_lock:
+            self.load += 1
+        try:
+            yield
+        finally:
+            with self.stats_lock:
+                self.load -= 1
+
+    def block_received(self, block_id, size):
+        with self.stats_lock:
+            self.used += size
+            self.received.append(block_id)
+
+    def block_deleted(self, block_id, size):
+        with self.stats_lock:
+            self.used -= size
+            self.deleted.append(block_id)
+            self.known_corrupt.discard(block_id)
+
+    # tell the namenode this datanode is up, with its capacity, load and the blocks written and deleted since the
+    # last heartbeat, then start the copies the namenode replied with
+    def heartbeat_forever(self):
+        last_report = None
+        connected = True
+        while True:
+            with self.stats_lock:
+                received, self.received = self.received, []
+                deleted, self.deleted = self.deleted, []
+                corrupt, self.corrupt = self.corrupt, []
+                heartbeat = {"command":"heartbeat", "datanode":self.port, "load":self.load, "received":received, "deleted":deleted, "corrupt":corrupt,
+                             "capacity":self.used + shutil.disk_usage(self.storage_path).free}
+            try:
+                response = self.pool.request(("localhost",self.namenode_port), heartbeat, HEARTBEAT_INTERVAL)
+                if response["status"]=="error":
+                    raise RuntimeError(response["message"])
+                if response["block_report"] or last_report is None or time.monotonic() - last_report >= BLOCK_REPORT_INTERVAL:
+                    self.block_report()
+                    last_report = time.monotonic()
+                for task in response["replicate"]:
+                    self.transfers.submit(self.transfer_block, task["block_id"], task["new_block_id"], task["target"])
+                # replicas of deleted files, replaced replicas and orphans, in batches of at most the namenode's limit
+                self.remove_files(response.get("delete", []))
+                if not connected:
+                    print("Heartbeats to NameNode resumed")
+                connected = True
+            except Exception as e:
+                # keep the changes for the next heartbeat
+                with self.stats_lock:
+                    self.received[:0] = received
+                    self.deleted[:0] = deleted
+                    self.corrupt[:0] = corrupt
+                if connected:
+                    print(f"Heartbeat to NameNode failed: {e}")
+                connected = False
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    # send the ids of every block stored here and of those of them known to be corrupt
+    def block_report(self):
+        blocks = self.storage.block_ids()
+        with self.stats_lock:
+            corrupt = list(self.known_corrupt)
+        response = self.pool.request(("localhost",self.namenode_port), {"command":"block_report", "datanode":self.port, "blocks":blocks, "corrupt":corrupt},
+                                     HEARTBEAT_INTERVAL * 10)
+        if response["status"]=="error":
+            raise RuntimeError(response["message"])
+
+    # copy a block to another datanode for re-replication, stored there as new_block_id
+    # the block is verified as it is sent so a corrupt replica is never copied
+    def transfer_block(self, block_id, new_block_id, target):
+        try:
+            with self.busy(), self.storage.open(str(block_id)) as f:
+                length = f.length
+                reader = None if self.recently_verified(block_id, f.version) else f.checksum_reader()
+                writer = self.pool.submit_stream(("localhost",target), {"command":"write_block", "block_id":new_block_id, "pipeline":[]}, length)
+                view = self.chunk_buffer()
+                offset = 0
+                try:
+                    while True:
+                        n = f.readinto(view)
+                        if not n:
+                            break
+                        if reader is not None:
+                            reader.verify(view[:n], offset, length)
+                        offset += n
+                        self.throttler.throttle(n)
+                        writer.write(view[:n])
+                except BaseException as e:
+                    writer.abort(e)
+                    raise
+                response = writer.finish().result()
+            if response["status"]=="error":
+                raise RuntimeError(response["message"])
+            print(f"Copied block {block_id} to DataNode {target}")
+        except ChecksumError as e:
+            self.report_corrupt(block_id, e)
+        except Exception as e:
+            print(f"Failed to copy block {block_id} to DataNode {target}: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="python3 datanode.py <datanode_ip> <datanode_port> [<namenode_port>] [--workers N] [--replication-bandwidth BYTES] [--scan-bandwidth BYTES] [--storage sharded|packed] [--no-sendfile] [--codec json|msgpack] [--check-responses]")
+    parser.add_argument("datanode_ip")
+    parser.add_argument("datanode_port", type=int)
+    parser.add_argument("namenode_port", type=int, nargs="?", help="namenode to send heartbeats and block reports to")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="number of threads serving block requests")
+    parser.add_argument("--replication-bandwidth", type=int, default=DEFAULT_REPLICATION_BANDWIDTH, help="bytes per second for re-replication copies, 0 for no limit")
+    parser.add_argument("--scan-bandwidth", type=int, default=DEFAULT_SCAN_BANDWIDTH, help="bytes per second the background block scanner reads, 0 for no limit")
+    parser.add_argument("--storage", choices=sorted(ENGINES), default="sharded",
+                        help="block files in hashed subdirectories, or small blocks packed into segment files")
+    parser.add_argument("--no-sendfile", dest="sendfile", action="store_false",
+                        help="read every block through user space and check its checksums, rather than sending verified blocks with sendfile")
+    parser.add_argument("--codec", choices=sorted(CODEC_VERSIONS), default="json", help="encoding of the request headers this process sends, msgpack needs the msgpack package")
+    parser.add_argument("--check-responses", action="store_true", help="check every response against its command's declared schema, for testing")
+    args = parser.parse_args()
+    try:
+        set_codec(args.codec)
+    except ValueError as e:
+        parser.error(str(e))
+    DataNode.commands.check_responses = args.check_responses
     
-    datanode = DataNode(datanode_ip, datanode_port)
-    datanode.start()
\ No newline at end of file
+    datanode = DataNode(args.datanode_ip, args.datanode_port, args.workers, args.namenode_port, args.replication_bandwidth, args.scan_bandwidth,
+                        args.storage, args.sendfile)
+    datanode.start()
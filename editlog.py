@@ -0,0 +1,114 @@
+import json
+import os
+import threading
+
+# append-only log of namespace edits, one json record per line
+# records are buffered by log() and made durable by sync(), the first waiting thread
+# writes and fsyncs everything buffered so far on behalf of all the others (group commit)
+#
+# the log is split into segments: edits_inprogress.log takes new records and roll() closes it
+# as edits_<last txid>.log, segments already covered by a checkpoint are removed by purge()
+class EditLog:
+    def __init__(self, directory="."):
+        self.directory = directory
+        self.current_path = os.path.join(directory, "edits_inprogress.log")
+        self.file = None
+        self.lock = threading.Condition(threading.Lock())
+        self.buffer = bytearray()
+        self.txid = 0           # last txid handed out
+        self.synced_txid = 0    # last txid known to be on disk
+        self.syncing = False
+        self.syncs = 0
+        self.local = threading.local()
+
+    # closed segments, oldest first, as (last txid, path)
+    def segments(self):
+        found = []
+        for name in os.listdir(self.directory):
+            if name.startswith("edits_") and name.endswith(".log") and name != "edits_inprogress.log":
+                found.append((int(name[len("edits_"):-len(".log")]), os.path.join(self.directory, name)))
+        return sorted(found)
+
+    # yield the edits newer than from_txid, a torn record at the end of the log is dropped
+    def replay(self, from_txid):
+        self.txid = from_txid
+        paths = [path for _, path in self.segments()]
+        if os.path.exists(self.current_path):
+            paths.append(self.current_path)
+        for path in paths:
+            with open(path, "rb") as f:
+                good_offset = 0
+                for line in f:
+                    try:
+                        edit = json.loads(line)
+                    except ValueError:
+                        break
+                    good_offset += len(line)
+                    if edit["txid"] > from_txid:
+                        self.txid = edit["txid"]
+                        yield edit
+            if path == self.current_path and good_offset != os.path.getsize(path):
+                with open(path, "r+b") as f:
+                    f.truncate(good_offset)
+        self.synced_txid = self.txid
+
+    # open the in-progress segment for appending
+    def open(self):
+        self.file = open(self.current_path, "ab")
+
+    # buffer an edit, returns its txid, the edit is durable once sync() covers that txid
+    def log(self, edit):
+        with self.lock:
+            self.txid += 1
+            record = {"txid": self.txid}
+            record.update(edit)
+            self.buffer += json.dumps(record, separators=(",", ":")).encode() + b"\n"
+            self.local.txid = self.txid
+            return self.txid
+
+    # wait until txid (by default the last edit logged by this thread) is on disk
+    def sync(self, txid=None):
+        if txid is None:
+            txid = getattr(self.local, "txid", 0)
+        with self.lock:
+            while self.synced_txid < txid:
+                if self.syncing:
+                    self.lock.wait()
+                    continue
+                self.syncing = True
+                data, self.buffer = self.buffer, bytearray()
+                last = self.txid
+                self.lock.release()
+                try:
+                    self.file.write(data)
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                finally:
+                    self.lock.acquire()
+                    self.syncing = False
+                    self.lock.notify_all()
+                self.synced_txid = last
+                self.syncs += 1
+
+    # close the in-progress segment and start a new one, returns the last txid of the closed segment
+    # callers must stop new edits from being logged while this runs
+    def roll(self):
+        self.sync(self.txid)
+        with self.lock:
+            last = self.txid
+            self.file.close()
+            if os.path.getsize(self.current_path) > 0:
+                os.replace(self.current_path, os.path.join(self.directory, f"edits_{last:020d}.log"))
+            self.file = open(self.current_path, "ab")
+            return last
+
+    # remove closed segments whose edits are all covered by a checkpoint at txid
+    def purge(self, txid):
+        for last, path in self.segments():
+            if last <= txid:
+                os.remove(path)
+
+    def close(self):
+        self.sync(self.txid)
+        with self.lock:
+            self.file.close()
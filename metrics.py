@@ -0,0 +1,193 @@
+import collections
+import contextlib
+import math
+import os
+import sys
+import threading
+import time
+
+# latency histograms have SUB_BUCKETS buckets for every power of two microseconds, so a recorded
+# value is off by at most 1 / SUB_BUCKETS of itself, from 1 microsecond up to MAX_EXPONENT powers of two
+SUB_BUCKETS = 16
+MAX_EXPONENT = 40
+HISTOGRAM_PERCENTILES = {"p50_ms": 0.50, "p90_ms": 0.90, "p99_ms": 0.99, "p999_ms": 0.999}
+
+# sampling profiler defaults: seconds between samples and frames kept per stack
+PROFILE_INTERVAL = 0.005
+PROFILE_DEPTH = 40
+PROFILE_TOP = 30
+
+
+# counts of durations in log-linear buckets, in the spirit of an HDR histogram, recording is a few arithmetic ops
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * ((MAX_EXPONENT + 1) * SUB_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def bucket(micros):
+        if micros < 1:
+            return 0
+        mantissa, exponent = math.frexp(micros)
+        return min(exponent * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS), (MAX_EXPONENT + 1) * SUB_BUCKETS - 1)
+
+    # the middle of a bucket in microseconds
+    @staticmethod
+    def value(bucket):
+        exponent, sub = divmod(bucket, SUB_BUCKETS)
+        return math.ldexp(0.5 + (sub + 0.5) / (2 * SUB_BUCKETS), exponent)
+
+    def record(self, seconds):
+        bucket = self.bucket(seconds * 1e6)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def snapshot(self):
+        with self.lock:
+            counts = list(self.counts)
+            count, total, largest = self.count, self.total, self.max
+        result = {"count":count, "mean_ms":round(total / count * 1000, 3) if count else None}
+        targets = iter(sorted(HISTOGRAM_PERCENTILES.items(), key=lambda item: item[1]))
+        name, p = next(targets)
+        seen = 0
+        for bucket, n in enumerate(counts):
+            seen += n
+            while name is not None and n and seen >= p * count:
+                result[name] = round(min(self.value(bucket) / 1000, largest * 1000), 3)
+                name, p = next(targets, (None, None))
+            if name is None:
+                break
+        for name in HISTOGRAM_PERCENTILES:
+            result.setdefault(name, None)
+        result["max_ms"] = round(largest * 1000, 3) if count else None
+        return result
+
+
+# latency histograms, counters and in-flight gauges of one process, by name
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = collections.Counter()
+        self.gauges = collections.Counter()
+        self.started = time.time()
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def record(self, name, seconds):
+        self.histogram(name).record(seconds)
+
+    def add(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def gauge(self, name, delta):
+        with self.lock:
+            self.gauges[name] += delta
+
+    # time the body into histogram name, counting it in the in_flight gauge of the same name while it runs
+    @contextlib.contextmanager
+    def track(self, name):
+        self.gauge(name, 1)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+            self.gauge(name, -1)
+
+    def snapshot(self):
+        with self.lock:
+            histograms = dict(self.histograms)
+            counters = dict(self.counters)
+            gauges = {name: value for name, value in self.gauges.items() if value}
+        return {"pid":os.getpid(), "uptime_s":round(time.time() - self.started, 1), "counters":counters, "in_flight":gauges,
+                "latency":{name: histogram.snapshot() for name, histogram in sorted(histograms.items())}}
+
+
+# samples the stacks of every thread in the process every interval seconds while running,
+# started and stopped at runtime, report gives the hottest stacks in folded form ("outer;inner;leaf") and functions
+class SamplingProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stacks = collections.Counter()
+        self.leaves = collections.Counter()
+        self.samples = 0
+        self.interval = PROFILE_INTERVAL
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # start sampling with fresh counts, does nothing if already running
+    def start(self, interval=PROFILE_INTERVAL):
+        with self.lock:
+            if self.running:
+                return False
+            self.stacks.clear()
+            self.leaves.clear()
+            self.samples = 0
+            self.interval = interval
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.sample_forever, daemon=True, name="Profiler")
+            self.thread.start()
+            return True
+
+    def stop(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is None:
+            return False
+        self.stop_event.set()
+        thread.join()
+        return True
+
+    def sample_forever(self):
+        me = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                self.samples += 1
+                for thread_id, frame in frames.items():
+                    if thread_id == me:
+                        continue
+                    names = []
+                    while frame is not None and len(names) < PROFILE_DEPTH:
+                        code = frame.f_code
+                        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                        frame = frame.f_back
+                    self.leaves[names[0]] += 1
+                    self.stacks[";".join(reversed(names))] += 1
+
+    def report(self, limit=PROFILE_TOP):
+        with self.lock:
+            return {"running":self.running, "samples":self.samples, "interval_s":self.interval,
+                    "stacks":self.stacks.most_common(limit), "functions":self.leaves.most_common(limit)}
+
+    # handle a profile request: action is start, stop or report
+    def command(self, command):
+        action = command.get("action", "report")
+        if action == "start":
+            started = self.start(command.get("interval", PROFILE_INTERVAL))
+            return {"command":"profile", "status":"success", "message":"Profiler started" if started else "Profiler already running"}
+        if action == "stop":
+            stopped = self.stop()
+            return dict(self.report(command.get("limit", PROFILE_TOP)), command="profile", status="success",
+                        message="Profiler stopped" if stopped else "Profiler was not running")
+        if action == "report":
+            return dict(self.report(command.get("limit", PROFILE_TOP)), command="profile", status="success", message="Profile")
+        return {"command":"profile", "status":"error", "message":f"Unknown profile action {action!r}"}
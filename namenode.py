@@ -1,185 +1,896 @@
-import socket
+import argparse
+import itertools
 import json
-import sys
-import random
+import os
+import threading
+import time
 import uuid
-import socket
+from commands import CommandTable, optional
+from connpool import ConnectionPool
+from editlog import EditLog
+from metrics import Metrics
+from namespace import REPLICA, INodeDirectory, Namespace, format_block_id, parse_block_id
+from placement import NodeStats, POLICIES, DEFAULT_CAPACITY, DEFAULT_RACK
+from protocol import CODEC_VERSIONS, set_codec
+from server import ThreadedServer, DEFAULT_WORKERS
+
+# a checkpoint is taken once this many edits were logged, or after the period if there were any
+CHECKPOINT_TXNS = 10000
+CHECKPOINT_PERIOD = 60
+
+DEFAULT_PLACEMENT = "least-loaded"
+DEFAULT_REPLICATION = 2
+# space reserved for an allocated file is given back if its put_update hasn't arrived after this many seconds,
+# a put_update that comes later is refused, its blocks may already have been deleted as orphans
+ALLOCATION_TIMEOUT = 600
+# an append holds a lease on its file from allocation to commit, which the writer renews while it sends blocks
+# a lease not renewed for LEASE_SOFT_LIMIT seconds can be recovered by another writer's append, and after
+# LEASE_HARD_LIMIT seconds it is recovered in the background
+LEASE_SOFT_LIMIT = 60
+LEASE_HARD_LIMIT = ALLOCATION_TIMEOUT
+
+# a datanode that hasn't sent a heartbeat for STALE_INTERVAL seconds is read from last,
+# after DEAD_INTERVAL it is dead: no new blocks go to it, reads skip it and its blocks are re-replicated
+STALE_INTERVAL = 10
+DEAD_INTERVAL = 30
+# how often the re-replication scheduler runs, how many copies a datanode sends at once,
+# and how long a copy may take before it is given to another datanode
+REPLICATION_INTERVAL = 3
+MAX_REPLICATION_STREAMS = 2
+REPLICATION_TIMEOUT = 60
+
+# replicas of deleted files are queued per datanode and handed out at most INVALIDATE_LIMIT at a time, with heartbeat
+# replies or, to datanodes that don't send heartbeats, in rm_blocks requests every INVALIDATE_INTERVAL seconds
+INVALIDATE_LIMIT = 1000
+INVALIDATE_INTERVAL = 3
+# a block a datanode reports that the namespace doesn't know is deleted once it has stayed unknown this long,
+# blocks of puts and appends still being written are never taken for orphans, their allocations and leases time out instead
+ORPHAN_GRACE = ALLOCATION_TIMEOUT
+
+# most entries a listing returns at once
+LISTING_LIMIT = 1000
+# most files a put_batch or put_update_batch may carry
+BATCH_LIMIT = 1000
+
+# bytes per block for files put without their own block size, and the range a file may ask for
+# a block is held in memory whole by the client and datanodes while it is written or read
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+MIN_BLOCK_SIZE = 512
+MAX_BLOCK_SIZE = 256 * 1024 * 1024
+
+# the right of one writer to append to a file, from the append that allocated its blocks to the append_update that commits them
+# file is the inode the append was allocated for, locations are [datanode port, block id] replicas per partition from
+# first_partition on and allocated the (datanode ports, block size) reservations made for them
+class Lease:
+    def __init__(self, holder, file, first_partition, locations, allocated):
+        self.id = uuid.uuid4().hex
+        self.holder = holder
+        self.file = file
+        self.first_partition = first_partition
+        self.locations = locations
+        self.allocated = allocated
+        self.renewed = time.monotonic()
 
 class NameNode:
-    def __init__(self, ip, port, datanode_ports):
+    commands = CommandTable("Namenode")
+
+    def __init__(self, ip, port, datanode_ports, workers=DEFAULT_WORKERS, checkpoint_txns=CHECKPOINT_TXNS, checkpoint_period=CHECKPOINT_PERIOD,
+                 placement=DEFAULT_PLACEMENT, replication=DEFAULT_REPLICATION, racks=None, capacity=DEFAULT_CAPACITY,
+                 dead_interval=DEAD_INTERVAL, block_size=DEFAULT_BLOCK_SIZE, orphan_grace=ORPHAN_GRACE):
         self.ip = ip
         self.port = port
         self.datanodes = datanode_ports
+        self.workers = workers
+        self.replication = replication
+        self.block_size = block_size
+
+        # per datanode usage, filled in from the namespace below and kept up to date by apply_edit
+        racks = racks or {}
+        self.placement = POLICIES[placement]([NodeStats(dn, racks.get(dn, DEFAULT_RACK), capacity) for dn in datanode_ports])
+        # file path -> [(allocation time, [(datanode ports, block size)], block ids)] for puts not committed yet
+        # allocations aren't logged, a put whose allocation a restart lost has to be made again
+        self.allocations = {}
+        # file path -> Lease of the append in progress on it, leases aren't logged so a restart recovers them all
+        self.leases = {}
+        # ids of the blocks of allocations and leases, written or about to be, that block reports mustn't take for orphans
+        self.writing_blocks = set()
+
+        # block id -> file inode and datanode port -> block ids, kept up to date by apply_edit
+        # block ids are 128-bit ints inside the namenode and uuid strings on the wire
+        self.block_index = {}
+        self.node_blocks = {dn: set() for dn in datanode_ports}
+        # block ids each datanode reported holding, None until its first full block report
+        self.reported = {dn: None for dn in datanode_ports}
+        # replicas absent from one full block report, they are missing if the next one doesn't have them either
+        self.report_suspects = {dn: set() for dn in datanode_ports}
+        # replicas found missing from their datanode or reported corrupt by it, they don't count towards the replication factor
+        # a missing replica that shows up in a later block report counts again, a corrupt one stays corrupt, and is
+        # learnt again from its datanode's block report after a restart
+        self.missing_replicas = set()
+        self.corrupt_replicas = set()
+        # (file inode, partition) of blocks that may have fewer live replicas than their file's rf
+        self.needed_replication = set()
+        # new block id -> (file inode, partition, source port, target port, size, deadline) for copies in progress
+        self.pending_replications = {}
+        # datanode port -> copies it should start, handed out with the reply to its next heartbeat
+        self.replication_work = {dn: [] for dn in datanode_ports}
+        # datanode port -> ids of replicas it should delete, of deleted files, replaced replicas and orphans
+        # filled in by apply_edit, so replaying the edit log queues again what a restart lost
+        self.invalidate_work = {dn: [] for dn in datanode_ports}
+        # datanode port -> {block id: when it was first reported} for blocks it holds that the namespace doesn't know
+        self.orphans = {dn: {} for dn in datanode_ports}
+        self.orphan_grace = orphan_grace
+        self.dead_interval = dead_interval
 
+        # guards the namespace, handlers run on several threads
+        self.lock = threading.RLock()
+
+        # request latencies and counters, served by the metrics op
+        self.metrics = Metrics()
+        # persistent connections to the datanodes, shared by all handler threads
+        self.pool = ConnectionPool(metrics=self.metrics)
+
+        # metadata.json is the last checkpoint (fsimage), edits logged after it are replayed on top
         with open("metadata.json","r") as f:
             metadata = json.load(f)            
         
-        self.file_metadata = metadata["file"]   
-        self.directory_metadata = metadata["dir"]
-        
-        self.block_size = 2048
+        self.namespace = Namespace.from_image(metadata)
+        # invalidations still queued at the last checkpoint
+        for port, block_ids in metadata.get("invalidate", {}).items():
+            if int(port) in self.invalidate_work:
+                self.invalidate_work[int(port)].extend(block_ids)
+        # directory generations restart from zero with the process, the epoch keeps listings from before a restart from matching
+        self.epoch = uuid.uuid4().hex[:8]
+        self.checkpoint_txid = metadata.get("txid", 0)
+        for _, file in self.namespace.files():
+            self.track_blocks(file, file.iter_replicas(), 1)
+
+        self.edit_log = EditLog()
+        for edit in self.edit_log.replay(self.checkpoint_txid):
+            self.apply_edit(edit)
+        self.edit_log.open()
+
+        # background checkpointing compacts the edit log into metadata.json
+        self.checkpoint_txns = checkpoint_txns
+        self.checkpoint_period = checkpoint_period
+        self.last_checkpoint = time.monotonic()
+        threading.Thread(target=self.checkpoint_forever, daemon=True).start()
+        threading.Thread(target=self.replicate_forever, daemon=True).start()
+        threading.Thread(target=self.invalidate_forever, daemon=True).start()
 
     # start listening on namenode port
     def start(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((self.ip, self.port))
-            s.listen()
-            print(f"NameNode started at {self.ip}:{self.port}")
-            try:
-                while True:
-                    conn, addr = s.accept()
-                    print(f"Connection from {addr}")
-                    self.handle_client(conn)
-
-            except KeyboardInterrupt:
-                s.close()
-                print("\nProgram terminated by user.")
+        ThreadedServer(self.ip, self.port, self.process_command, self.workers, "NameNode", metrics=self.metrics, info=self.metrics_info).serve_forever()
+        self.checkpoint()
         
-    # receive command from client
-    def handle_client(self, conn):
-        with conn:
-            data = conn.recv(4096)
-            command = json.loads(data)
-            response = self.process_command(command)
-            conn.sendall(json.dumps(response).encode())
-
     # process command
     def process_command(self, command):
-        if command["command"]=="put":
-            return self.write_new_file(command["file_path"], command["file_size"]) 
-        if command["command"]=="put_update":
-            return self.write_new_file_update_metadata(command["file_path"],command["file_size"],command["locations"],command["block_sizes"])
-        if command["command"]=="ls":
-            return self.ls(command["path"])
-        if command["command"]=="rm":
-            return self.remove_file(command["path"])
-        if command["command"]=="mkdir":
-            return self.make_directory(command["path"])
-        if command["command"]=="rmdir":
-            return self.remove_directory(command["path"])
-        if command["command"]=="get":
-            return self.get_block_locations(command["file_path"])
-        if command["command"]=="cat":
-            return self.get_block_locations(command["file_path"])
-        if command["command"]=="blocks_metadata":
-            return self.blocks_metadata(command["file_path"])
-        
-    # send command to datanode
-    def send_to_datanode(self, command, dn_port):
+        start = time.perf_counter()
+        with self.lock:
+            self.metrics.record("namenode.lock_wait", time.perf_counter() - start)
+            response = self.commands.dispatch(self, command)
+        # wait for this thread's edits to reach the edit log outside the lock, so syncs are shared
+        with self.metrics.track("namenode.edit_log_sync"):
+            self.edit_log.sync()
+        return response
+
+    # namenode fields of the metrics response: the datanodes as last heard from, for the web ui to query them in turn
+    def metrics_info(self):
+        now = time.monotonic()
+        return {"txid":self.edit_log.txid, "leases":len(self.leases), "datanodes":[{"port":node.port, "alive":node.alive, "load":node.load, "used":node.used, "capacity":node.capacity,
+                                                          "last_heartbeat_s":None if node.last_heartbeat is None else round(now - node.last_heartbeat, 1)}
+                                                         for node in self.placement.nodes.values()]}
+
+    # log an edit and apply it to the in-memory namespace, callers hold self.lock
+    def log_edit(self, edit):
+        self.edit_log.log(edit)
+        self.apply_edit(edit)
+
+    # apply an edit to the in-memory namespace, used both for new edits and edit log replay
+    # a batch is one record holding several edits, so it is replayed whole or, if it was torn, not at all
+    def apply_edit(self, edit):
+        if edit["op"]=="batch":
+            for sub_edit in edit["edits"]:
+                self.apply_edit(sub_edit)
+            return
+        path = edit["path"]
+        if edit["op"]=="add_file":
+            file = self.namespace.add_file(path, edit["file"])
+            self.track_blocks(file, file.iter_replicas(), 1)
+        elif edit["op"]=="delete_file":
+            file = self.namespace.delete_file(path)
+            self.track_blocks(file, file.iter_replicas(), -1)
+            self.invalidate(file.iter_replicas())
+        elif edit["op"]=="add_replica":
+            file = self.namespace.get_file(path)
+            block = edit["block"]
+            replica = (parse_block_id(block["id"]), block["partition"], block["datanode"], block["num_bytes"])
+            file.add_replica(*replica)
+            self.track_blocks(file, [replica], 1)
+        elif edit["op"]=="remove_replica":
+            file = self.namespace.get_file(path)
+            replica = file.remove_replica(parse_block_id(edit["id"]))
+            self.track_blocks(file, [replica], -1)
+            self.invalidate([replica])
+        elif edit["op"]=="append":
+            file = self.namespace.get_file(path)
+            first = edit["first_partition"]
+            replicas = [(parse_block_id(b["id"]), b["partition"], b["datanode"], b["num_bytes"]) for b in edit["blocks"]]
+            dropped = file.replace_partitions(first, replicas)
+            file.size = edit["size"]
+            # listings show sizes, so a cached listing of the directory is stale now
+            self.namespace.touch(file.parent)
+            self.track_blocks(file, dropped, -1)
+            self.invalidate(dropped)
+            self.track_blocks(file, replicas, 1)
+            # a copy of a replaced block still in flight would land among the new blocks' replicas
+            for block_id, (pending_file, partition, _, target, size, _) in list(self.pending_replications.items()):
+                if pending_file is file and partition >= first:
+                    del self.pending_replications[block_id]
+                    self.placement.release([target], size)
+        elif edit["op"]=="mkdir":
+            self.namespace.mkdir(path)
+        elif edit["op"]=="rmdir":
+            self.namespace.rmdir(path)
+
+    # add (sign 1) or remove (sign -1) (block id, partition, datanode, num_bytes) replicas of a file from the
+    # datanode usage placement works from and from the block indexes heartbeats and re-replication work from
+    def track_blocks(self, file, replicas, sign):
+        for block_id, _, datanode, num_bytes in replicas:
+            self.placement.add_used(datanode, sign * num_bytes)
+            if sign > 0:
+                self.block_index[block_id] = file
+                self.node_blocks.setdefault(datanode, set()).add(block_id)
+            else:
+                self.block_index.pop(block_id, None)
+                self.node_blocks.get(datanode, set()).discard(block_id)
+                self.missing_replicas.discard(block_id)
+                self.corrupt_replicas.discard(block_id)
+
+    # queue (block id, partition, datanode, num_bytes) replicas for deletion on their datanodes
+    # a dead datanode's deletes wait until it is back
+    def invalidate(self, replicas):
+        for block_id, _, datanode, _ in replicas:
+            if datanode in self.invalidate_work:
+                self.invalidate_work[datanode].append(format_block_id(block_id))
+
+    # take up to INVALIDATE_LIMIT queued deletes of a datanode
+    def take_invalidations(self, port):
+        queue = self.invalidate_work[port]
+        batch, self.invalidate_work[port] = queue[:INVALIDATE_LIMIT], queue[INVALIDATE_LIMIT:]
+        return batch
+
+    # send queued deletes to live datanodes that don't send heartbeats, a batch that fails is queued again
+    def invalidate_forever(self):
+        while True:
+            time.sleep(INVALIDATE_INTERVAL)
+            with self.lock:
+                batches = {port: self.take_invalidations(port) for port, node in self.placement.nodes.items()
+                           if node.alive and node.last_heartbeat is None and self.invalidate_work.get(port)}
+            pending = []
+            for port, block_ids in batches.items():
+                try:
+                    pending.append((port, block_ids, self.pool.submit(("localhost",port), {"command":"rm_blocks", "block_ids":block_ids})))
+                except OSError as e:
+                    pending.append((port, block_ids, None))
+                    print(f"Error sending command to DataNode: {e}")
+            for port, block_ids, future in pending:
+                try:
+                    if future is not None and future.result()["status"]=="success":
+                        continue
+                except Exception as e:
+                    print(f"Error sending command to DataNode: {e}")
+                with self.lock:
+                    self.invalidate_work[port][:0] = block_ids
+
+    # block ids a datanode sent as ints, files in its storage that aren't blocks are skipped
+    @staticmethod
+    def parse_block_ids(block_ids):
+        parsed = []
+        for block_id in block_ids:
+            try:
+                parsed.append(parse_block_id(block_id))
+            except ValueError:
+                pass
+        return parsed
+
+    # the ids of the blocks in [datanode port, block id] replicas per partition, raises ValueError if they aren't
+    @staticmethod
+    def location_block_ids(locations):
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect(("localhost",dn_port))
-                s.sendall(json.dumps(command).encode())              
-                response = s.recv(4096)
-                return json.loads(response)
-        except Exception as e:
-            print(f"Error sending command to DataNode: {e}")
-            return {"status": "error", "message": str(e)}
-            
+            return frozenset(parse_block_id(block_id) for partition in locations for _, block_id in partition)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid block locations: {e}")
+
+    # give back the (datanode ports, block size) reservations of an allocation or lease and stop protecting its blocks
+    def release_blocks(self, allocated, block_ids):
+        for ports, size in allocated:
+            self.placement.release(ports, size)
+        self.writing_blocks -= block_ids
+
+    # give back the space of allocations whose put_update never came
+    def expire_allocations(self):
+        deadline = time.monotonic() - ALLOCATION_TIMEOUT
+        for path, pending in list(self.allocations.items()):
+            while pending and pending[0][0] < deadline:
+                _, allocated, block_ids = pending.pop(0)
+                self.release_blocks(allocated, block_ids)
+            if not pending:
+                del self.allocations[path]
+
+    # give up an append: release the space its lease reserved and delete whatever blocks the writer got to write
+    def recover_lease(self, file_path):
+        lease = self.leases.pop(file_path)
+        self.release_blocks(lease.allocated, self.location_block_ids(lease.locations))
+        for partition in lease.locations:
+            for port, block_id in partition:
+                if port in self.invalidate_work:
+                    self.invalidate_work[port].append(block_id)
+
+    # recover the leases whose writers have been silent for LEASE_HARD_LIMIT seconds
+    def expire_leases(self):
+        now = time.monotonic()
+        for file_path, lease in list(self.leases.items()):
+            if now - lease.renewed > LEASE_HARD_LIMIT:
+                print(f"Recovering the lease of {lease.holder} on {file_path}, not renewed for {now - lease.renewed:.0f}s")
+                self.recover_lease(file_path)
+
+    # a datanode reports it is up, with its capacity, load and the blocks it received, deleted or found corrupt since its last heartbeat
+    # the reply carries the copies it should make, the replicas it should delete and whether the namenode needs a full block report
+    @commands.command("heartbeat", {"datanode":int, "load":optional(int), "capacity":optional(int), "received":optional(list), "deleted":optional(list), "corrupt":optional(list)},
+                      {"replicate":list, "delete":list, "block_report":bool})
+    def heartbeat(self, datanode, load=0, capacity=None, received=(), deleted=(), corrupt=()):
+        node = self.placement.nodes.get(datanode)
+        if node is None:
+            return {"command":"heartbeat", "status":"error", "message":f"Namenode Error: Unknown DataNode {datanode}"}
+        if not node.alive:
+            print(f"DataNode {datanode} is back")
+            # what it holds may have changed while it was gone
+            self.reported[datanode] = None
+        node.alive = True
+        node.last_heartbeat = time.monotonic()
+        node.load = load
+        if capacity:
+            node.capacity = capacity
+
+        reported = self.reported[datanode]
+        for block_id in self.parse_block_ids(deleted):
+            if reported is not None:
+                reported.discard(block_id)
+        for block_id in self.parse_block_ids(received):
+            if reported is not None:
+                reported.add(block_id)
+            self.missing_replicas.discard(block_id)
+            if block_id in self.pending_replications:
+                self.replication_done(block_id, datanode)
+        self.mark_corrupt(datanode, corrupt)
+
+        work, self.replication_work[datanode] = self.replication_work[datanode], []
+        delete = self.take_invalidations(datanode)
+        return {"command":"heartbeat", "status":"success", "replicate":work, "delete":delete, "block_report":reported is None}
+
+    # a datanode's full list of the blocks it holds
+    # replicas the namespace places on it that are absent from two reports in a row are missing and get re-replicated,
+    # blocks it holds that the namespace has no replica for are orphans and are deleted once they are older than orphan_grace,
+    # corrupt lists those of its blocks it has found corrupt, so corruption reported before a restart isn't forgotten
+    @commands.command("block_report", {"datanode":int, "blocks":list, "corrupt":optional(list)})
+    def block_report(self, datanode, blocks, corrupt=()):
+        if datanode not in self.reported:
+            return {"command":"block_report", "status":"error", "message":f"Namenode Error: Unknown DataNode {datanode}"}
+        reported = set(self.parse_block_ids(blocks))
+        self.reported[datanode] = reported
+        absent = self.node_blocks.get(datanode, set()) - reported
+        missing = absent & self.report_suspects[datanode]
+        self.report_suspects[datanode] = absent - missing
+        self.missing_replicas -= self.node_blocks.get(datanode, set()) & reported
+        for block_id in missing:
+            if block_id not in self.missing_replicas:
+                print(f"Block {format_block_id(block_id)} is missing from DataNode {datanode}")
+                self.missing_replicas.add(block_id)
+                self.need_replication(block_id)
+
+        now = time.monotonic()
+        first_seen = self.orphans[datanode]
+        orphans = {block_id: first_seen.get(block_id, now) for block_id in reported
+                   if block_id not in self.block_index and block_id not in self.pending_replications and block_id not in self.writing_blocks}
+        expired = [block_id for block_id, seen in orphans.items() if now - seen >= self.orphan_grace]
+        for block_id in expired:
+            del orphans[block_id]
+        self.orphans[datanode] = orphans
+        if expired:
+            print(f"Deleting {len(expired)} orphaned blocks from DataNode {datanode}")
+            self.invalidate((block_id, 0, datanode, 0) for block_id in expired)
+        self.mark_corrupt(datanode, corrupt)
+        return {"command":"block_report", "status":"success"}
+
+    # stop counting replicas a datanode found corrupt and re-replicate their blocks
+    def mark_corrupt(self, datanode, block_ids):
+        for block_id in self.parse_block_ids(block_ids):
+            if block_id in self.node_blocks.get(datanode, ()) and block_id not in self.corrupt_replicas:
+                print(f"Block {format_block_id(block_id)} on DataNode {datanode} is corrupt")
+                self.corrupt_replicas.add(block_id)
+                self.need_replication(block_id)
+
+    # whether a (block id, partition, datanode, num_bytes) replica counts towards its file's replication factor
+    def replica_live(self, replica):
+        block_id, _, datanode, _ = replica
+        node = self.placement.nodes.get(datanode)
+        return node is not None and node.alive and block_id not in self.missing_replicas and block_id not in self.corrupt_replicas
+
+    # queue the partition a replica belongs to for a replication check
+    def need_replication(self, block_id):
+        file = self.block_index.get(block_id)
+        if file is None:
+            return
+        partition = next(partition for replica_id, partition, _, _ in file.iter_replicas() if replica_id==block_id)
+        self.needed_replication.add((file, partition))
+
+    # a copy made for re-replication arrived on its target, record it and drop replicas it replaced,
+    # the ones on datanodes still up are corrupt or missing and are deleted there
+    def replication_done(self, block_id, port):
+        file, partition, _, target, size, _ = self.pending_replications.pop(block_id)
+        self.placement.release([target], size)
+        # a file deleted in the meantime is detached from the tree
+        if file.parent is None or port != target:
+            return
+        path = self.namespace.path_of(file)
+        self.log_edit({"op":"add_replica", "path":path, "block":{"id":format_block_id(block_id), "partition":partition, "datanode":port, "num_bytes":size}})
+        replicas = [replica for replica in file.iter_replicas() if replica[1]==partition]
+        if sum(map(self.replica_live, replicas)) >= file.rf:
+            for replica in replicas:
+                if not self.replica_live(replica):
+                    self.log_edit({"op":"remove_replica", "path":path, "id":format_block_id(replica[0])})
+
+    # mark datanodes without a recent heartbeat dead and queue every block they held
+    def check_liveness(self):
+        now = time.monotonic()
+        for node in self.placement.nodes.values():
+            if node.alive and node.last_heartbeat is not None and now - node.last_heartbeat > self.dead_interval:
+                print(f"DataNode {node.port} is dead, no heartbeat for {now - node.last_heartbeat:.0f}s")
+                node.alive = False
+                for block_id in self.node_blocks.get(node.port, ()):
+                    self.need_replication(block_id)
+
+    # hand out copies for under-replicated blocks, at most MAX_REPLICATION_STREAMS per source datanode
+    # a block whose copy timed out is queued again
+    def schedule_replication(self):
+        now = time.monotonic()
+        for block_id, (file, partition, _, target, size, deadline) in list(self.pending_replications.items()):
+            if now > deadline:
+                del self.pending_replications[block_id]
+                self.placement.release([target], size)
+                self.needed_replication.add((file, partition))
+
+        streams = {}
+        for _, _, source, _, _, _ in self.pending_replications.values():
+            streams[source] = streams.get(source, 0) + 1
+        in_progress = {(file, partition) for file, partition, _, _, _, _ in self.pending_replications.values()}
+
+        for file, partition in list(self.needed_replication):
+            if file.parent is None:
+                self.needed_replication.discard((file, partition))
+                continue
+            if (file, partition) in in_progress:
+                continue
+            replicas = [replica for replica in file.iter_replicas() if replica[1]==partition]
+            live = [replica for replica in replicas if self.replica_live(replica)]
+            if len(live) >= file.rf:
+                self.needed_replication.discard((file, partition))
+                continue
+            # with no live replica left there is nothing to copy from, it stays queued in case one comes back
+            sources = [replica for replica in live if streams.get(replica[2], 0) < MAX_REPLICATION_STREAMS]
+            if not sources:
+                continue
+            source_id, _, source, size = min(sources, key=lambda replica: streams.get(replica[2], 0))
+            try:
+                target = self.placement.place(1, size, exclude={replica[2] for replica in replicas})[0]
+            except ValueError:
+                continue
+            self.placement.reserve([target], size)
+            new_block_id = uuid.uuid4().int
+            self.pending_replications[new_block_id] = (file, partition, source, target, size, now + REPLICATION_TIMEOUT)
+            self.replication_work[source].append({"block_id":format_block_id(source_id), "new_block_id":format_block_id(new_block_id), "target":target})
+            streams[source] = streams.get(source, 0) + 1
+            self.needed_replication.discard((file, partition))
+
+    def replicate_forever(self):
+        while True:
+            time.sleep(REPLICATION_INTERVAL)
+            try:
+                with self.lock:
+                    self.check_liveness()
+                    self.schedule_replication()
+                    self.expire_leases()
+            except Exception as e:
+                print(f"Replication check failed: {e}")
+
+    # write the namespace and the queued invalidations to metadata.json and drop the edit log segments it covers
+    def checkpoint(self):
+        with self.lock:
+            txid = self.edit_log.roll()
+            if txid == self.checkpoint_txid:
+                self.last_checkpoint = time.monotonic()
+                return
+            image = self.namespace.to_json(txid, {"invalidate": {port: block_ids for port, block_ids in self.invalidate_work.items() if block_ids}})
+        # write a new file and rename it over the old one so a crash never leaves a partial image
+        with open("metadata.json.tmp","w") as f:
+            f.write(image)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace("metadata.json.tmp", "metadata.json")
+        self.checkpoint_txid = txid
+        self.last_checkpoint = time.monotonic()
+        self.edit_log.purge(txid)
+
+    def checkpoint_forever(self):
+        while True:
+            time.sleep(1)
+            pending = self.edit_log.txid - self.checkpoint_txid
+            if pending >= self.checkpoint_txns or (pending > 0 and time.monotonic() - self.last_checkpoint >= self.checkpoint_period):
+                try:
+                    self.checkpoint()
+                except Exception as e:
+                    print(f"Checkpoint failed: {e}")
+        
     # create a new file
-    def write_new_file(self, file_path, file_size):
+    @commands.command("put", {"file_path":str, "file_size":int, "rf":optional(int), "block_size":optional(int)}, {"locations":list, "block_size":int})
+    def write_new_file(self, file_path, file_size, rf=None, block_size=None):
+        self.expire_allocations()
+        return self.allocate_file(file_path, file_size, rf, block_size)
+
+    # check a new file and allocate its blocks, the put response, callers expire old allocations first
+    def allocate_file(self, file_path, file_size, rf=None, block_size=None):
         if "." not in file_path:
             return {"command":"put", "status":"error", "message":"Namenode Error: Invalid file name"}
 
         # check if file already exists in metadata
-        if file_path in self.file_metadata.keys():
+        if self.namespace.lookup(file_path) is not None:
             return {"command":"put", "status":"error", "message":"Namenode Error: File already exists"}
         
         # check if parent directory exists
         parent_path = file_path[:file_path.rfind('/')]
-        if len(parent_path)>1 and parent_path not in self.directory_metadata.keys():
+        if len(parent_path)>1 and not self.namespace.is_dir(parent_path):
             return {"command":"put", "status":"error", "message":"Namenode Error: Parent directory does not exist"}
 
+        rf = rf or self.replication
+        if rf < 1 or rf > len(self.datanodes):
+            return {"command":"put", "status":"error", "message":f"Namenode Error: Replication factor must be between 1 and {len(self.datanodes)}"}
+        block_size = block_size or self.block_size
+        if block_size < MIN_BLOCK_SIZE or block_size > MAX_BLOCK_SIZE:
+            return {"command":"put", "status":"error", "message":f"Namenode Error: Block size must be between {MIN_BLOCK_SIZE} and {MAX_BLOCK_SIZE} bytes"}
+
+        try:
+            locations, allocated = self.allocate_blocks(file_size, rf, block_size)
+        except ValueError as e:
+            return {"command":"put", "status":"error", "message":f"Namenode Error: {e}"}
+        block_ids = self.location_block_ids(locations)
+        self.allocations.setdefault(file_path, []).append((time.monotonic(), allocated, block_ids))
+        self.writing_blocks |= block_ids
+        
+        # return locations and block size to client
+        return {"command":"put", "locations":locations, "block_size":block_size, "status":"success",}
+
+    # place the blocks of size bytes split into block_size partitions, at least one, returns (locations, allocated)
+    # locations lists [datanode port, new block id] replicas per partition, allocated the (datanode ports, block size)
+    # reserved on the datanodes until the blocks are committed, raises ValueError if they don't fit
+    def allocate_blocks(self, size, rf, block_size):
         locations = []
         
         # calculate number of partitions to split the file into
         n_partitions = 1    # default number of partitions is 1
-        if file_size > self.block_size:
-            n_partitions = (file_size + self.block_size - 1) // self.block_size
+        if size > block_size:
+            n_partitions = (size + block_size - 1) // block_size
 
-        # select 2 datanodes at random (since rf=2) to send each partition to
+        # the placement policy picks rf datanodes for each partition, space is reserved on them until the commit
+        allocated = []
         for p in range(n_partitions):
-            dn = random.sample(range(3), 2)
-            dn_with_blockid = [(self.datanodes[i],str(uuid.uuid4())) for i in dn]   # uuid creates a unique block_id for each replica
+            partition_size = min(block_size, size - p * block_size)
+            try:
+                dn = self.placement.place(rf, partition_size)
+            except ValueError:
+                for ports, reserved in allocated:
+                    self.placement.release(ports, reserved)
+                raise
+            self.placement.reserve(dn, partition_size)
+            allocated.append((dn, partition_size))
+            dn_with_blockid = [(port,str(uuid.uuid4())) for port in dn]   # uuid creates a unique block_id for each replica
             
             locations.append(dn_with_blockid) 
-        
-        # return locations and block size to client
-        return {"command":"put", "locations":locations, "block_size":self.block_size, "status":"success",}
+        return locations, allocated
+
+    # updates metadata, block_size is the one put handed out, clients that don't send it get the default
+    @commands.command("put_update", {"file_path":str, "file_size":int, "locations":list, "block_sizes":dict, "block_size":optional(int)}, {"message":str})
+    def write_new_file_update_metadata(self, file_path, file_size, locations, block_sizes, block_size=None):
+        edit, error = self.add_file_edit(file_path, file_size, locations, block_sizes, block_size)
+        if error is not None:
+            return {"command":"put_update", "status":"error", "message":error}
+        self.log_edit(edit)
+        return {"command":"put_update", "status":"success", "message":"File uploaded successfully"}
+
+    # give up puts the client couldn't finish, each {"file_path", "locations"} as put or put_batch allocated it
+    # the allocation's space is given back and the blocks that were written are deleted, an expired allocation's
+    # blocks are left to orphan collection
+    @commands.command("abandon_put", {"files":list}, {"message":str})
+    def abandon_files(self, files):
+        if any(not isinstance(f, dict) or not isinstance(f.get("file_path"), str) or not isinstance(f.get("locations"), list) for f in files):
+            return {"command":"abandon_put", "status":"error", "message":"Namenode Error: Invalid abandoned file"}
+        for f in files:
+            if self.release_allocation(f["file_path"], f["locations"]):
+                self.invalidate((parse_block_id(block_id), 0, port, 0) for partition in f["locations"] for port, block_id in partition)
+        return {"command":"abandon_put", "status":"success", "message":f"{len(files)} puts abandoned"}
 
-    # updates metadata
-    def write_new_file_update_metadata(self, file_path, file_size, locations, block_sizes):
-        self.file_metadata[file_path] = {
-            "rf": 2,
+    # give back the space reserved by the allocation of a path that handed out locations, returns whether it was still pending
+    def release_allocation(self, file_path, locations):
+        pending = self.allocations.get(file_path, [])
+        try:
+            block_ids = self.location_block_ids(locations)
+        except ValueError:
+            return False
+        for i, (_, allocated, allocated_ids) in enumerate(pending):
+            if allocated_ids == block_ids:
+                del pending[i]
+                if not pending:
+                    del self.allocations[file_path]
+                self.release_blocks(allocated, block_ids)
+                return True
+        return False
+
+    # the add_file edit committing an allocated file, returns (edit, None) or (None, error message)
+    # everything is checked before the edit is logged, an edit that can't be applied would also fail every replay
+    def add_file_edit(self, file_path, file_size, locations, block_sizes, block_size=None):
+        # block_sizes maps each partition, counted from 0, to its bytes, checked before the allocation is given up
+        sizes = [block_sizes.get(str(p)) for p in range(len(locations))]
+        if len(block_sizes) != len(sizes) or any(not isinstance(size, int) or size < 0 for size in sizes):
+            return None, "Namenode Error: Invalid block sizes"
+        # an allocation that expired may have had its blocks deleted as orphans
+        if not self.release_allocation(file_path, locations):
+            return None, "Namenode Error: The file's allocation expired, put it again"
+        # another client may have committed the same path since this one was allocated
+        if self.namespace.lookup(file_path) is not None:
+            return None, "Namenode Error: File already exists"
+        if not self.namespace.is_dir(file_path[:file_path.rfind('/')] or "/"):
+            return None, "Namenode Error: Parent directory does not exist"
+
+        file = {
+            "rf": len(locations[0]) if locations else self.replication,
             "size": file_size,  
+            "block_size": block_size or self.block_size,
             "blocks": []
         }
         p = 0
         for partition in locations:
-            block_size = block_sizes[str(p)]
+            partition_size = sizes[p]
             p+=1
             for replica in partition:
-                self.file_metadata[file_path]["blocks"].append({
+                try:
+                    parse_block_id(replica[1])
+                except ValueError as e:
+                    return None, f"Namenode Error: {e}"
+                file["blocks"].append({
                     "id":replica[1],
                     "partition": p,
                     "datanode":replica[0],
-                    "num_bytes": block_size
+                    "num_bytes": partition_size
                 })
-        
-        parent_path = file_path[:file_path.rfind('/')]
-        if parent_path=="":
-            parent_path="/"
-        file_name = file_path[file_path.rfind('/')+1:]
-        self.directory_metadata[parent_path]["children"].append(file_name)
+        return {"op":"add_file", "path":file_path, "file":file}, None
 
-        self.save_metadata()    # saving metadata.json
-        return {"command":"put_update", "status":"success", "message":"File uploaded successfully"}
-    
-    def save_metadata(self):
-        data = {"file":self.file_metadata, "dir":self.directory_metadata}
-        with open("metadata.json","w") as f:
-            json.dump(data,f)
+    # start appending append_size bytes to a file, granting holder its lease
+    # blocks are never modified in place, so a last block that isn't full is rewritten under a new id: tail lists the
+    # replicas of that block and its num_bytes for the writer to read, and the first of the new partitions,
+    # first_partition, replaces it, a full last block is kept and first_partition is the one after it
+    # an unexpired lease of another holder makes the append fail, an expired one or the holder's own is recovered first
+    @commands.command("append", {"file_path":str, "append_size":int, "holder":str},
+                      {"lease":str, "lease_period":int, "file_size":int, "first_partition":int, "locations":list, "block_size":int, "tail":dict})
+    def append_file(self, file_path, append_size, holder):
+        file = self.namespace.get_file(file_path)
+        if file is None:
+            return {"command":"append", "status":"error", "message":"Namenode Error: File doesn't exist"}
+        if append_size < 1:
+            return {"command":"append", "status":"error", "message":"Namenode Error: Nothing to append"}
+        lease = self.leases.get(file_path)
+        if lease is not None:
+            idle = time.monotonic() - lease.renewed
+            if lease.holder != holder and idle < LEASE_SOFT_LIMIT:
+                return {"command":"append", "status":"error",
+                        "message":f"Namenode Error: File is being appended to by another client, its lease expires in {LEASE_SOFT_LIMIT - idle:.0f}s"}
+            print(f"Recovering the lease of {lease.holder} on {file_path}")
+            self.recover_lease(file_path)
+
+        partition_sizes = {}
+        for _, partition, _, num_bytes in file.iter_replicas():
+            partition_sizes[partition] = num_bytes
+        last = max(partition_sizes, default=0)
+        tail = partition_sizes.get(last, 0)
+        if last and tail < file.block_size:
+            first = last
+        else:
+            first, tail = last + 1, 0
+
+        try:
+            locations, allocated = self.allocate_blocks(tail + append_size, file.rf, file.block_size)
+        except ValueError as e:
+            return {"command":"append", "status":"error", "message":f"Namenode Error: {e}"}
+        lease = Lease(holder, file, first, locations, allocated)
+        self.leases[file_path] = lease
+        self.writing_blocks |= self.location_block_ids(locations)
+        tail_replicas = [[block["id"], block["datanode"]] for block in self.readable_blocks(file) if tail and block["partition"]==first]
+        return {"command":"append", "status":"success", "lease":lease.id, "lease_period":LEASE_SOFT_LIMIT, "file_size":file.size, "first_partition":first,
+                "locations":locations, "block_size":file.block_size, "tail":{"num_bytes":tail, "replicas":tail_replicas}}
+
+    # the lease with id lease_id on a file, returns (lease, None) or (None, error message)
+    def check_lease(self, file_path, lease_id):
+        lease = self.leases.get(file_path)
+        if lease is None or lease.id != lease_id:
+            return None, "Namenode Error: The append's lease was lost, it expired and was recovered"
+        return lease, None
 
+    # keep a lease from expiring, writers renew well within lease_period
+    @commands.command("renew_lease", {"file_path":str, "lease":str}, {"lease_period":int})
+    def renew_lease(self, file_path, lease):
+        held, error = self.check_lease(file_path, lease)
+        if error is not None:
+            return {"command":"renew_lease", "status":"error", "message":error}
+        held.renewed = time.monotonic()
+        return {"command":"renew_lease", "status":"success", "lease_period":LEASE_SOFT_LIMIT}
+
+    # abandon an append, the writer gives its lease back and the blocks it allocated are deleted
+    @commands.command("release_lease", {"file_path":str, "lease":str}, {"message":str})
+    def release_lease(self, file_path, lease):
+        held, error = self.check_lease(file_path, lease)
+        if error is not None:
+            return {"command":"release_lease", "status":"error", "message":error}
+        self.recover_lease(file_path)
+        return {"command":"release_lease", "status":"success", "message":"Append abandoned"}
+
+    # commit an append whose blocks were written, block_sizes maps each allocated partition, counted from 0, to its bytes
+    # the partitions replace the file's from the lease's first_partition on as one edit, so readers see the whole append or none of it
+    @commands.command("append_update", {"file_path":str, "lease":str, "file_size":int, "block_sizes":dict}, {"message":str})
+    def append_file_update_metadata(self, file_path, lease, file_size, block_sizes):
+        held, error = self.check_lease(file_path, lease)
+        if error is not None:
+            return {"command":"append_update", "status":"error", "message":error}
+        file = held.file
+        if self.namespace.get_file(file_path) is not file:
+            self.recover_lease(file_path)
+            return {"command":"append_update", "status":"error", "message":"Namenode Error: File was removed while it was appended to"}
+
+        kept = {partition: num_bytes for _, partition, _, num_bytes in file.iter_replicas() if partition < held.first_partition}
+        sizes = [block_sizes.get(str(p)) for p in range(len(held.locations))]
+        # every partition but the last is full
+        if any(not isinstance(size, int) or not 0 < size <= file.block_size for size in sizes) or any(size != file.block_size for size in sizes[:-1]):
+            self.recover_lease(file_path)
+            return {"command":"append_update", "status":"error", "message":"Namenode Error: Block sizes don't match the allocated partitions"}
+        if sum(kept.values()) + sum(sizes) != file_size or file_size <= file.size:
+            self.recover_lease(file_path)
+            return {"command":"append_update", "status":"error", "message":"Namenode Error: File size doesn't match its blocks"}
+
+        blocks = [{"id":block_id, "partition":held.first_partition + p, "datanode":port, "num_bytes":sizes[p]}
+                  for p, partition in enumerate(held.locations) for port, block_id in partition]
+        appended = file_size - file.size
+        del self.leases[file_path]
+        self.release_blocks(held.allocated, self.location_block_ids(held.locations))
+        self.log_edit({"op":"append", "path":file_path, "size":file_size, "first_partition":held.first_partition, "blocks":blocks})
+        return {"command":"append_update", "status":"success", "message":f"Appended {appended} bytes"}
+
+    # allocate blocks for several files in one request, each {"file_path", "file_size"} with optional "rf" and "block_size"
+    # all or nothing: if one file can't be allocated the ones allocated before it are released
+    @commands.command("put_batch", {"files":list}, {"files":list})
+    def write_new_files(self, files):
+        error = self.check_batch(files)
+        if error is not None:
+            return {"command":"put_batch", "status":"error", "message":error}
+        # expired allocations are swept once for the whole batch, not once per file
+        self.expire_allocations()
+        allocated = []
+        for f in files:
+            response = self.allocate_file(f["file_path"], f["file_size"], f.get("rf"), f.get("block_size"))
+            if response["status"]=="error":
+                for done, done_allocated in zip(files, allocated):
+                    self.release_allocation(done["file_path"], done_allocated["locations"])
+                return {"command":"put_batch", "status":"error", "message":f"{f['file_path']}: {response['message']}"}
+            allocated.append({"locations":response["locations"], "block_size":response["block_size"]})
+        return {"command":"put_batch", "status":"success", "files":allocated}
+
+    # commit several allocated files as one batch edit, each with the fields of put_update
+    # all or nothing: the batch is a single edit log record, logged only if every file can be added
+    @commands.command("put_update_batch", {"files":list}, {"message":str})
+    def write_new_files_update_metadata(self, files):
+        error = self.check_batch(files)
+        edits = []
+        for f in files:
+            # once the batch has failed the rest of its allocations are only released
+            if error is not None:
+                self.release_allocation(f["file_path"], f["locations"])
+                continue
+            edit, file_error = self.add_file_edit(f["file_path"], f["file_size"], f["locations"], f["block_sizes"], f.get("block_size"))
+            if file_error is not None:
+                error = f"{f['file_path']}: {file_error}"
+            edits.append(edit)
+        if error is not None:
+            return {"command":"put_update_batch", "status":"error", "message":error}
+        self.log_edit({"op":"batch", "edits":edits})
+        return {"command":"put_update_batch", "status":"success", "message":f"{len(edits)} files uploaded successfully"}
+
+    # error message for a batch that is too large or names a path twice, None if it is fine
+    @staticmethod
+    def check_batch(files):
+        if len(files) > BATCH_LIMIT:
+            return f"Namenode Error: A batch can hold at most {BATCH_LIMIT} files"
+        if len({f["file_path"] for f in files}) != len(files):
+            return "Namenode Error: A batch names the same file twice"
+        return None
+    
     # list contents of directory
+    @commands.command("ls", {"path":str}, {"list":list})
     def ls(self, path):
         if len(path)>1 and path[-1]=="/":
             path = path[:-1]
-        if path in self.directory_metadata.keys():
-            return {"command":"ls", "list": self.directory_metadata[path]["children"], "status": "success"}
+        directory = self.namespace.get_directory(path)
+        if directory is not None:
+            return {"command":"ls", "list": list(directory.children), "status": "success"}
         else:
             return {"command":"ls", "status":"error", "message":"Namenode Error: Path does not exist"}
         
-    # delete a file
+    # typed, paginated directory listing: up to limit entries from offset on, each {"name", "type": "dir" or "file", "size"}
+    # with size in bytes, 0 for directories, and total the number of entries in the directory
+    # generation changes whenever entries are added or removed or a file's size changes, a caller passing the current one gets "not_modified" back
+    @commands.command("listing", {"path":str, "offset":optional(int), "limit":optional(int), "generation":optional(str)},
+                      {"generation":str, "entries":optional(list), "total":optional(int), "not_modified":optional(bool)})
+    def listing(self, path, offset=0, limit=LISTING_LIMIT, generation=None):
+        if len(path)>1 and path[-1]=="/":
+            path = path[:-1]
+        directory = self.namespace.get_directory(path)
+        if directory is None:
+            return {"command":"listing", "status":"error", "message":"Namenode Error: Path does not exist"}
+        current = f"{self.epoch}-{directory.generation}"
+        if generation == current:
+            return {"command":"listing", "status":"success", "not_modified":True, "generation":current}
+        entries = []
+        for name, child in itertools.islice(directory.children.items(), max(offset, 0), max(offset, 0) + max(min(limit, LISTING_LIMIT), 0)):
+            if isinstance(child, INodeDirectory):
+                entries.append({"name":name, "type":"dir", "size":0})
+            else:
+                entries.append({"name":name, "type":"file", "size":child.size})
+        return {"command":"listing", "status":"success", "generation":current, "entries":entries, "total":len(directory.children)}
+
+    # delete a file, its blocks are queued for deletion on their datanodes and removed in the background
+    @commands.command("rm", {"path":str}, {"message":str})
     def remove_file(self, path):
-        parent_path = path[:path.rfind('/')]
-        if parent_path=="":
-            parent_path="/"
         file_name = path[path.rfind('/')+1:]
         if '.' not in file_name:
             return {"command":"rm", "status":"error", "message":"Namenode Error: Input isn't a file"}
-        if path not in self.file_metadata.keys():
+        if self.namespace.get_file(path) is None:
             return {"command":"rm", "status":"error", "message":"Namenode Error: File doesn't exist"}
-    
-        # delete file
-        for block in self.file_metadata[path]["blocks"]:
-            dn_port = block["datanode"]
-            block_id = block["id"]
-            datanode_response = self.send_to_datanode({"command": "rm", "block_id":block_id},dn_port)
-       
-        # update metadata
-        self.file_metadata.pop(path)
-        self.directory_metadata[parent_path]["children"].remove(file_name)
-        self.save_metadata()    # saving metadata.json
+        self.log_edit({"op":"delete_file", "path":path})
         return {"command":"rm", "status":"success", "message":"File deleted"}
+
+    # delete a directory and everything under it, or a single file, as one batch edit, blocks are deleted as for rm
+    # the root directory itself is kept
+    @commands.command("rm_recursive", {"path":str}, {"message":str})
+    def remove_recursive(self, path):
+        if self.namespace.lookup(path) is None:
+            return {"command":"rm_recursive", "status":"error", "message":"Namenode Error: Path does not exist"}
+        # entries are removed before the directories holding them
+        edits = []
+        for node_path, node in reversed(list(self.namespace.walk(path))):
+            if isinstance(node, INodeDirectory):
+                if node_path != "/":
+                    edits.append({"op":"rmdir", "path":node_path})
+            else:
+                edits.append({"op":"delete_file", "path":node_path})
+        if edits:
+            self.log_edit({"op":"batch", "edits":edits})
+        files = sum(edit["op"]=="delete_file" for edit in edits)
+        return {"command":"rm_recursive", "status":"success", "message":f"Deleted {files} files and {len(edits) - files} directories"}
     
     # create a new directory 
+    @commands.command("mkdir", {"path":str}, {"message":str})
     def make_directory(self, path):
         if path[0]!="/":
             return {"command":"mkdir", "status":"error", "message":"Namenode Error: Invalid path"}
         if len(path)>1 and path[path.rfind("/")+1:].isalnum()==0:
             return {"command":"mkdir", "status":"error", "message":"Namenode Error: Invalid path"}
-        if path in self.directory_metadata.keys():
+        if self.namespace.is_dir(path):
             if path=="/":
                 return {"command":"mkdir", "status":"error", "message":"Namenode Error: Cannot create root directory, already exists"}    
             return {"command":"mkdir", "status":"error", "message":"Namenode Error: Directory already exists"}
@@ -188,41 +899,61 @@ class NameNode:
         parent_path = path[:path.rfind('/')]
         if parent_path=="":
             parent_path = "/"
-        if parent_path not in self.directory_metadata.keys():
+        if not self.namespace.is_dir(parent_path):
             return {"command":"mkdir", "status":"error", "message":"Namenode Error: Parent directory does not exist"}
         
-        children = []
-        dir_name = path[path.rfind('/')+1:]
-        self.directory_metadata[parent_path]["children"].append(dir_name)
-
-        a = {"parent": parent_path, "children": children}
-        if parent_path=="/":
-            self.directory_metadata[parent_path + dir_name] = a
-        else:
-            self.directory_metadata[parent_path + "/" + dir_name] = a
-
-        self.save_metadata()    # saving metadata.json
+        self.log_edit({"op":"mkdir", "path":path})
         return {"command":"mkdir", "status":"success", "message":"Directory Created"}
 
     # remove a directory 
+    @commands.command("rmdir", {"path":str}, {"message":str})
     def remove_directory(self, path):
-        parent_path = path[:path.rfind('/')]
-        if parent_path=="":
-            parent_path = "/"
-        dir_name = path[path.rfind('/')+1:]
-
-        if path not in self.directory_metadata.keys():
+        directory = self.namespace.get_directory(path)
+        if directory is None:
             return {"command":"rmdir", "status":"error", "message":"Namenode Error: Directory doesn't exist"}
-        if len(self.directory_metadata[path]["children"]) != 0:
+        if len(directory.children) != 0:
             return {"command":"rmdir", "status":"error", "message":"Namenode Error: Directory isn't empty"}
         if path == '/':
             return {"command":"rmdir", "status":"error", "message":"Namenode Error: Root directory cannot be deleted"}
         
-        self.directory_metadata[parent_path]["children"].remove(dir_name)
-        self.directory_metadata.pop(path)
-        self.save_metadata()    # saving metadata.json
+        self.log_edit({"op":"rmdir", "path":path})
         return {"command":"rmdir", "status":"success", "message":"Directory Deleted"}
 
+    # type and size of several paths, plus entry count for directories and rf, block size and replica count for files
+    # a path that doesn't exist gets an error entry, the others are still answered
+    @commands.command("stat", {"paths":list}, {"stats":list})
+    def stat(self, paths):
+        if len(paths) > LISTING_LIMIT:
+            return {"command":"stat", "status":"error", "message":f"Namenode Error: At most {LISTING_LIMIT} paths can be looked up at once"}
+        stats = []
+        for path in paths:
+            node = self.namespace.lookup(path)
+            if node is None:
+                stats.append({"path":path, "status":"error", "message":"Namenode Error: Path does not exist"})
+            elif isinstance(node, INodeDirectory):
+                stats.append({"path":path, "status":"success", "type":"dir", "size":0, "entries":len(node.children)})
+            else:
+                stats.append({"path":path, "status":"success", "type":"file", "size":node.size, "rf":node.rf, "block_size":node.block_size,
+                              "replicas":len(node.replicas) // REPLICA.size})
+        return {"command":"stat", "status":"success", "stats":stats}
+
+    # everything under a directory in one response, one "<type>\t<size>\t<path>" line per entry sent as the payload
+    # so the header stays small however large the tree is, type is "dir" or "file" and size is 0 for directories
+    @commands.command("ls_recursive", {"path":str}, {"entries":int, "data":bytes})
+    def ls_recursive(self, path):
+        if self.namespace.lookup(path) is None:
+            return {"command":"ls_recursive", "status":"error", "message":"Namenode Error: Path does not exist"}
+        lines = []
+        for node_path, node in self.namespace.walk(path):
+            if isinstance(node, INodeDirectory):
+                lines.append(f"dir\t0\t{node_path}\n")
+            else:
+                lines.append(f"file\t{node.size}\t{node_path}\n")
+        # the directory itself isn't listed, a file is
+        if isinstance(self.namespace.lookup(path), INodeDirectory):
+            lines = lines[1:]
+        return {"command":"ls_recursive", "status":"success", "entries":len(lines), "data":"".join(lines).encode()}
+
     # # get block locations 
     # def get_file(self, file_path):
     #     if '.' not in file_path:
@@ -239,27 +970,75 @@ class NameNode:
     #         return {"command":"cat", "status":"error", "message":"Namenode Error: File doesn't exist"} 
     #     return {"command":"cat", "status":"success", "rf":self.file_metadata[file_path]["rf"], "blocks":self.file_metadata[file_path]["blocks"]}
     
-    # get block locations for client UI
-    def blocks_metadata(self, file_path):
-        return {"command":"blocks_metadata", "status":"success", "data": str(self.file_metadata[file_path]["blocks"])}
+    # get block locations for client UI, up to limit replicas from offset on in partition order
+    @commands.command("blocks_metadata", {"file_path":str, "offset":optional(int), "limit":optional(int)},
+                      {"rf":int, "size":int, "block_size":int, "blocks":list, "total":int})
+    def blocks_metadata(self, file_path, offset=0, limit=LISTING_LIMIT):
+        file = self.namespace.get_file(file_path)
+        if file is None:
+            return {"command":"blocks_metadata", "status":"error", "message":"Namenode Error: File doesn't exist"}
+        offset = max(offset, 0)
+        replicas = sorted(file.iter_replicas(), key=lambda replica: replica[1])
+        page = replicas[offset:offset + max(min(limit, LISTING_LIMIT), 0)]
+        return {"command":"blocks_metadata", "status":"success", "rf":file.rf, "size":file.size, "block_size":file.block_size, "blocks":file.block_dicts(page), "total":len(replicas)}
     
+    @commands.command("get", {"file_path":str}, {"rf":int, "blocks":list})
+    @commands.command("cat", {"file_path":str}, {"rf":int, "blocks":list})
     def get_block_locations(self, file_path):
         if '.' not in file_path:
             return {"command":"block_locations", "status":"error", "message":"Namenode Error: Invalid file name"}
-        if file_path not in self.file_metadata.keys():
+        file = self.namespace.get_file(file_path)
+        if file is None:
             return {"command":"block_locations", "status":"error", "message":"Namenode Error: File doesn't exist"} 
-        return {"command":"block_locations", "status":"success", "rf":self.file_metadata[file_path]["rf"], "blocks":self.file_metadata[file_path]["blocks"]}
+        return {"command":"block_locations", "status":"success", "rf":file.rf, "blocks":self.readable_blocks(file)}
+
+    # a file's replicas in the order readers should try them: live ones first, stale ones after them,
+    # dead or missing ones only for a partition that has nothing else
+    def readable_blocks(self, file):
+        now = time.monotonic()
+        def rank(replica):
+            if not self.replica_live(replica):
+                return 2
+            node = self.placement.nodes[replica[2]]
+            return 1 if node.last_heartbeat is not None and now - node.last_heartbeat > STALE_INTERVAL else 0
+        ranked = sorted(file.iter_replicas(), key=rank)
+        readable = {replica[1] for replica in ranked if rank(replica) < 2}
+        return file.block_dicts([replica for replica in ranked if rank(replica) < 2 or replica[1] not in readable])
         
 
 if __name__ == "__main__":
-    if len(sys.argv)!=6:
-        print("Correct usage: python3 namenode.py <namenode_ip> <namenode_port> <datanode_port1> <datanode_port2> <datanode_port3>\n")
-        sys.exit(1)
-    namenode_ip = sys.argv[1]
-    namenode_port = int(sys.argv[2])
-    datanode_ports = []
-    for i in range(3):
-        datanode_ports.append(int(sys.argv[3+i]))
+    parser = argparse.ArgumentParser(usage="python3 namenode.py <namenode_ip> <namenode_port> <datanode_port> [<datanode_port> ...] [--workers N] [--placement POLICY] [--replication N] [--rack PORT=RACK] [--capacity BYTES] [--block-size BYTES] [--codec json|msgpack] [--check-responses]")
+    parser.add_argument("namenode_ip")
+    parser.add_argument("namenode_port", type=int)
+    parser.add_argument("datanode_ports", type=int, nargs="+")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="number of threads serving client connections")
+    parser.add_argument("--placement", choices=sorted(POLICIES), default=DEFAULT_PLACEMENT, help="how datanodes are picked for new blocks")
+    parser.add_argument("--replication", type=int, default=DEFAULT_REPLICATION, help="replicas per block for files put without --rf")
+    parser.add_argument("--rack", action="append", default=[], metavar="PORT=RACK", help="rack of a datanode, used by rack-aware placement")
+    parser.add_argument("--capacity", type=int, default=DEFAULT_CAPACITY, help="bytes of block storage on each datanode until its first heartbeat reports its own")
+    parser.add_argument("--dead-interval", type=float, default=DEAD_INTERVAL, help="seconds without a heartbeat after which a datanode is dead")
+    parser.add_argument("--orphan-grace", type=float, default=ORPHAN_GRACE, help="seconds a block unknown to the namespace is kept on its datanode before it is deleted")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE, help=f"bytes per block for files put without --block-size, {MIN_BLOCK_SIZE} to {MAX_BLOCK_SIZE}")
+    parser.add_argument("--codec", choices=sorted(CODEC_VERSIONS), default="json", help="encoding of the request headers this process sends, msgpack needs the msgpack package")
+    parser.add_argument("--check-responses", action="store_true", help="check every response against its command's declared schema, for testing")
+    args = parser.parse_args()
+    if not 1 <= args.replication <= len(args.datanode_ports):
+        parser.error(f"--replication must be between 1 and the number of datanodes ({len(args.datanode_ports)})")
+    if not MIN_BLOCK_SIZE <= args.block_size <= MAX_BLOCK_SIZE:
+        parser.error(f"--block-size must be between {MIN_BLOCK_SIZE} and {MAX_BLOCK_SIZE}")
+    try:
+        set_codec(args.codec)
+    except ValueError as e:
+        parser.error(str(e))
+    NameNode.commands.check_responses = args.check_responses
+    racks = {}
+    for entry in args.rack:
+        port, _, rack = entry.partition("=")
+        if not port.isdigit() or not rack:
+            parser.error(f"--rack expects PORT=RACK, got {entry!r}")
+        racks[int(port)] = rack
     
-    namenode = NameNode(namenode_ip, namenode_port, datanode_ports)
-    namenode.start()
\ No newline at end of file
+    namenode = NameNode(args.namenode_ip, args.namenode_port, args.datanode_ports, args.workers,
+                        placement=args.placement, replication=args.replication, racks=racks, capacity=args.capacity,
+                        dead_interval=args.dead_interval, block_size=args.block_size, orphan_grace=args.orphan_grace)
+    namenode.start()
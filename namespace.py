@@ -0,0 +1,232 @@
+import json
+import struct
+import sys
+
+# one replica of a block as stored on its file: block id as two 64-bit halves, partition, datanode port, size in bytes
+REPLICA = struct.Struct("=QQIHQ")
+LOW_64 = (1 << 64) - 1
+# block size of files written before it was recorded per file
+LEGACY_BLOCK_SIZE = 2048
+
+
+# block ids are uuids on the wire and 128-bit ints in the namenode
+def parse_block_id(block_id):
+    if len(block_id) != 36 or block_id[8] != "-" or block_id[13] != "-" or block_id[18] != "-" or block_id[23] != "-":
+        raise ValueError(f"Invalid block id {block_id!r}")
+    return int(block_id.replace("-", ""), 16)
+
+def format_block_id(n):
+    h = f"{n:032x}"
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+class INode:
+    __slots__ = ("name", "parent")
+
+    def __init__(self, name, parent):
+        self.name = sys.intern(name)
+        self.parent = parent
+
+
+class INodeDirectory(INode):
+    __slots__ = ("children", "generation")
+
+    def __init__(self, name, parent):
+        super().__init__(name, parent)
+        self.children = {}      # name -> INode, in creation order
+        self.generation = 0     # the namespace generation when an entry was last added, removed or resized
+
+
+# a file's replicas are packed REPLICA records in one bytes object rather than a dict per replica
+class INodeFile(INode):
+    __slots__ = ("rf", "size", "block_size", "replicas")
+
+    def __init__(self, name, parent, rf, size, block_size=LEGACY_BLOCK_SIZE, replicas=b""):
+        super().__init__(name, parent)
+        self.rf = rf
+        self.size = size
+        self.block_size = block_size
+        self.replicas = replicas
+
+    # (block id, partition, datanode, num_bytes) for every replica
+    def iter_replicas(self):
+        for hi, lo, partition, datanode, num_bytes in REPLICA.iter_unpack(self.replicas):
+            yield (hi << 64) | lo, partition, datanode, num_bytes
+
+    def add_replica(self, block_id, partition, datanode, num_bytes):
+        self.replicas += REPLICA.pack(block_id >> 64, block_id & LOW_64, partition, datanode, num_bytes)
+
+    # drop a replica, returns its (block id, partition, datanode, num_bytes)
+    def remove_replica(self, block_id):
+        for i, replica in enumerate(self.iter_replicas()):
+            if replica[0] == block_id:
+                self.replicas = self.replicas[:i * REPLICA.size] + self.replicas[(i + 1) * REPLICA.size:]
+                return replica
+        raise KeyError(format_block_id(block_id))
+
+    # replace the replicas of partition first and every partition after it with replicas, a list of
+    # (block id, partition, datanode, num_bytes), returns the replicas that were dropped
+    def replace_partitions(self, first, replicas):
+        kept, dropped = [], []
+        for replica in self.iter_replicas():
+            (dropped if replica[1] >= first else kept).append(replica)
+        self.replicas = b"".join(REPLICA.pack(block_id >> 64, block_id & LOW_64, partition, datanode, num_bytes)
+                                 for block_id, partition, datanode, num_bytes in kept + list(replicas))
+        return dropped
+
+    # replicas in the dict form used by the protocol and metadata.json
+    def block_dicts(self, replicas=None):
+        return [{"id":format_block_id(block_id), "partition":partition, "datanode":datanode, "num_bytes":num_bytes}
+                for block_id, partition, datanode, num_bytes in (self.iter_replicas() if replicas is None else replicas)]
+
+    def to_dict(self):
+        return {"rf":self.rf, "size":self.size, "block_size":self.block_size, "blocks":self.block_dicts()}
+
+
+# the directory tree, looked up one path component at a time through each directory's child map
+class Namespace:
+    def __init__(self):
+        self.root = INodeDirectory("", None)
+        self.generation = 0     # counts changes to directory entries
+
+    # record a change to a directory's entries
+    def touch(self, directory):
+        self.generation += 1
+        directory.generation = self.generation
+
+    # path components of an absolute path, None for a relative one
+    @staticmethod
+    def components(path):
+        if not path.startswith("/"):
+            return None
+        return [name for name in path.split("/") if name]
+
+    def lookup(self, path):
+        names = self.components(path)
+        if names is None:
+            return None
+        node = self.root
+        for name in names:
+            if not isinstance(node, INodeDirectory):
+                return None
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+    def get_directory(self, path):
+        node = self.lookup(path)
+        return node if isinstance(node, INodeDirectory) else None
+
+    def get_file(self, path):
+        node = self.lookup(path)
+        return node if isinstance(node, INodeFile) else None
+
+    def is_dir(self, path):
+        return self.get_directory(path) is not None
+
+    # the directory that holds path and the last component of path
+    def parent_of(self, path):
+        parent_path, _, name = path.rpartition("/")
+        parent = self.get_directory(parent_path or "/")
+        if parent is None:
+            raise KeyError(f"Parent directory of {path} does not exist")
+        return parent, name
+
+    def path_of(self, node):
+        names = []
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return "/" + "/".join(reversed(names))
+
+    # add a file from its dict form, with block ids as uuid strings
+    def add_file(self, path, file):
+        parent, name = self.parent_of(path)
+        node = INodeFile(name, parent, file["rf"], file["size"], file.get("block_size", LEGACY_BLOCK_SIZE))
+        node.replicas = b"".join(REPLICA.pack(block_id >> 64, block_id & LOW_64, b["partition"], b["datanode"], b["num_bytes"])
+                                 for b in file["blocks"] for block_id in (parse_block_id(b["id"]),))
+        parent.children[node.name] = node
+        self.touch(parent)
+        return node
+
+    # remove a file, returns its inode, detached from the tree
+    def delete_file(self, path):
+        parent, name = self.parent_of(path)
+        node = parent.children.pop(name)
+        node.parent = None
+        self.touch(parent)
+        return node
+
+    def mkdir(self, path):
+        parent, name = self.parent_of(path)
+        node = INodeDirectory(name, parent)
+        parent.children[node.name] = node
+        self.touch(parent)
+        return node
+
+    def rmdir(self, path):
+        parent, name = self.parent_of(path)
+        node = parent.children.pop(name)
+        node.parent = None
+        self.touch(parent)
+
+    # (path, inode) of every file, parents before children
+    def files(self):
+        stack = [("", self.root)]
+        while stack:
+            path, directory = stack.pop()
+            for name, child in directory.children.items():
+                if isinstance(child, INodeDirectory):
+                    stack.append((path + "/" + name, child))
+                else:
+                    yield path + "/" + name, child
+
+    # (path, inode) of the node at path and everything under it, each directory before its entries, empty if path doesn't exist
+    def walk(self, path):
+        node = self.lookup(path)
+        if node is None:
+            return
+        stack = [("/" + "/".join(self.components(path)), node)]
+        while stack:
+            path, node = stack.pop()
+            yield path, node
+            if isinstance(node, INodeDirectory):
+                prefix = "" if path == "/" else path
+                stack.extend((prefix + "/" + name, child) for name, child in reversed(node.children.items()))
+
+    # build the tree from a metadata.json image, children are added in the order the image lists them
+    @classmethod
+    def from_image(cls, metadata):
+        namespace = cls()
+        files = metadata["file"]
+        dirs = metadata["dir"]
+        stack = [("/", namespace.root)]
+        while stack:
+            path, directory = stack.pop()
+            for name in dirs[path]["children"]:
+                child_path = path + name if path == "/" else path + "/" + name
+                if child_path in dirs:
+                    stack.append((child_path, namespace.mkdir(child_path)))
+                else:
+                    namespace.add_file(child_path, files[child_path])
+        return namespace
+
+    # the metadata.json image of the tree, in the layout the namenode has always written, extra holds more top-level keys
+    # entries are encoded one at a time so the dict form of the whole namespace never exists at once
+    def to_json(self, txid, extra=None):
+        dumps = json.JSONEncoder(separators=(", ", ": ")).encode
+        file_parts = []
+        dir_parts = []
+        stack = [("/", 0, self.root)]
+        while stack:
+            path, parent_path, directory = stack.pop()
+            dir_parts.append(f"{dumps(path)}: {dumps({'parent':parent_path, 'children':list(directory.children)})}")
+            for name, child in directory.children.items():
+                child_path = path + name if path == "/" else path + "/" + name
+                if isinstance(child, INodeDirectory):
+                    stack.append((child_path, path, child))
+                else:
+                    file_parts.append(f"{dumps(child_path)}: {dumps(child.to_dict())}")
+        extra_parts = "".join(f", {dumps(key)}: {dumps(value)}" for key, value in (extra or {}).items())
+        return '{"file": {' + ", ".join(file_parts) + '}, "dir": {' + ", ".join(dir_parts) + '}, "txid": ' + str(txid) + extra_parts + "}"
@@ -0,0 +1,123 @@
+import heapq
+import random
+
+DEFAULT_CAPACITY = 10 * 1024**3     # bytes per datanode when the namenode is given no other figure
+DEFAULT_RACK = "default"
+
+# what the namenode knows about one datanode's space, load and liveness
+class NodeStats:
+    __slots__ = ("port", "rack", "capacity", "used", "reserved", "in_flight", "load", "last_heartbeat", "alive")
+
+    def __init__(self, port, rack=DEFAULT_RACK, capacity=DEFAULT_CAPACITY):
+        self.port = port
+        self.rack = rack
+        self.capacity = capacity
+        self.used = 0           # bytes of committed blocks
+        self.reserved = 0       # bytes of blocks allocated but not committed yet
+        self.in_flight = 0      # blocks allocated but not committed yet
+        self.load = 0           # transfers the datanode reported running in its last heartbeat
+        self.last_heartbeat = None  # monotonic time, None for a datanode that hasn't sent one
+        self.alive = True
+
+    def free(self):
+        return self.capacity - self.used - self.reserved
+
+    # fraction of capacity taken, counting writes still in flight
+    def utilization(self):
+        return (self.used + self.reserved) / self.capacity if self.capacity else 1.0
+
+
+# picks the datanodes for each replica of a new block
+# subclasses implement choose(), the base class keeps the per node accounting
+class PlacementPolicy:
+    def __init__(self, nodes, rng=None):
+        self.nodes = {node.port: node for node in nodes}
+        self.rng = rng or random.Random()
+
+    # live nodes outside exclude that could take a block of size bytes
+    def candidates(self, size, exclude=()):
+        return [node for node in self.nodes.values() if node.alive and node.port not in exclude and node.free() >= size]
+
+    # return the ports of n distinct nodes out of candidates for a block of size bytes
+    def choose(self, n, size, candidates):
+        raise NotImplementedError
+
+    # ports of the n datanodes that should hold a new block of size bytes, none of them in exclude
+    def place(self, n, size, exclude=()):
+        candidates = self.candidates(size, exclude)
+        if len(candidates) < n:
+            raise ValueError(f"Need {n} DataNodes with {size} bytes free, only {len(candidates)} available")
+        return self.choose(n, size, candidates)
+
+    # a block was allocated on these nodes and is being written
+    def reserve(self, ports, size):
+        for port in ports:
+            node = self.nodes[port]
+            node.reserved += size
+            node.in_flight += 1
+
+    # an allocated block was committed or abandoned
+    def release(self, ports, size):
+        for port in ports:
+            node = self.nodes.get(port)
+            if node is not None:
+                node.reserved = max(node.reserved - size, 0)
+                node.in_flight = max(node.in_flight - 1, 0)
+
+    def add_used(self, port, size):
+        node = self.nodes.get(port)
+        if node is not None:
+            node.used += size
+
+
+# the original behaviour, replicas on datanodes picked uniformly at random
+class RandomPlacement(PlacementPolicy):
+    def choose(self, n, size, candidates):
+        return [node.port for node in self.rng.sample(candidates, n)]
+
+
+# replicas on the datanodes with the lowest utilization, counting space reserved by in-flight writes,
+# ties go to the node with fewer writes and transfers in flight and then at random so equal nodes share the load
+class LeastLoadedPlacement(PlacementPolicy):
+    def key(self, node):
+        return (node.utilization(), node.in_flight + node.load, self.rng.random())
+
+    def choose(self, n, size, candidates):
+        return [node.port for node in heapq.nsmallest(n, candidates, key=self.key)]
+
+
+# the hdfs default layout: one replica on one rack, the second and third on two nodes of another rack,
+# any further replicas on the least loaded nodes left
+# hdfs puts the first replica on the writer's node, here clients aren't datanodes so the rack holding two replicas
+# is the one whose two least loaded nodes are least loaded, otherwise that rack fills up faster than the others
+# falls back to least loaded placement when there is only one rack
+class RackAwarePlacement(LeastLoadedPlacement):
+    def choose(self, n, size, candidates):
+        remaining = sorted(candidates, key=self.key)
+        by_rack = {}
+        for node in remaining:
+            by_rack.setdefault(node.rack, []).append(node)
+        if n < 2 or len(by_rack) < 2:
+            return [node.port for node in remaining[:n]]
+
+        if n == 2:
+            first = remaining[0]
+            second = next(node for node in remaining if node.rack != first.rack)
+            chosen = [first, second]
+        else:
+            pairs = [nodes[:2] for nodes in by_rack.values() if len(nodes) >= 2]
+            if not pairs:
+                return [node.port for node in remaining[:n]]
+            pair = min(pairs, key=lambda pair: sum(node.utilization() for node in pair))
+            first = next(node for node in remaining if node.rack != pair[0].rack)
+            chosen = [first] + pair
+        taken = set(map(id, chosen))
+        chosen += [node for node in remaining if id(node) not in taken][:n - len(chosen)]
+        return [node.port for node in chosen]
+
+
+POLICIES = {
+    "random": RandomPlacement,
+    "least-loaded": LeastLoadedPlacement,
+    "rack-aware": RackAwarePlacement,
+}
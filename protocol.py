@@ -0,0 +1,265 @@
+import base64
+import json
+import os
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# every framed message starts with a fixed header:
+# magic, version, opcode, request id, metadata header length, payload length
+# commands are named in the metadata header, so the command tables nodes register them in are the only list of them,
+# the opcode is always 0 and a frame with any other is refused
+MAGIC = b"ED"
+VERSION = 1
+FRAME_HEADER = struct.Struct("!2sBBIIQ")
+
+# the version of a frame names the codec of its metadata header: version 1 frames carry json, version 2 frames carry
+# msgpack, which is smaller and quicker to encode and decode, and is used when the msgpack package is installed
+# and set_codec("msgpack") was called, replies are always sent in the codec their request arrived in
+# LEGACY marks requests that came in the old unframed json form
+CODEC_VERSIONS = {"json": VERSION, "msgpack": 2}
+VERSION_CODECS = {version: codec for codec, version in CODEC_VERSIONS.items()}
+LEGACY = "legacy"
+request_codec = "json"
+
+# fields that carry raw block bytes, sent as the frame payload instead of base64 inside json
+PAYLOAD_FIELDS = ("data", "block")
+
+# a frame payload is sent with a separate sendall above this size to avoid copying it
+COPY_THRESHOLD = 64 * 1024
+
+
+# a payload of length bytes of a file starting at offset, sent with sendfile so it never passes through user space
+# file has fileno() and close(), it is closed once the payload is sent or the send fails
+class FilePayload:
+    def __init__(self, file, offset, length):
+        self.file = file
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def send(self, sock):
+        offset = self.offset
+        end = self.offset + self.length
+        while offset < end:
+            n = os.sendfile(sock.fileno(), self.file.fileno(), offset, end - offset)
+            if n == 0:
+                raise EOFError(f"File ended {end - offset} bytes short of its payload")
+            offset += n
+
+    # the payload as bytes, for peers it can't be sent to directly
+    def read(self):
+        data = bytearray(self.length)
+        view = memoryview(data)
+        filled = 0
+        while filled < self.length:
+            n = os.preadv(self.file.fileno(), [view[filled:]], self.offset + filled)
+            if n == 0:
+                raise EOFError(f"File ended {self.length - filled} bytes short of its payload")
+            filled += n
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+PAYLOAD_TYPES = (bytes, bytearray, memoryview, FilePayload)
+
+
+# bytes of a message's payload, 0 if it has none
+def payload_size(message):
+    for field in PAYLOAD_FIELDS:
+        if isinstance(message.get(field), PAYLOAD_TYPES):
+            return len(message[field])
+    return 0
+
+
+# codec of the requests this process sends, "json" or "msgpack"
+def set_codec(name):
+    global request_codec
+    if name not in CODEC_VERSIONS:
+        raise ValueError(f"Unknown codec {name!r}")
+    if name == "msgpack" and msgpack is None:
+        raise ValueError("The msgpack codec needs the msgpack package")
+    request_codec = name
+
+
+# build the frame header and metadata header for a message, returns (header bytes, payload)
+def encode_message(message, request_id=0, codec=None):
+    header = dict(message)
+    payload = b""
+    for field in PAYLOAD_FIELDS:
+        if isinstance(header.get(field), PAYLOAD_TYPES):
+            payload = header.pop(field)
+            header["payload"] = field
+            break
+    return encode_header(header, request_id, len(payload), codec), payload
+
+
+# frame header for a message whose payload of payload_len bytes is sent afterwards in pieces
+def encode_stream_header(message, request_id, payload_len, field="data", codec=None):
+    return encode_header(dict(message, payload=field), request_id, payload_len, codec)
+
+
+# pack the fixed header followed by the metadata header in codec, the process default if None, header is consumed
+def encode_header(header, request_id, payload_len, codec=None):
+    codec = codec or request_codec
+    if codec == "msgpack":
+        meta = msgpack.packb(header, use_bin_type=True)
+    else:
+        meta = json.dumps(header, separators=(",", ":")).encode()
+    return FRAME_HEADER.pack(MAGIC, CODEC_VERSIONS[codec], 0, request_id, len(meta), payload_len) + meta
+
+
+# send a message as a single frame
+def send_message(sock, message, request_id=0, codec=None):
+    head, payload = encode_message(message, request_id, codec)
+    if isinstance(payload, FilePayload):
+        try:
+            sock.sendall(head)
+            payload.send(sock)
+        finally:
+            payload.close()
+    elif len(payload) < COPY_THRESHOLD:
+        sock.sendall(head + bytes(payload))
+    else:
+        sock.sendall(head)
+        sock.sendall(payload)
+
+
+# send a message in the old json form, block bytes are base64 encoded
+def send_legacy(sock, message):
+    sock.sendall(json.dumps(to_legacy(message)).encode())
+
+
+# reply on a connection using the same form and codec the request arrived in
+def send_reply(sock, message, request_id=0, codec=None):
+    if codec == LEGACY:
+        message = read_file_payloads(message)
+        send_legacy(sock, message)
+    else:
+        send_message(sock, message, request_id, codec)
+
+
+# fill a buffer from the socket, raising if the peer closes early
+def recv_exact_into(sock, view):
+    view = memoryview(view)
+    while len(view):
+        n = sock.recv_into(view)
+        if n == 0:
+            raise ConnectionError("Connection closed in the middle of a message")
+        view = view[n:]
+
+
+# receive one message, returns (request_id, message, codec)
+# returns (None, None, None) if the peer closed the connection before sending anything
+def recv_message(sock):
+    request_id, message, payload_len, codec = recv_header(sock)
+    if message is not None:
+        recv_payload(sock, message, payload_len)
+    return request_id, message, codec
+
+
+# receive a message without its payload, returns (request_id, message, payload_len, codec), codec is LEGACY for old style messages
+# the caller must consume the payload, with recv_payload or by reading payload_len bytes itself
+def recv_header(sock):
+    first = bytearray(len(MAGIC))
+    n = sock.recv_into(first)
+    if n == 0:
+        return None, None, 0, None
+    if n < len(first):
+        recv_exact_into(sock, memoryview(first)[n:])
+
+    if bytes(first) != MAGIC:
+        return 0, recv_legacy(sock, first), 0, LEGACY
+
+    fixed = bytearray(FRAME_HEADER.size)
+    fixed[:len(MAGIC)] = first
+    recv_exact_into(sock, memoryview(fixed)[len(MAGIC):])
+    _, version, opcode, request_id, header_len, payload_len = FRAME_HEADER.unpack(fixed)
+    codec = VERSION_CODECS.get(version)
+    if codec is None or (codec == "msgpack" and msgpack is None):
+        raise ValueError(f"Unsupported protocol version {version}")
+
+    meta = bytearray(header_len)
+    recv_exact_into(sock, meta)
+    if codec == "msgpack":
+        message = msgpack.unpackb(meta, raw=False, strict_map_key=False)
+    else:
+        message = json.loads(meta)
+    if opcode:
+        # the frame can't be understood and the connection is given up
+        raise ValueError(f"Unknown opcode {opcode}")
+    return request_id, message, payload_len, codec
+
+
+# read a message's payload into a buffer of its exact size and store it under its field
+def recv_payload(sock, message, payload_len):
+    field = message.pop("payload", None)
+    if field is not None:
+        payload = bytearray(payload_len)
+        recv_exact_into(sock, payload)
+        message[field] = payload
+
+
+# read and discard a payload of payload_len bytes, so the next message on the connection can be read
+def skip_payload(sock, payload_len):
+    buffer = memoryview(bytearray(min(payload_len, COPY_THRESHOLD)))
+    while payload_len:
+        n = sock.recv_into(buffer[:min(len(buffer), payload_len)])
+        if n == 0:
+            raise ConnectionError("Connection closed in the middle of a message")
+        payload_len -= n
+
+
+# receive the rest of an old style json message whose first bytes were already read
+def recv_legacy(sock, data):
+    data = bytearray(data)
+    while True:
+        try:
+            message = json.loads(data)
+            break
+        except json.JSONDecodeError:
+            chunk = sock.recv(65536)
+            if not chunk:
+                raise
+            data += chunk
+    return from_legacy(message)
+
+
+# replace file payloads with their bytes
+def read_file_payloads(message):
+    if isinstance(message, dict) and any(isinstance(message.get(f), FilePayload) for f in PAYLOAD_FIELDS):
+        message = dict(message)
+        for field in PAYLOAD_FIELDS:
+            payload = message.get(field)
+            if isinstance(payload, FilePayload):
+                try:
+                    message[field] = payload.read()
+                finally:
+                    payload.close()
+    return message
+
+
+# convert base64 block fields of an old style message into bytes
+def from_legacy(message):
+    if isinstance(message, dict):
+        for field in PAYLOAD_FIELDS:
+            if isinstance(message.get(field), str):
+                message[field] = base64.b64decode(message[field])
+    return message
+
+
+# convert bytes block fields into base64 strings for an old style peer
+def to_legacy(message):
+    if isinstance(message, dict) and any(isinstance(message.get(f), (bytes, bytearray, memoryview)) for f in PAYLOAD_FIELDS):
+        message = dict(message)
+        for field in PAYLOAD_FIELDS:
+            if isinstance(message.get(field), (bytes, bytearray, memoryview)):
+                message[field] = base64.b64encode(message[field]).decode()
+    return message
@@ -0,0 +1,112 @@
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import protocol
+from metrics import Metrics, SamplingProfiler
+
+DEFAULT_WORKERS = 16
+
+# accept loop shared by the namenode and datanodes
+# every connection gets a reader thread that stays open for as many requests as the peer sends,
+# requests are processed on a shared worker pool and answered with the request id they came with
+#
+# stream_handlers maps a command to handler(command, conn, payload_len) for requests whose payload
+# should be consumed as it arrives rather than buffered, they run on the connection's reader thread,
+# check(command) returns the error response for a request a stream handler must not be given, or None, and a refused
+# request's payload is read off the connection before the error is sent so the next request can still be read
+#
+# every request is timed into metrics by command, along with payload bytes in and out, requests waiting
+# for a worker and errors, the server answers metrics and profile requests itself, info() adds node specific
+# fields to the metrics response
+class ThreadedServer:
+    def __init__(self, ip, port, process, workers=DEFAULT_WORKERS, name="Server", stream_handlers=None, metrics=None, info=None, check=None):
+        self.ip = ip
+        self.port = port
+        self.process = process
+        self.stream_handlers = stream_handlers or {}
+        self.check = check
+        self.workers = workers
+        self.name = name
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.metrics = metrics or Metrics()
+        self.info = info
+        self.profiler = SamplingProfiler()
+
+    # start listening and dispatch connections until interrupted
+    def serve_forever(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((self.ip, self.port))
+            s.listen(socket.SOMAXCONN)
+            print(f"{self.name} started at {self.ip}:{self.port} with {self.workers} workers")
+            try:
+                while True:
+                    conn, addr = s.accept()
+                    print(f"Connection from {addr}")
+                    self.metrics.add("connections")
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    threading.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
+            except KeyboardInterrupt:
+                s.close()
+                print("\nProgram terminated by user.")
+            finally:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+
+    # read requests off one connection until the peer closes it
+    def serve_connection(self, conn):
+        send_lock = threading.Lock()
+        with conn:
+            try:
+                while True:
+                    request_id, command, payload_len, codec = protocol.recv_header(conn)
+                    if command is None:
+                        break
+                    self.metrics.add("bytes_in", payload_len)
+                    handler = self.stream_handlers.get(command["command"])
+                    if handler is not None and codec != protocol.LEGACY:
+                        command.pop("payload", None)
+                        error = self.check(command) if self.check else None
+                        if error is not None:
+                            protocol.skip_payload(conn, payload_len)
+                            self.respond(conn, send_lock, command, request_id, codec, lambda command: error)
+                            continue
+                        self.respond(conn, send_lock, command, request_id, codec, lambda command: handler(command, conn, payload_len))
+                        continue
+                    protocol.recv_payload(conn, command, payload_len)
+                    if codec == protocol.LEGACY:
+                        # old style peers send one json request per connection
+                        self.respond(conn, send_lock, command, request_id, codec)
+                        break
+                    self.metrics.gauge("queued", 1)
+                    self.pool.submit(self.respond_queued, conn, send_lock, command, request_id, codec)
+            except (OSError, ValueError) as e:
+                print(f"Error reading from connection: {e}")
+
+    def respond_queued(self, *args):
+        self.metrics.gauge("queued", -1)
+        self.respond(*args)
+
+    # process a request and send its response back on the same connection
+    def respond(self, conn, send_lock, command, request_id, codec, process=None):
+        name = command.get("command")
+        with self.metrics.track(name):
+            try:
+                response = self.dispatch(command, process)
+            except Exception as e:
+                response = {"command":name, "status":"error", "message":f"{self.name} Error: {e}"}
+            if response.get("status")=="error":
+                self.metrics.add(f"errors.{name}")
+            self.metrics.add("bytes_out", protocol.payload_size(response))
+            try:
+                with send_lock:
+                    protocol.send_reply(conn, response, request_id, codec)
+            except OSError as e:
+                print(f"Error sending response: {e}")
+
+    def dispatch(self, command, process=None):
+        if command["command"]=="metrics":
+            return dict(self.info() if self.info else {}, command="metrics", status="success", node=self.name, port=self.port,
+                        workers=self.workers, profiling=self.profiler.running, **self.metrics.snapshot())
+        if command["command"]=="profile":
+            return self.profiler.command(command)
+        return (process or self.process)(command)
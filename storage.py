@@ -0,0 +1,487 @@
+import contextlib
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from checksum import ChecksumError, ChecksumReader, ChecksumWriter, META_SUFFIX, meta_path
+from namespace import parse_block_id
+
+# sharded layout: a block lives at <storage>/<first 2 hex chars of its id>/<next 2>/<id>, next to its .meta sidecar,
+# so no directory holds more than a few thousand blocks however many the datanode stores
+SHARD_WIDTH = 2
+SHARD_DEPTH = 2
+# blocks at least this big get their space reserved up front with fallocate so they are written contiguously
+PREALLOCATE_MIN = 1024 * 1024
+# a block is written under a temporary name in its shard and renamed into place, after its sidecar, once it is whole,
+# so a block in the shards always has a sidecar and one without is corrupt
+TEMP_SUFFIX = ".tmp"
+# present in the storage root once every block in the shards has a sidecar, blocks from before checksums get theirs on start
+SIDECARS_MARKER = ".sidecars"
+
+# packed layout: blocks of at most PACK_LIMIT bytes are appended to segment files under <storage>/segments,
+# bigger ones are stored sharded as above
+PACK_LIMIT = 64 * 1024
+SEGMENT_DIR = "segments"
+SEGMENT_SUFFIX = ".seg"
+SEGMENT_SIZE = 64 * 1024 * 1024
+# every record starts with a header: magic, kind, segment, block id, checksum bytes, data bytes
+# then a crc32 of the header and checksum bytes, the block's .meta contents, and the block data
+# a tombstone records the deletion of the block's record in segment, and has no checksums or data,
+# it only applies to that segment so a block written again later under the same id is left alone
+RECORD_MAGIC = b"EDPK"
+RECORD = struct.Struct("!4sBI16sIQ")
+RECORD_CRC = struct.Struct("!I")
+BLOCK_RECORD = 1
+TOMBSTONE_RECORD = 2
+# segments other than the one being appended to are rewritten once less than COMPACT_RATIO of them is live blocks,
+# looked for every COMPACT_INTERVAL seconds
+COMPACT_RATIO = 0.5
+COMPACT_INTERVAL = 60
+
+
+def shard_dir(root, block_id):
+    return os.path.join(root, *(block_id[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_DEPTH)))
+
+
+# packed records hold block ids as 16 bytes, so only ids in the canonical uuid form can be packed
+def is_uuid(block_id):
+    try:
+        return str(uuid.UUID(block_id)) == block_id
+    except ValueError:
+        return False
+
+
+# whether a file name is a block id, anything else in a storage directory, like a .DS_Store, isn't a block and is left alone
+def is_block_id(name):
+    try:
+        parse_block_id(name)
+    except ValueError:
+        return False
+    return True
+
+
+# a stored block open for reading, data is length bytes of the file fileno starting at offset
+# version changes whenever the block is rewritten or moved, so a verification can be tied to it
+class BlockFile:
+    def __init__(self, f, offset, length, version, checksums, owned=True):
+        self.f = f
+        self.owned = owned      # whether closing the block closes f
+        self.offset = offset
+        self.length = length
+        self.version = version
+        self.checksums = checksums
+        self.position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fileno(self):
+        return self.f.fileno()
+
+    # the ChecksumReader for the block, None if it was stored without checksums
+    def checksum_reader(self):
+        return self.checksums() if callable(self.checksums) else self.checksums
+
+    # move to position bytes into the block
+    def seek(self, position):
+        self.position = position
+
+    # read the next bytes of the block into view, 0 at the end of the block
+    def readinto(self, view):
+        n = os.preadv(self.f.fileno(), [view[:self.length - self.position]], self.offset + self.position)
+        self.position += n
+        return n
+
+    def close(self):
+        if self.owned:
+            self.f.close()
+
+
+# a block being written, data arrives in pieces and only becomes readable on commit
+class BlockWriter:
+    def __init__(self, storage, block_id):
+        self.storage = storage
+        self.block_id = block_id
+        self.summer = ChecksumWriter()
+
+    def write(self, data):
+        self.summer.update(data)
+
+    def commit(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class FileBlockWriter(BlockWriter):
+    def __init__(self, storage, block_id, length):
+        super().__init__(storage, block_id)
+        self.path = storage.path_of(block_id, create=True)
+        self.temp_path = f"{self.path}.{uuid.uuid4().hex[:8]}{TEMP_SUFFIX}"
+        self.f = open(self.temp_path, "wb", buffering=0)
+        if length >= PREALLOCATE_MIN and hasattr(os, "posix_fallocate"):
+            # not every filesystem can reserve space, the block is written all the same
+            with contextlib.suppress(OSError):
+                os.posix_fallocate(self.f.fileno(), 0, length)
+
+    def write(self, data):
+        pending = memoryview(data)
+        while len(pending):
+            pending = pending[self.f.write(pending):]
+        super().write(data)
+
+    def commit(self):
+        self.f.close()
+        self.summer.write(self.temp_path)
+        os.replace(meta_path(self.temp_path), meta_path(self.path))
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        self.f.close()
+        for path in (self.temp_path, meta_path(self.temp_path)):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+
+# every block in a file of its own, in hashed subdirectories of root
+class ShardedStorage:
+    def __init__(self, root):
+        self.root = root
+        self.made = set()       # shard directories known to exist
+        self.migrate()
+        self.recover()
+
+    # move blocks of the old flat layout into their shards, renames only so it is quick even for many blocks
+    def migrate(self):
+        moved = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_file() or not is_block_id(entry.name):
+                continue
+            path = self.path_of(entry.name, create=True)
+            with contextlib.suppress(FileNotFoundError):
+                os.replace(meta_path(entry.path), meta_path(path))
+            os.replace(entry.path, path)
+            moved += 1
+        if moved:
+            print(f"Moved {moved} blocks into sharded directories")
+
+    # remove what writes cut short by a crash left behind: blocks under temporary names and sidecars of blocks that never
+    # got renamed into place, and the first time, give blocks stored before checksums a sidecar of their data as it is now
+    def recover(self):
+        marker = os.path.join(self.root, SIDECARS_MARKER)
+        upgrade = not os.path.exists(marker)
+        removed = summed = 0
+        for directory, names in self.shard_dirs():
+            for name in names:
+                path = os.path.join(directory, name)
+                block_name = name[:-len(META_SUFFIX)] if name.endswith(META_SUFFIX) else name
+                # a temporary name is the block id followed by a random part and TEMP_SUFFIX
+                temp = block_name.endswith(TEMP_SUFFIX)
+                if not is_block_id(block_name[:-len(TEMP_SUFFIX)].rpartition(".")[0] if temp else block_name):
+                    continue
+                if temp or (block_name != name and block_name not in names):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+                    removed += 1
+                elif upgrade and block_name == name and name + META_SUFFIX not in names:
+                    summer = ChecksumWriter()
+                    with open(path, "rb") as f:
+                        for data in iter(lambda: f.read(1024 * 1024), b""):
+                            summer.update(data)
+                    summer.write(path)
+                    summed += 1
+        if removed:
+            print(f"Removed {removed} files of unfinished block writes")
+        if summed:
+            print(f"Wrote checksums for {summed} blocks stored without them")
+        if upgrade:
+            open(marker, "w").close()
+
+    def start(self):
+        pass
+
+    def path_of(self, block_id, create=False):
+        directory = shard_dir(self.root, block_id)
+        if create and directory not in self.made:
+            os.makedirs(directory, exist_ok=True)
+            self.made.add(directory)
+        return os.path.join(directory, block_id)
+
+    def create(self, block_id, length):
+        return FileBlockWriter(self, block_id, length)
+
+    def open(self, block_id):
+        path = self.path_of(block_id)
+        f = open(path, "rb", buffering=0)
+        st = os.fstat(f.fileno())
+        return BlockFile(f, 0, st.st_size, (st.st_mtime_ns, st.st_size), lambda: self.checksums(path))
+
+    # the checksums of the block at path, a block in the shards always has a sidecar so it is corrupt without one
+    @staticmethod
+    def checksums(path):
+        reader = ChecksumReader.open(path)
+        if reader is None:
+            raise ChecksumError("Block has no checksum file")
+        return reader
+
+    def version(self, block_id):
+        st = os.stat(self.path_of(block_id))
+        return (st.st_mtime_ns, st.st_size)
+
+    # remove a block, returns its size
+    def delete(self, block_id):
+        path = self.path_of(block_id)
+        size = os.path.getsize(path)
+        os.remove(path)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(meta_path(path))
+        return size
+
+    # (directory, {name: directory entry} of the files in it) of every leaf shard directory
+    def shard_dirs(self):
+        stack = [(self.root, 0)]
+        while stack:
+            directory, depth = stack.pop()
+            with contextlib.suppress(FileNotFoundError):
+                if depth == SHARD_DEPTH:
+                    yield directory, {entry.name: entry for entry in os.scandir(directory) if entry.is_file()}
+                    continue
+                for entry in os.scandir(directory):
+                    if entry.is_dir() and len(entry.name) == SHARD_WIDTH:
+                        stack.append((entry.path, depth + 1))
+
+    # (block id, size) of every block, from the shard directories, blocks still being written are left out
+    def blocks(self):
+        for directory, names in self.shard_dirs():
+            for name, entry in names.items():
+                if is_block_id(name):
+                    with contextlib.suppress(FileNotFoundError):
+                        yield name, entry.stat().st_size
+
+    def block_ids(self):
+        return [block_id for block_id, _ in self.blocks()]
+
+    def used(self):
+        return sum(size for _, size in self.blocks())
+
+
+class PackedBlockWriter(BlockWriter):
+    def __init__(self, storage, block_id, length):
+        super().__init__(storage, block_id)
+        self.data = bytearray()
+        self.data_length = length
+
+    def write(self, data):
+        self.data += data
+        super().write(data)
+
+    def commit(self):
+        if len(self.data) != self.data_length:
+            raise IOError(f"Block is {len(self.data)} bytes, expected {self.data_length}")
+        self.storage.append_block(self.block_id, self.summer.finish(), self.data)
+
+
+# small blocks appended to large segment files, found through an in-memory index rebuilt from the segments on start
+# deleting a block appends a tombstone, and segments left mostly dead are compacted in the background
+class PackedStorage:
+    def __init__(self, root, pack_limit=PACK_LIMIT, segment_size=SEGMENT_SIZE):
+        self.root = root
+        self.pack_limit = pack_limit
+        self.segment_size = segment_size
+        self.files = ShardedStorage(root)
+        self.segment_dir = os.path.join(root, SEGMENT_DIR)
+        os.makedirs(self.segment_dir, exist_ok=True)
+
+        # guards everything below, appends and index changes happen together
+        self.lock = threading.Lock()
+        self.index = {}         # block id -> (segment, record offset, checksum bytes, data bytes)
+        self.segments = {}      # segment -> [file, size in bytes, live block record bytes]
+        self.active = None      # segment appended to
+        self.load()
+
+    def start(self):
+        threading.Thread(target=self.compact_forever, daemon=True).start()
+
+    def segment_path(self, segment):
+        return os.path.join(self.segment_dir, f"{segment:08d}{SEGMENT_SUFFIX}")
+
+    # rebuild the index by replaying every segment in order, a torn record at the end of a segment is cut off
+    def load(self):
+        numbers = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.segment_dir) if name.endswith(SEGMENT_SUFFIX))
+        for segment in numbers:
+            f = open(self.segment_path(segment), "a+b", buffering=0)
+            self.segments[segment] = [f, 0, 0]
+            size = os.fstat(f.fileno()).st_size
+            offset = 0
+            while offset < size:
+                record = self.read_record(f, offset, size)
+                if record is None:
+                    print(f"Segment {segment} has a torn record at byte {offset}, dropping its last {size - offset} bytes")
+                    f.truncate(offset)
+                    break
+                kind, target, block_id, meta_length, data_length = record
+                length = RECORD.size + RECORD_CRC.size + meta_length + data_length
+                if kind == BLOCK_RECORD:
+                    self.forget(block_id)
+                    self.index[block_id] = (segment, offset, meta_length, data_length)
+                    self.segments[segment][2] += length
+                elif self.index.get(block_id, (None,))[0] == target:
+                    self.forget(block_id)
+                offset += length
+            self.segments[segment][1] = offset
+        self.roll(numbers[-1] if numbers else 0)
+        if self.index:
+            print(f"Loaded {len(self.index)} packed blocks from {len(numbers)} segments")
+
+    # header fields of the record at offset, None if it is cut short or damaged
+    @staticmethod
+    def read_record(f, offset, size):
+        header = os.pread(f.fileno(), RECORD.size + RECORD_CRC.size, offset)
+        if len(header) < RECORD.size + RECORD_CRC.size:
+            return None
+        magic, kind, target, raw_id, meta_length, data_length = RECORD.unpack_from(header)
+        if magic != RECORD_MAGIC or kind not in (BLOCK_RECORD, TOMBSTONE_RECORD):
+            return None
+        if offset + len(header) + meta_length + data_length > size:
+            return None
+        meta = os.pread(f.fileno(), meta_length, offset + len(header))
+        if zlib.crc32(meta, zlib.crc32(header[:RECORD.size])) != RECORD_CRC.unpack_from(header, RECORD.size)[0]:
+            return None
+        return kind, target, str(uuid.UUID(bytes=raw_id)), meta_length, data_length
+
+    # drop a block from the index, counting its record as dead, called with lock held
+    def forget(self, block_id):
+        entry = self.index.pop(block_id, None)
+        if entry is not None:
+            segment, _, meta_length, data_length = entry
+            self.segments[segment][2] -= RECORD.size + RECORD_CRC.size + meta_length + data_length
+        return entry
+
+    # start appending to a new segment unless segment is still below the segment size, called with lock held
+    def roll(self, segment):
+        if segment in self.segments and self.segments[segment][1] < self.segment_size:
+            self.active = segment
+            return
+        self.active = segment + 1
+        self.segments[self.active] = [open(self.segment_path(self.active), "a+b", buffering=0), 0, 0]
+
+    # append a record to the active segment, returns (segment, offset), called with lock held
+    def append(self, kind, target, block_id, meta, data):
+        header = RECORD.pack(RECORD_MAGIC, kind, target, uuid.UUID(block_id).bytes, len(meta), len(data))
+        crc = zlib.crc32(meta, zlib.crc32(header))
+        segment = self.active
+        f, offset, _ = self.segments[segment]
+        pending = memoryview(b"".join((header, RECORD_CRC.pack(crc), meta, data)))
+        try:
+            while len(pending):
+                pending = pending[f.write(pending):]
+        except OSError:
+            # don't leave half a record for the next one to land behind
+            f.truncate(offset)
+            raise
+        self.segments[segment][1] = offset + len(header) + RECORD_CRC.size + len(meta) + len(data)
+        self.roll(segment)
+        return segment, offset
+
+    def append_block(self, block_id, meta, data):
+        with self.lock:
+            segment, offset = self.append(BLOCK_RECORD, 0, block_id, meta, data)
+            self.forget(block_id)
+            self.index[block_id] = (segment, offset, len(meta), len(data))
+            self.segments[segment][2] += RECORD.size + RECORD_CRC.size + len(meta) + len(data)
+
+    def create(self, block_id, length):
+        if length > self.pack_limit or not is_uuid(block_id):
+            return self.files.create(block_id, length)
+        return PackedBlockWriter(self, block_id, length)
+
+    def open(self, block_id):
+        with self.lock:
+            entry = self.index.get(block_id)
+            if entry is not None:
+                segment, offset, meta_length, data_length = entry
+                f = self.segments[segment][0]
+        if entry is None:
+            return self.files.open(block_id)
+        # the segment file stays open for this reader even if compaction removes it meanwhile
+        meta_offset = offset + RECORD.size + RECORD_CRC.size
+        meta = os.pread(f.fileno(), meta_length, meta_offset)
+        return BlockFile(f, meta_offset + meta_length, data_length, (segment, offset), ChecksumReader(meta) if meta else None, owned=False)
+
+    def version(self, block_id):
+        with self.lock:
+            entry = self.index.get(block_id)
+        if entry is None:
+            return self.files.version(block_id)
+        return entry[:2]
+
+    def delete(self, block_id):
+        with self.lock:
+            entry = self.index.get(block_id)
+            if entry is not None:
+                self.append(TOMBSTONE_RECORD, entry[0], block_id, b"", b"")
+                self.forget(block_id)
+                return entry[3]
+        return self.files.delete(block_id)
+
+    def block_ids(self):
+        with self.lock:
+            packed = list(self.index)
+        return packed + self.files.block_ids()
+
+    def used(self):
+        with self.lock:
+            packed = sum(entry[3] for entry in self.index.values())
+        return packed + self.files.used()
+
+    def compact_forever(self):
+        while True:
+            time.sleep(COMPACT_INTERVAL)
+            with self.lock:
+                sparse = [segment for segment, (_, size, live) in self.segments.items()
+                          if segment != self.active and live < size * COMPACT_RATIO]
+            for segment in sparse:
+                try:
+                    self.compact(segment)
+                except OSError as e:
+                    print(f"Failed to compact segment {segment}: {e}")
+
+    # copy the live blocks of a segment to the active one and remove it
+    # a tombstone is carried over while the segment holding the block it deleted still exists
+    def compact(self, segment):
+        with self.lock:
+            f, size, live = self.segments[segment]
+        offset = 0
+        moved = 0
+        while offset < size:
+            record = self.read_record(f, offset, size)
+            if record is None:
+                raise OSError(f"Unreadable record at byte {offset}")
+            kind, target, block_id, meta_length, data_length = record
+            body_offset = offset + RECORD.size + RECORD_CRC.size
+            if kind == BLOCK_RECORD:
+                meta = os.pread(f.fileno(), meta_length, body_offset)
+                data = os.pread(f.fileno(), data_length, body_offset + meta_length)
+            with self.lock:
+                if kind == BLOCK_RECORD and self.index.get(block_id, (None, None))[:2] == (segment, offset):
+                    new_segment, new_offset = self.append(BLOCK_RECORD, 0, block_id, meta, data)
+                    self.forget(block_id)
+                    self.index[block_id] = (new_segment, new_offset, meta_length, data_length)
+                    self.segments[new_segment][2] += RECORD.size + RECORD_CRC.size + meta_length + data_length
+                    moved += 1
+                elif kind == TOMBSTONE_RECORD and target != segment and target in self.segments:
+                    self.append(TOMBSTONE_RECORD, target, block_id, b"", b"")
+            offset = body_offset + meta_length + data_length
+        with self.lock:
+            del self.segments[segment]
+        os.remove(self.segment_path(segment))
+        print(f"Compacted segment {segment}, moved {moved} blocks, freed {size - live} bytes")
+
+
+ENGINES = {"sharded": ShardedStorage, "packed": PackedStorage}